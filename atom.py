@@ -5,10 +5,15 @@ __author__ = "Steve Marshall (steve@nascentguruism.com)"
 __copyright__ = "Copyright (c) 2008 Steve Marshall"
 __license__ = "Python"
 
+from atompath import compile_path
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+import mmap
 import os
 import StringIO
-from struct import calcsize, pack, unpack
-import tempfile
+from struct import Struct
+import threading
+import time
 
 
 ATOM_HEADER = {
@@ -20,12 +25,18 @@ ATOM_HEADER = {
     # Only used if basic size == 1
     'large': '>L4sQ',
 }
+# Precompiled versions of the above, for decoding straight from buffers
+ATOM_HEADER_STRUCT = {
+    'basic': Struct(ATOM_HEADER['basic']),
+    'large': Struct(ATOM_HEADER['large']),
+}
 # Define known atom types
 ATOM_CONTAINER_TYPES = [
     'aaid', 'akid', '\xa9alb', 'apid', 'aART', '\xa9ART', 'atid', 'clip',
     '\xa9cmt', '\xa9com', 'covr', 'cpil', 'cprt', '\xa9day', 'dinf', 'disk',
     'edts', 'geid', 'gnre', '\xa9grp', 'hinf', 'hnti', 'ilst', 'matt',
-    'mdia', 'minf', 'moof', 'moov', '\xa9nam', 'pinf', 'plid', 'rtng',
+    'mdia', 'mfra', 'minf', 'moof', 'moov', 'mvex', '\xa9nam', 'pinf', 'plid',
+    'rtng',
     'schi', 'sinf', 'stbl', 'stik', 'tmpo', '\xa9too', 'traf', 'trak', 'trkn',
     'udta', '\xa9wrt',
 ]
@@ -46,15 +57,102 @@ ATOM_SPECIAL_CONTAINER_TYPES = {
 }
 ATOM_NONCONTAINER_TYPES = [
     'chtb', 'ctts', 'data', 'esds', 'free', 'frma', 'ftyp', '\xa9gen', 'hmhd',
-    'iviv', 'key ', 'mdat', 'mdhd', 'mp4s', 'mpv4', 'mvhd', 'name',
-    'priv', 'rtp', 'sign', 'stco', 'stsc', 'stp', 'stts', 'tfhd',
-    'tkhd', 'tref', 'trun', 'user', 'vmhd', 'wide',
+    'iviv', 'key ', 'mdat', 'mdhd', 'mehd', 'mfhd', 'mfro', 'mp4s', 'mpv4',
+    'mvhd', 'name', 'priv', 'rtp', 'sign', 'stco', 'stsc', 'stp', 'stts',
+    'tfdt', 'tfhd', 'tfra', 'tkhd', 'tref', 'trex', 'trun', 'user', 'vmhd',
+    'wide',
 ]
+# Largest piece of atom content held in memory at once while saving
+SAVE_CHUNK_SIZE = 1024 * 1024
+# Largest container read in one go to decode the headers of all its
+# descendants from memory, rather than with a seek and read per atom
+BULK_READ_SIZE = 64 * 1024 * 1024
+
+class _ActiveStats(threading.local):
+    # The AtomStats collecting counters in this thread, if any: checking
+    # it is all that instrumentation costs when it is off
+    stats = None
+
+_active = _ActiveStats()
+
+class AtomStats(object):
+    """I/O and parsing counters of all atoms, while active:
+       
+           with AtomStats() as stats:
+               Mp4File(path)
+           print stats.seeks, stats.reads, stats.bytes_read, stats.atoms
+       
+       Times are in seconds per atom type, for header parsing, content
+       reads and saving. A <hook>, if given, is called as
+       hook(operation, atom_type, bytes, seconds) on each of those.
+       
+       Only the thread that activated the counters is counted, so that
+       concurrent probes each get their own.
+    """
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.seeks = 0
+        self.reads = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.atoms = 0
+        self.atom_types = {}
+        self.parse_time = {}
+        self.read_time = {}
+        self.save_time = {}
+        self.__previous = None
+    
+    def __enter__(self):
+        self.__previous = _active.stats
+        _active.stats = self
+        return self
+    
+    def __exit__(self, *exc_info):
+        _active.stats = self.__previous
+        self.__previous = None
+        return False
+    
+    def io(self, seeks=0, reads=0, bytes_read=0):
+        self.seeks += seeks
+        self.reads += reads
+        self.bytes_read += bytes_read
+    
+    def parsed(self, atom_type, header_size, seconds):
+        self.atoms += 1
+        self.atom_types[atom_type] = self.atom_types.get(atom_type, 0) + 1
+        self.parse_time[atom_type] = \
+            self.parse_time.get(atom_type, 0.0) + seconds
+        if self.hook is not None:
+            self.hook('parse', atom_type, header_size, seconds)
+    
+    def read(self, atom_type, size, seconds):
+        self.read_time[atom_type] = \
+            self.read_time.get(atom_type, 0.0) + seconds
+        if self.hook is not None:
+            self.hook('read', atom_type, size, seconds)
+    
+    def saved(self, atom_type, size, seconds):
+        self.bytes_written += size
+        self.save_time[atom_type] = \
+            self.save_time.get(atom_type, 0.0) + seconds
+        if self.hook is not None:
+            self.hook('save', atom_type, size, seconds)
+    
+    def as_dict(self):
+        """All the counters, eg. for JSON reports"""
+        return dict(seeks=self.seeks, reads=self.reads,
+                    bytes_read=self.bytes_read,
+                    bytes_written=self.bytes_written, atoms=self.atoms,
+                    atom_types=dict(self.atom_types),
+                    parse_time=dict(self.parse_time),
+                    read_time=dict(self.read_time),
+                    save_time=dict(self.save_time))
 
 def get_header_size(content_size):
-    if 2**32 <= content_size:
-        return calcsize(ATOM_HEADER['large'])
-    return calcsize(ATOM_HEADER['basic'])
+    # The basic 32bit size has to hold the header as well as the content
+    if 2**32 <= content_size + ATOM_HEADER_STRUCT['basic'].size:
+        return ATOM_HEADER_STRUCT['large'].size
+    return ATOM_HEADER_STRUCT['basic'].size
 
 def render_atom_header(atom_type, content_size):
     """Build an MP4 atom header for a given <type> and
@@ -64,23 +162,55 @@ def render_atom_header(atom_type, content_size):
     atom_size = header_size + content_size
     
     # If we have a large (64bit) atom, render using the 'large data' flag
-    if calcsize(ATOM_HEADER['large']) == header_size :
-        rendered_header = pack( \
-            ATOM_HEADER['large'], \
+    if ATOM_HEADER_STRUCT['large'].size == header_size :
+        rendered_header = ATOM_HEADER_STRUCT['large'].pack( \
             1, atom_type, atom_size)
     else:
-        rendered_header = pack( \
-            ATOM_HEADER['basic'], \
+        rendered_header = ATOM_HEADER_STRUCT['basic'].pack( \
             atom_size, atom_type)
     
     return rendered_header
 
+def unpack_atom_header(buffer, offset=0, end=None):
+    """Decode an atom header at a particular <offset> within an object
+       supporting the buffer interface (a string, mmap, etc.) without
+       copying it. Returns (atom_type, content_size, header_size).
+       
+       Atoms with a zero size run up to <end>, which defaults to the end
+       of the buffer.
+    """
+    basic_header = ATOM_HEADER_STRUCT['basic']
+    
+    (atom_size, atom_type) = basic_header.unpack_from(buffer, offset)
+    header_size = basic_header.size
+    
+    # If we have a large atom, use the large size in place of the size
+    if 1 == atom_size:
+        large_header = ATOM_HEADER_STRUCT['large']
+        atom_size = large_header.unpack_from(buffer, offset)[2]
+        header_size = large_header.size
+    
+    # A zero size means the atom extends to the end of the buffer
+    if 0 == atom_size:
+        if end is None:
+            end = len(buffer)
+        atom_size = end - offset
+    
+    return (atom_type, atom_size - header_size, header_size)
+
 def parse_atom_header(stream, offset=0):
     """Parse an atom header from a particular <offset> within a
        file-like object
     """
-    basic_header = calcsize(ATOM_HEADER['basic'])
-    large_header = calcsize(ATOM_HEADER['large'])
+    # Memory-mapped sources can be decoded in place, without reads
+    if isinstance(stream, MappedStream):
+        (atom_type, atom_size, header_size) = \
+            unpack_atom_header(stream.map, offset)
+        stream.seek(offset + header_size)
+        return (atom_type, atom_size)
+    
+    basic_header = ATOM_HEADER_STRUCT['basic'].size
+    large_header = ATOM_HEADER_STRUCT['large'].size
     
     header_size = large_header
     
@@ -92,11 +222,10 @@ def parse_atom_header(stream, offset=0):
     # If we have enough data to unpack as a large atom, try that
     if len(atom_header) == large_header:
         (atom_size, atom_type, large_atom_size) = \
-            unpack(ATOM_HEADER['large'], atom_header)
+            ATOM_HEADER_STRUCT['large'].unpack(atom_header)
     else:
         (atom_size, atom_type) = \
-            unpack(ATOM_HEADER['basic'], \
-                          atom_header[:basic_header])
+            ATOM_HEADER_STRUCT['basic'].unpack_from(atom_header)
     
     # If we have a large atom, use the large size in place of the size
     if 1 == atom_size:
@@ -107,46 +236,595 @@ def parse_atom_header(stream, offset=0):
         header_size = basic_header
 
     if 0 == atom_size:
+        # The atom extends to the end of the stream
         stream.seek(0, os.SEEK_END)
-    else:
-        # Remove the header from the size we use
-        atom_size -= header_size
+        atom_size = stream.tell() - offset
+        if _active.stats is not None:
+            _active.stats.io(seeks=1)
+    
+    # Remove the header from the size we use
+    atom_size -= header_size
     
-        # Jump back to the end of the actual header because we will have overrun into
-        # the content, if we have a basic header)
-        offset_fix = -(len(atom_header) - header_size)
-        stream.seek(offset_fix, os.SEEK_CUR)
+    # Jump back to the end of the actual header because we will have overrun into
+    # the content, if we have a basic header)
+    stream.seek(offset + header_size)
+    
+    if _active.stats is not None:
+        _active.stats.io(seeks=2, reads=1, bytes_read=len(atom_header))
     
     return (atom_type, atom_size)
 
 
+# Typed boxes
+#
+# Decoders take the content of an atom and return its fields as a named
+# tuple; encoders take the fields back along with the original content,
+# whose bytes outside the fields (reserved words, matrices, extensions)
+# are kept as they are. Version 0 boxes are promoted to version 1 when a
+# time no longer fits in 32 bits.
+
+MovieHeader = namedtuple('MovieHeader', 'version flags creation_time '
+    'modification_time timescale duration rate volume next_track_id')
+MediaHeader = namedtuple('MediaHeader', 'version flags creation_time '
+    'modification_time timescale duration language')
+TrackHeader = namedtuple('TrackHeader', 'version flags creation_time '
+    'modification_time track_id duration layer alternate_group volume '
+    'width height')
+HandlerReference = namedtuple('HandlerReference',
+    'version flags handler_type name')
+EditList = namedtuple('EditList', 'version flags entries')
+EditListEntry = namedtuple('EditListEntry',
+    'segment_duration media_time media_rate')
+VisualSampleEntry = namedtuple('VisualSampleEntry', 'data_reference_index '
+    'width height horizontal_resolution vertical_resolution frame_count '
+    'compressor_name depth')
+AudioSampleEntry = namedtuple('AudioSampleEntry',
+    'data_reference_index channel_count sample_size sample_rate')
+
+FULL_BOX_STRUCT = Struct('>L')
+# Times and durations, by version, and the fields following them as
+# (offset after the times, struct)
+MOVIE_HEADER_STRUCT = (Struct('>LLLL'), Struct('>QQLQ'))
+MOVIE_HEADER_RATE_STRUCT = (0, Struct('>lh'))
+MOVIE_HEADER_NEXT_TRACK_STRUCT = (76, Struct('>L'))
+MEDIA_HEADER_STRUCT = (Struct('>LLLLH'), Struct('>QQLQH'))
+TRACK_HEADER_STRUCT = (Struct('>LLL4xL'), Struct('>QQL4xQ'))
+TRACK_HEADER_LAYER_STRUCT = (8, Struct('>hhh'))
+TRACK_HEADER_SIZE_STRUCT = (52, Struct('>LL'))
+HANDLER_STRUCT = Struct('>4x4s12x')
+# The media rate is a 16.16 fixed point number
+EDIT_LIST_ENTRY_STRUCT = (Struct('>Lll'), Struct('>Qql'))
+SAMPLE_ENTRY_STRUCT = Struct('>6xH')
+VISUAL_SAMPLE_ENTRY_STRUCT = Struct('>16xHHLL4xH32pH')
+AUDIO_SAMPLE_ENTRY_STRUCT = Struct('>8xHH4xL')
+
+def unpack_full_box(content):
+    """Version and flags of a full box"""
+    version_flags = FULL_BOX_STRUCT.unpack_from(content)[0]
+    return (version_flags >> 24, version_flags & 0xffffff)
+
+def pack_full_box(version, flags):
+    return FULL_BOX_STRUCT.pack((version << 24) | flags)
+
+def pack_times(structs, content, fields, *values):
+    """Full box header and times of a new box, followed by the rest of the
+       original <content> as a bytearray, to pack the other fields into
+    """
+    old_version = unpack_full_box(content)[0]
+    version = fields.version
+    # Version 0 times are 32bit: promote the box rather than wrap them
+    if 0 == version and 0xffffffff < max(fields.creation_time,
+            fields.modification_time, fields.duration):
+        version = 1
+    packed = bytearray(pack_full_box(version, fields.flags))
+    packed += structs[version].pack(*values)
+    packed += content[4 + structs[old_version].size:]
+    return (packed, 4 + structs[version].size)
+
+def decode_mvhd(content):
+    (version, flags) = unpack_full_box(content)
+    start = 4 + MOVIE_HEADER_STRUCT[version].size
+    (creation_time, modification_time, timescale, duration) = \
+        MOVIE_HEADER_STRUCT[version].unpack_from(content, 4)
+    (rate, volume) = MOVIE_HEADER_RATE_STRUCT[1].unpack_from(content,
+        start + MOVIE_HEADER_RATE_STRUCT[0])
+    (next_track_id, ) = MOVIE_HEADER_NEXT_TRACK_STRUCT[1].unpack_from(
+        content, start + MOVIE_HEADER_NEXT_TRACK_STRUCT[0])
+    return MovieHeader(version, flags, creation_time, modification_time,
+                       timescale, duration, rate / 65536.0, volume / 256.0,
+                       next_track_id)
+
+def encode_mvhd(fields, content):
+    (packed, start) = pack_times(MOVIE_HEADER_STRUCT, content, fields,
+        fields.creation_time, fields.modification_time, fields.timescale,
+        fields.duration)
+    MOVIE_HEADER_RATE_STRUCT[1].pack_into(packed,
+        start + MOVIE_HEADER_RATE_STRUCT[0],
+        int(round(fields.rate * 65536)), int(round(fields.volume * 256)))
+    MOVIE_HEADER_NEXT_TRACK_STRUCT[1].pack_into(packed,
+        start + MOVIE_HEADER_NEXT_TRACK_STRUCT[0], fields.next_track_id)
+    return str(packed)
+
+def unpack_language(code):
+    # ISO 639-2/T code, packed in 5 bits per letter
+    return ''.join([chr(((code >> shift) & 0x1f) + 0x60)
+                    for shift in (10, 5, 0)])
+
+def pack_language(language):
+    code = 0
+    for letter in language:
+        code = (code << 5) | ((ord(letter) - 0x60) & 0x1f)
+    return code
+
+def decode_mdhd(content):
+    (version, flags) = unpack_full_box(content)
+    (creation_time, modification_time, timescale, duration, language) = \
+        MEDIA_HEADER_STRUCT[version].unpack_from(content, 4)
+    return MediaHeader(version, flags, creation_time, modification_time,
+                       timescale, duration, unpack_language(language))
+
+def encode_mdhd(fields, content):
+    (packed, start) = pack_times(MEDIA_HEADER_STRUCT, content, fields,
+        fields.creation_time, fields.modification_time, fields.timescale,
+        fields.duration, pack_language(fields.language))
+    return str(packed)
+
+def decode_tkhd(content):
+    (version, flags) = unpack_full_box(content)
+    start = 4 + TRACK_HEADER_STRUCT[version].size
+    (creation_time, modification_time, track_id, duration) = \
+        TRACK_HEADER_STRUCT[version].unpack_from(content, 4)
+    (layer, alternate_group, volume) = TRACK_HEADER_LAYER_STRUCT[1] \
+        .unpack_from(content, start + TRACK_HEADER_LAYER_STRUCT[0])
+    (width, height) = TRACK_HEADER_SIZE_STRUCT[1].unpack_from(content,
+        start + TRACK_HEADER_SIZE_STRUCT[0])
+    return TrackHeader(version, flags, creation_time, modification_time,
+                       track_id, duration, layer, alternate_group,
+                       volume / 256.0, width / 65536.0, height / 65536.0)
+
+def encode_tkhd(fields, content):
+    (packed, start) = pack_times(TRACK_HEADER_STRUCT, content, fields,
+        fields.creation_time, fields.modification_time, fields.track_id,
+        fields.duration)
+    TRACK_HEADER_LAYER_STRUCT[1].pack_into(packed,
+        start + TRACK_HEADER_LAYER_STRUCT[0], fields.layer,
+        fields.alternate_group, int(round(fields.volume * 256)))
+    TRACK_HEADER_SIZE_STRUCT[1].pack_into(packed,
+        start + TRACK_HEADER_SIZE_STRUCT[0],
+        int(round(fields.width * 65536)), int(round(fields.height * 65536)))
+    return str(packed)
+
+def decode_hdlr(content):
+    (version, flags) = unpack_full_box(content)
+    (handler_type, ) = HANDLER_STRUCT.unpack_from(content, 4)
+    name = str(content[4 + HANDLER_STRUCT.size:])
+    # Null-terminated, though QuickTime writes a counted string instead
+    if 0 < len(name) and len(name) == ord(name[0]) + 1:
+        name = name[1:]
+    return HandlerReference(version, flags, handler_type,
+                            name.split('\0', 1)[0])
+
+def encode_hdlr(fields, content=None):
+    return pack_full_box(fields.version, fields.flags) \
+        + HANDLER_STRUCT.pack(fields.handler_type) + fields.name + '\0'
+
+def decode_elst(content):
+    (version, flags) = unpack_full_box(content)
+    (count, ) = FULL_BOX_STRUCT.unpack_from(content, 4)
+    entry = EDIT_LIST_ENTRY_STRUCT[version]
+    entries = []
+    for i in xrange(count):
+        (segment_duration, media_time, media_rate) = \
+            entry.unpack_from(content, 8 + i * entry.size)
+        entries.append(EditListEntry(segment_duration, media_time,
+                                     media_rate / 65536.0))
+    return EditList(version, flags, entries)
+
+def encode_elst(fields, content=None):
+    version = fields.version
+    if 0 == version and [e for e in fields.entries
+                         if 0xffffffff < e.segment_duration
+                         or not -2**31 <= e.media_time < 2**31]:
+        version = 1
+    entry = EDIT_LIST_ENTRY_STRUCT[version]
+    packed = [pack_full_box(version, fields.flags),
+              FULL_BOX_STRUCT.pack(len(fields.entries))]
+    for e in fields.entries:
+        packed.append(entry.pack(e.segment_duration, e.media_time,
+                                 int(round(e.media_rate * 65536))))
+    return ''.join(packed)
+
+def decode_visual_sample_entry(content):
+    (data_reference_index, ) = SAMPLE_ENTRY_STRUCT.unpack_from(content)
+    (width, height, horizontal_resolution, vertical_resolution, frame_count,
+     compressor_name, depth) = VISUAL_SAMPLE_ENTRY_STRUCT.unpack_from(
+        content, SAMPLE_ENTRY_STRUCT.size)
+    return VisualSampleEntry(data_reference_index, width, height,
+                             horizontal_resolution / 65536.0,
+                             vertical_resolution / 65536.0, frame_count,
+                             compressor_name, depth)
+
+def encode_visual_sample_entry(fields, content):
+    # Codec configuration boxes follow the fields, and are kept
+    packed = bytearray(content)
+    SAMPLE_ENTRY_STRUCT.pack_into(packed, 0, fields.data_reference_index)
+    VISUAL_SAMPLE_ENTRY_STRUCT.pack_into(packed, SAMPLE_ENTRY_STRUCT.size,
+        fields.width, fields.height,
+        int(round(fields.horizontal_resolution * 65536)),
+        int(round(fields.vertical_resolution * 65536)), fields.frame_count,
+        fields.compressor_name, fields.depth)
+    return str(packed)
+
+def decode_audio_sample_entry(content):
+    (data_reference_index, ) = SAMPLE_ENTRY_STRUCT.unpack_from(content)
+    (channel_count, sample_size, sample_rate) = \
+        AUDIO_SAMPLE_ENTRY_STRUCT.unpack_from(content, SAMPLE_ENTRY_STRUCT.size)
+    return AudioSampleEntry(data_reference_index, channel_count, sample_size,
+                            sample_rate / 65536.0)
+
+def encode_audio_sample_entry(fields, content):
+    packed = bytearray(content)
+    SAMPLE_ENTRY_STRUCT.pack_into(packed, 0, fields.data_reference_index)
+    AUDIO_SAMPLE_ENTRY_STRUCT.pack_into(packed, SAMPLE_ENTRY_STRUCT.size,
+        fields.channel_count, fields.sample_size,
+        int(round(fields.sample_rate * 65536)))
+    return str(packed)
+
+# Atom type: (decoder, encoder)
+ATOM_CODECS = {
+    'mvhd': (decode_mvhd, encode_mvhd),
+    'mdhd': (decode_mdhd, encode_mdhd),
+    'tkhd': (decode_tkhd, encode_tkhd),
+    'hdlr': (decode_hdlr, encode_hdlr),
+    'elst': (decode_elst, encode_elst),
+}
+# Sample entries, the children of stsd
+for sample_entry_type in ('avc1', 'avc3', 'encv', 'hev1', 'hvc1', 'mp4v',
+                          's263', 'vp08', 'vp09', 'av01'):
+    ATOM_CODECS[sample_entry_type] = \
+        (decode_visual_sample_entry, encode_visual_sample_entry)
+for sample_entry_type in ('mp4a', 'enca', 'ac-3', 'ec-3', 'alac', 'Opus',
+                          'samr', 'drms'):
+    ATOM_CODECS[sample_entry_type] = \
+        (decode_audio_sample_entry, encode_audio_sample_entry)
+del sample_entry_type
+
+
+class MappedStream(object):
+    """Read-only, file-like view of a memory-mapped file.
+    
+       Reads return zero-copy buffer slices of the mapping rather than
+       copied strings, so only the pages actually touched get loaded.
+    """
+    def __init__(self, file):
+        if isinstance(file, basestring):
+            file = open(file, 'rb')
+        self.__file = file
+        
+        # mmap refuses to map empty files
+        if 0 < os.fstat(file.fileno()).st_size:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.map = ''
+        self.__position = 0
+    
+    def __len__(self):
+        return len(self.map)
+    
+    def close(self):
+        if not isinstance(self.map, basestring):
+            self.map.close()
+        self.__file.close()
+    
+    def fileno(self):
+        return self.__file.fileno()
+    
+    def tell(self):
+        return self.__position
+    
+    def seek(self, offset, whence=os.SEEK_SET):
+        if os.SEEK_CUR == whence:
+            offset += self.__position
+        elif os.SEEK_END == whence:
+            offset += len(self.map)
+        self.__position = max(0, offset)
+    
+    def read(self, size=-1):
+        start = min(self.__position, len(self.map))
+        end = len(self.map)
+        if 0 <= size:
+            end = min(end, start + size)
+        self.__position = end
+        return buffer(self.map, start, end - start)
+    
+
+class OverlayStream(object):
+    """File-like content of an edited data atom: the bytes written so far,
+       kept as sorted, non-overlapping patches over the untouched region
+       <size> bytes long at <offset> in <source>.
+       
+       Reads merge the patches and the source on the fly, so editing a few
+       bytes of a large atom costs a few bytes of memory. Bytes past the
+       source and never written read as zeros, as in a file. The source is
+       read again when needed and must not change meanwhile.
+    """
+    def __init__(self, source=None, offset=0, size=0):
+        self.__source = source
+        self.__offset = offset
+        # Source bytes past a truncation stay hidden, even if written over
+        self.__source_end = size
+        self.__length = size
+        self.__position = 0
+        self.__starts = []
+        self.__patches = []
+    
+    def __iter__(self):
+        return self
+    
+    def close(self):
+        self.__starts = []
+        self.__patches = []
+    
+    def copy(self):
+        """Independent overlay on the same source, cheap as it only copies
+           the list of patches
+        """
+        other = OverlayStream(self.__source, self.__offset)
+        other.__source_end = self.__source_end
+        other.__length = self.__length
+        other.__position = self.__position
+        other.__starts = list(self.__starts)
+        other.__patches = list(self.__patches)
+        return other
+    
+    def patched_size(self):
+        """Bytes held in memory by the patches"""
+        return sum([len(patch) for patch in self.__patches])
+    
+    def tell(self):
+        return self.__position
+    
+    def seek(self, offset, whence=os.SEEK_SET):
+        if os.SEEK_CUR == whence:
+            offset += self.__position
+        elif os.SEEK_END == whence:
+            offset += self.__length
+        self.__position = max(0, offset)
+    
+    def read(self, size=-1):
+        start = min(self.__position, self.__length)
+        end = self.__length
+        if 0 <= size:
+            end = min(end, start + size)
+        self.__position = end
+        
+        # Alternate between the patches and the source in the gaps
+        pieces = []
+        i = max(0, bisect_right(self.__starts, start) - 1)
+        position = start
+        while position < end:
+            if i < len(self.__starts) and self.__starts[i] <= position:
+                patch_start = self.__starts[i]
+                patch_end = min(end, patch_start + len(self.__patches[i]))
+                if position < patch_end:
+                    pieces.append(self.__patches[i][position - patch_start:
+                                                    patch_end - patch_start])
+                    position = patch_end
+                i += 1
+                continue
+            
+            gap_end = end
+            if i < len(self.__starts):
+                gap_end = min(end, self.__starts[i])
+            pieces.append(self.__read_source(position, gap_end))
+            position = gap_end
+        
+        if 1 == len(pieces):
+            # Unpatched reads of mapped sources stay zero-copy
+            return pieces[0]
+        return ''.join([str(piece) for piece in pieces])
+    
+    def __read_source(self, start, end):
+        source_end = max(start, min(end, self.__source_end))
+        data = ''
+        if start < source_end:
+            self.__source.seek(self.__offset + start)
+            data = self.__source.read(source_end - start)
+            if _active.stats is not None:
+                _active.stats.io(seeks=1, reads=1, bytes_read=len(data))
+        if source_end < end:
+            data = str(data) + '\0' * (end - source_end)
+        return data
+    
+    def readline(self, size=-1):
+        line = []
+        while 0 != size:
+            chunk = self.read(4096 if size < 0 else min(4096, size))
+            if 0 == len(chunk):
+                break
+            chunk = str(chunk)
+            newline = chunk.find('\n')
+            if 0 <= newline:
+                self.seek(newline + 1 - len(chunk), os.SEEK_CUR)
+                line.append(chunk[:newline + 1])
+                break
+            line.append(chunk)
+            if 0 < size:
+                size -= len(chunk)
+        return ''.join(line)
+    
+    def readlines(self, size=0):
+        lines = []
+        total = 0
+        line = self.readline()
+        while line:
+            lines.append(line)
+            total += len(line)
+            if 0 < size <= total:
+                break
+            line = self.readline()
+        return lines
+    
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+    
+    def truncate(self, size=None):
+        if size is None:
+            size = self.__position
+        if self.__length <= size:
+            return
+        
+        self.__length = size
+        self.__source_end = min(self.__source_end, size)
+        i = bisect_left(self.__starts, size)
+        del self.__starts[i:]
+        del self.__patches[i:]
+        if self.__starts:
+            self.__patches[-1] = self.__patches[-1][:size - self.__starts[-1]]
+    
+    def write(self, data):
+        if isinstance(data, buffer):
+            data = str(data)
+        if 0 == len(data):
+            return
+        start = self.__position
+        end = start + len(data)
+        
+        # Merge with the patches this one overlaps or touches
+        first = bisect_right(self.__starts, start) - 1
+        if first < 0 or self.__starts[first] + len(self.__patches[first]) < start:
+            first += 1
+        last = bisect_right(self.__starts, end)
+        if first < last:
+            first_start = self.__starts[first]
+            last_start = self.__starts[last - 1]
+            data = self.__patches[first][:max(0, start - first_start)] + data \
+                + self.__patches[last - 1][end - last_start:]
+            start = min(start, first_start)
+        self.__starts[first:last] = [start]
+        self.__patches[first:last] = [data]
+        
+        self.__position = end
+        self.__length = max(self.__length, end)
+    
+    def writelines(self, sequence):
+        # Joined first: each write copies the patch it extends
+        self.write(''.join(sequence))
+    
+
 class Atom(list):
-    def __init__(self, stream=None, offset=0, type=None):
+    # Containers built lazily keep their children pending until first use
+    __pending = False
+    # Typed fields, once decoded
+    __fields = None
+    
+    def __init__(self, stream=None, offset=0, type=None, lazy=False,
+                 header=None, children=None):
         if stream is not None:
-            (self.type, self.__size) = parse_atom_header(stream, offset)
-            self.__offset = stream.tell()
+            stats = _active.stats
+            if stats is not None:
+                started = time.time()
+            if header is None:
+                (self.type, self.__size) = parse_atom_header(stream, offset)
+                self.__offset = stream.tell()
+            else:
+                # Header already decoded elsewhere, as returned by
+                # unpack_atom_header; no need to read it again
+                (self.type, self.__size, header_size) = header
+                self.__offset = offset + header_size
+            if stats is not None:
+                stats.parsed(self.type, self.__offset - offset,
+                             time.time() - started)
             self.__source_stream = stream
+            # Special containers shrink to their padding once loaded, so
+            # keep track of where the atom really ends in the source
+            self.__end = self.__offset + self.__size
             
             # Recursively build the tree; don't try to skip containers, 
             # as their leaf data atoms will do all the skipping for us
             if self.is_special_container():
                 padding = ATOM_SPECIAL_CONTAINER_TYPES[self.type]['padding']
-                self.__source_stream.seek(padding, os.SEEK_CUR)
-                self.__load_children()
                 self.__size = padding
+            
+            if self.is_container() and lazy:
+                # Only remember where the children are; they are parsed
+                # the first time the container is used as a sequence,
+                # unless a <children> callable can supply them instead
+                self.__pending = children or True
             elif self.is_container():
                 self.__load_children()
             
-            # Skip over the rest of the atom
-            self.__source_stream.seek(self.__offset + self.__size)
+            # Skip over the rest of the atom, for callers walking the
+            # stream; those who decoded the header know where it ends
+            if header is None:
+                self.__source_stream.seek(self.__end)
+                if _active.stats is not None:
+                    _active.stats.io(seeks=1)
         elif type is not None:
             self.type = type
     
-    def __load_children(self):
+    def __load_children(self, lazy=False):
+        # Children of special containers follow their padding
+        position = self.__offset
+        if self.is_special_container():
+            position += self.__size
+        
+        # Fetch the whole content at once and decode the headers of all the
+        # descendants from memory; mapped sources are in memory already
+        size = self.__end - position
+        if not lazy and isinstance(self.__source_stream, MappedStream):
+            self.__load_children_from(self.__source_stream.map, 0)
+            self.__source_stream.seek(self.__end)
+            return
+        if not lazy and size <= BULK_READ_SIZE:
+            self.__source_stream.seek(position)
+            content = self.__source_stream.read(size)
+            if _active.stats is not None:
+                _active.stats.io(seeks=1, reads=1, bytes_read=len(content))
+            self.__load_children_from(content, position)
+            self.__source_stream.seek(self.__end)
+            return
+        
         # If we don't have enough data left for another atom, abort
-        while calcsize(ATOM_HEADER['basic']) <= (self.__size - self.tell()):
-            child = Atom(stream=self.__source_stream, offset=self.__source_stream.tell())
+        while ATOM_HEADER_STRUCT['basic'].size <= (self.__end - position):
+            child = Atom(stream=self.__source_stream, offset=position, lazy=lazy)
+            self.append(child)
+            position = child.__end
+    
+    def __load_children_from(self, content, base):
+        # <content> holds the source from offset <base>; children still
+        # read their own content from the source when asked to
+        position = self.__offset
+        if self.is_special_container():
+            position += self.__size
+        end = min(self.__end, base + len(content))
+        
+        while ATOM_HEADER_STRUCT['basic'].size <= (end - position):
+            header = unpack_atom_header(content, position - base, end - base)
+            child = Atom(stream=self.__source_stream, offset=position,
+                         lazy=True, header=header)
+            if child.is_container():
+                child.__pending = False
+                child.__load_children_from(content, base)
             self.append(child)
+            position = child.__end
+    
+    def __load_pending_children(self):
+        if self.__pending:
+            pending = self.__pending
+            self.__pending = False
+            if callable(pending):
+                for child in pending():
+                    self.append(child)
+                return
+            
+            # Loading must not disturb anyone reading from the source
+            prior_pos = self.__source_stream.tell()
+            self.__load_children(lazy=True)
+            self.__source_stream.seek(prior_pos)
     
     def __del__(self):
         if hasattr(self, '_Atom__data'):
@@ -166,6 +844,7 @@ class Atom(list):
         if not self.is_container():
             return self.type
         
+        self.__load_pending_children()
         repr = '%s: %s' % (self.type, super(Atom, self).__repr__())
         return repr
     
@@ -178,6 +857,8 @@ class Atom(list):
         if other.type != self.type:
             equal = False
         if (other.type == self.type) and self.is_container():
+            self.__load_pending_children()
+            other.__load_pending_children()
             equal = super(Atom, self).__eq__(other)
         elif (other.type == self.type) \
          and hasattr(self, '_Atom__data') \
@@ -195,6 +876,26 @@ class Atom(list):
         return self.__size
     def makestrstorage(self):
         self.__data = StringIO.StringIO()
+    def clone(self):
+        """Copy of this atom and its descendants, for editing apart from
+           it; the content is not copied but read from the same source,
+           and only the edits made so far are duplicated
+        """
+        other = Atom(type=self.type)
+        if hasattr(self, '_Atom__source_stream'):
+            other.__source_stream = self.__source_stream
+            other.__offset = self.__offset
+            other.__size = self.__size
+            other.__end = self.__end
+        if hasattr(self, '_Atom__data'):
+            if isinstance(self.__data, OverlayStream):
+                other.__data = self.__data.copy()
+            else:
+                other.__data = StringIO.StringIO(self.__data.getvalue())
+        if self.is_container():
+            for child in self:
+                other.append(child.clone())
+        return other
     
     # Container/Sequence behaviours
     
@@ -207,6 +908,7 @@ class Atom(list):
         elif not isinstance(x, Atom):
             raise TypeError, 'an Atom is required'
         
+        self.__load_pending_children()
         super(Atom, self).append(x)
     
     def insert(self, i, x):
@@ -215,6 +917,7 @@ class Atom(list):
         elif not isinstance(x, Atom):
             raise TypeError, 'an Atom is required'
         
+        self.__load_pending_children()
         super(Atom, self).insert(i, x)
     
     def __setitem__(self, key, value):
@@ -224,6 +927,7 @@ class Atom(list):
         if not isinstance(value, Atom):
             raise TypeError, 'an Atom is required'
         
+        self.__load_pending_children()
         super(Atom, self).__setitem__(key, value)
     
     def __setslice__(self, i, j, sequence):
@@ -233,16 +937,78 @@ class Atom(list):
         if 0 < len([item for item in sequence if not isinstance(item, Atom)]):
                 raise TypeError, 'all items in slice are required to be Atoms'
         
+        self.__load_pending_children()
         super(Atom, self).__setslice__(i, j, sequence)
     
+    # Remaining sequence behaviours only need lazy children loading first
+    
+    def __len__(self):
+        self.__load_pending_children()
+        return super(Atom, self).__len__()
+    
+    def __getitem__(self, key):
+        self.__load_pending_children()
+        return super(Atom, self).__getitem__(key)
+    
+    def __getslice__(self, i, j):
+        self.__load_pending_children()
+        return super(Atom, self).__getslice__(i, j)
+    
+    def __delitem__(self, key):
+        self.__load_pending_children()
+        super(Atom, self).__delitem__(key)
+    
+    def __delslice__(self, i, j):
+        self.__load_pending_children()
+        super(Atom, self).__delslice__(i, j)
+    
+    def __contains__(self, x):
+        self.__load_pending_children()
+        return super(Atom, self).__contains__(x)
+    
+    def count(self, x):
+        self.__load_pending_children()
+        return super(Atom, self).count(x)
+    
+    def index(self, x, *args):
+        self.__load_pending_children()
+        return super(Atom, self).index(x, *args)
+    
+    def extend(self, sequence):
+        for x in sequence:
+            self.append(x)
+    
+    def pop(self, *args):
+        self.__load_pending_children()
+        return super(Atom, self).pop(*args)
+    
+    def remove(self, x):
+        self.__load_pending_children()
+        super(Atom, self).remove(x)
+    
+    def reverse(self):
+        self.__load_pending_children()
+        super(Atom, self).reverse()
+    
+    def sort(self, *args, **kwargs):
+        self.__load_pending_children()
+        super(Atom, self).sort(*args, **kwargs)
+    
     
     def get_all_descendants(self):
-        # TODO: Is there a faster way to do this?
+        """All the atoms below this one, in document order"""
         descendants = []
         if self.is_container():
-            for child in self:
+            # Depth-first without recursion, nor a list built per level
+            stack = list(self)
+            stack.reverse()
+            while stack:
+                child = stack.pop()
                 descendants.append(child)
-                descendants += child.get_all_descendants()
+                if child.is_container():
+                    grandchildren = list(child)
+                    grandchildren.reverse()
+                    stack.extend(grandchildren)
         
         return descendants
     
@@ -254,14 +1020,12 @@ class Atom(list):
         return children
     
     def get_descendants_of_type(self, type):
-        descendants = []
-        if self.is_container():
-            for child in self:
-                if child.type == type:
-                    descendants.append(child)
-                descendants += child.get_descendants_of_type(type)
-        
-        return descendants
+        return [descendant for descendant in self.get_all_descendants()
+                if descendant.type == type]
+    
+    def find(self, path):
+        """Atoms below this one matching <path>, see atompath"""
+        return compile_path(path).find_in(self)
     
     
     # File-like behaviours
@@ -287,7 +1051,17 @@ class Atom(list):
             elif self.tell() == self.__size:
                 self.seek(0, os.SEEK_END)
             
-            return self.__source_stream.read(self.__size - self.tell())
+            remaining = max(0, self.__size - self.tell())
+            if 0 <= size < remaining:
+                remaining = size
+            if _active.stats is None:
+                return self.__source_stream.read(remaining)
+            
+            started = time.time()
+            data = self.__source_stream.read(remaining)
+            _active.stats.io(reads=1, bytes_read=len(data))
+            _active.stats.read(self.type, len(data), time.time() - started)
+            return data
         return ''
     
     def readline(self, size=-1):
@@ -301,6 +1075,10 @@ class Atom(list):
         return []
     
     def seek(self, offset, whence=os.SEEK_SET):
+        if _active.stats is not None and hasattr(self, '_Atom__source_stream') \
+        and not hasattr(self, '_Atom__data'):
+            _active.stats.io(seeks=1)
+        
         if hasattr(self, '_Atom__data'):
             self.__data.seek(offset, whence)
         elif hasattr(self, '_Atom__source_stream') \
@@ -316,41 +1094,46 @@ class Atom(list):
             self.__source_stream.seek(source_offset)
     
     def truncate(self, size=None):
+        self.__fields = None
         if size is None:
             size = self.tell()
+        if not hasattr(self, '_Atom__data') \
+        and hasattr(self, '_Atom__source_stream'):
+            self.__data = self.__overlay()
         if hasattr(self, '_Atom__data'):
             self.__data.truncate(size)
     
     def write(self, str):
         if self.is_normal_container():
             raise ValueError, 'Cannot write data to normal container atoms'
+        self.__fields = None
         
         if not hasattr(self, '_Atom__data'):
-            # Store starting location in case we already have content
-            initial_location = self.tell()
-            
-            # Store in a file in case of large data
-            self.__data = tempfile.TemporaryFile()
-            
-            # Copy old data to tempfile
-            if hasattr(self, '_Atom__source_stream'):
-                self.__source_stream.seek(get_header_size(self.__size))
-                self.__data.write(self.__source_stream.read(self.__size))
-                self.__data.seek(0)
-                self.seek(initial_location)
+            self.__data = self.__overlay()
         
         self.__data.write(str)
     
     def writelines(self, sequence):
         if self.is_container():
             raise ValueError, 'Cannot write data to container atoms'
+        self.__fields = None
         
         if not hasattr(self, '_Atom__data'):
-            # Store in a file in case of large data
-            self.__data = tempfile.TemporaryFile()
+            self.__data = self.__overlay()
         
         self.__data.writelines(sequence)
     
+    def __overlay(self):
+        # Edits go on top of the content in the source, if any, which is
+        # left where it is rather than copied
+        if not hasattr(self, '_Atom__source_stream'):
+            return OverlayStream()
+        
+        overlay = OverlayStream(self.__source_stream, self.__offset,
+                                self.__size)
+        overlay.seek(self.tell())
+        return overlay
+    
     # Sequence and file-like behaviours
     
     def __iter__(self):
@@ -366,32 +1149,98 @@ class Atom(list):
             self.__source_stream.seek(prior_pos)
             return iter(iterable_stream)
         
+        self.__load_pending_children()
         return super(Atom, self).__iter__()
     
+    # Typed content
+    
+    def decode(self):
+        """Fields of an atom of a type known to ATOM_CODECS, as a named
+           tuple; the content is only read and decoded the first time
+        """
+        if self.type not in ATOM_CODECS:
+            raise ValueError, 'Cannot decode %r atoms' % self.type
+        if self.__fields is None:
+            initial_position = self.tell()
+            self.seek(0)
+            self.__fields = ATOM_CODECS[self.type][0](self.read())
+            self.seek(initial_position)
+        return self.__fields
+    
+    def encode(self, fields):
+        """Replace the content of an atom of a type known to ATOM_CODECS
+           with the encoding of <fields>, as returned by decode()
+        """
+        if self.type not in ATOM_CODECS:
+            raise ValueError, 'Cannot encode %r atoms' % self.type
+        self.seek(0)
+        content = ATOM_CODECS[self.type][1](fields, self.read())
+        self.seek(0)
+        self.write(content)
+        self.truncate()
+    
     # Storage
     
     def save(self, stream):
-        # HACK: Dumping into content allows us to use len() to get content
-        #       size easily, but will fall over for large content
-        content = ''
-        
+        # Work out every content size bottom-up first, so headers can be
+        # written ahead of their content without buffering any of it
+        sizes = {}
+        self.__measure(sizes)
+        self.__save(stream, sizes)
+    
+    def __measure(self, sizes):
+        content_size = self.__data_size()
         if self.is_container():
-            content_stream = StringIO.StringIO()
-            [atom.save(content_stream) for atom in self]
-            content = content_stream.getvalue()
-        elif hasattr(self, '_Atom__data') \
-        or hasattr(self, '_Atom__source_stream'):
+            for child in self:
+                child_size = child.__measure(sizes)
+                content_size += get_header_size(child_size) + child_size
+        
+        sizes[id(self)] = content_size
+        return content_size
+    
+    def __data_size(self):
+        # Normal containers have no content other than their children;
+        # special containers keep their own (padding) data ahead of them
+        if self.is_normal_container():
+            return 0
+        elif hasattr(self, '_Atom__data'):
+            initial_position = self.__data.tell()
+            self.__data.seek(0, os.SEEK_END)
+            data_size = self.__data.tell()
+            self.__data.seek(initial_position)
+            return data_size
+        elif hasattr(self, '_Atom__source_stream'):
+            return self.__size
+        return 0
+    
+    def __save(self, stream, sizes):
+        stats = _active.stats
+        if stats is not None:
+            started = time.time()
+        
+        header = render_atom_header(self.type, sizes[id(self)])
+        stream.write(header)
+        written = len(header)
+        
+        if not self.is_normal_container():
             # Store the initial position so we can seek back to there for
             # other users of our data
             initial_position = self.tell()
             
             self.seek(0)
-            content = self.read()
+            chunk = self.read(SAVE_CHUNK_SIZE)
+            while 0 < len(chunk):
+                stream.write(chunk)
+                written += len(chunk)
+                chunk = self.read(SAVE_CHUNK_SIZE)
             
             self.seek(initial_position)
         
-        stream.write(render_atom_header(self.type, len(content)))
-        if 0 < len(content):
-            stream.write(content)
+        # Children account for themselves
+        if stats is not None:
+            stats.saved(self.type, written, time.time() - started)
+        
+        if self.is_container():
+            for child in self:
+                child.__save(stream, sizes)
     
-
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Compact, array-backed index of an MP4 atom tree.
+
+An AtomIndex walks the tree once and keeps one entry per atom in a few
+parallel arrays, in document (depth-first) order, rather than building an
+Atom object per box. Atom views are only created when asked for.
+"""
+
+from array import array
+import os
+from struct import pack, unpack
+
+from atom import ATOM_CONTAINER_TYPES, ATOM_HEADER_STRUCT, \
+    ATOM_SPECIAL_CONTAINER_TYPES, Atom, MappedStream, unpack_atom_header
+
+CONTAINER_TYPES = frozenset(ATOM_CONTAINER_TYPES) \
+    | frozenset(ATOM_SPECIAL_CONTAINER_TYPES)
+
+def pack_type(atom_type):
+    """Pack a four character atom type into an unsigned integer"""
+    return unpack('>L', atom_type)[0]
+
+def unpack_type(packed_type):
+    """Unpack an atom type packed by pack_type()"""
+    return pack('>L', packed_type)
+
+
+class AtomIndex(object):
+    def __init__(self, stream, offset=0, end=None):
+        if isinstance(stream, basestring):
+            stream = open(stream, 'rb')
+        self.stream = stream
+
+        # One entry per atom: packed type, content offset and size (as
+        # returned by Atom.offset() and Atom.size()), header size, index of
+        # the parent atom (-1 for top-level atoms) and depth in the tree
+        self.types = array('I')
+        self.offsets = array('L')
+        self.sizes = array('L')
+        self.header_sizes = array('B')
+        self.parents = array('i')
+        self.depths = array('B')
+
+        if end is None:
+            stream.seek(0, os.SEEK_END)
+            end = stream.tell()
+        self.__end = end
+        self.__scan(offset, end, -1, 0)
+
+    def __read_header(self, position):
+        if isinstance(self.stream, MappedStream):
+            return unpack_atom_header(self.stream.map, position)
+
+        self.stream.seek(position)
+        header = self.stream.read(ATOM_HEADER_STRUCT['large'].size)
+        return unpack_atom_header(header, 0, self.__end - position)
+
+    def __scan(self, position, end, parent, depth):
+        basic_header_size = ATOM_HEADER_STRUCT['basic'].size
+
+        # If we don't have enough data left for another atom, abort
+        while basic_header_size <= end - position:
+            (atom_type, size, header_size) = self.__read_header(position)
+            content_offset = position + header_size
+
+            index = len(self.types)
+            self.types.append(pack_type(atom_type))
+            self.offsets.append(content_offset)
+            self.sizes.append(size)
+            self.header_sizes.append(header_size)
+            self.parents.append(parent)
+            self.depths.append(depth)
+
+            if atom_type in CONTAINER_TYPES:
+                children_offset = content_offset
+                if atom_type in ATOM_SPECIAL_CONTAINER_TYPES:
+                    children_offset += \
+                        ATOM_SPECIAL_CONTAINER_TYPES[atom_type]['padding']
+                self.__scan(children_offset, content_offset + size,
+                            index, depth + 1)
+
+            position = content_offset + size
+
+    def __len__(self):
+        return len(self.types)
+
+    def type(self, index):
+        return unpack_type(self.types[index])
+
+    def roots(self):
+        """Indices of the top-level atoms"""
+        return [i for (i, depth) in enumerate(self.depths) if 0 == depth]
+
+    def children(self, index):
+        """Indices of the direct children of the atom at <index>"""
+        # Descendants directly follow their ancestor in document order
+        depth = self.depths[index]
+        children = []
+        for i in xrange(index + 1, len(self.depths)):
+            if self.depths[i] <= depth:
+                break
+            elif self.depths[i] == depth + 1:
+                children.append(i)
+
+        return children
+
+    def find(self, atom_type):
+        """Indices of all the atoms of a given type, in document order"""
+        packed_type = pack_type(atom_type)
+        return [i for (i, t) in enumerate(self.types) if t == packed_type]
+
+    def atom(self, index, stream=None):
+        """Build a lazily loaded Atom view of the atom at <index>, reading
+           from <stream> (by default the indexed one). Children of the view
+           are built from the index too, so no header is ever parsed again.
+        """
+        if stream is None:
+            stream = self.stream
+
+        header_size = self.header_sizes[index]
+        header = (self.type(index), self.sizes[index], header_size)
+        children = lambda: [self.atom(i, stream) for i in self.children(index)]
+        return Atom(stream=stream,
+                    offset=self.offsets[index] - header_size,
+                    lazy=True, header=header, children=children)
+
+    # Pickling: the arrays are the whole index, the stream cannot be kept
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['stream'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Unit tests for atomindex.py
+
+"""
+
+import atom
+import atomindex
+import StringIO
+import tempfile
+import unittest
+
+class IndexComplexTree(unittest.TestCase):
+    root_type = 'moov'
+    
+    def setUp(self):
+        child_1_1 = atom.render_atom_header('free', 3) + '1.1'
+        child_1_2 = atom.render_atom_header('free', 3) + '1.2'
+        child_1 = atom.render_atom_header('trak', \
+            len(child_1_1 + child_1_2)) + child_1_1 + child_1_2
+        
+        entry = atom.render_atom_header('mp4a', 28) + 'x' * 28
+        child_2 = atom.render_atom_header('stsd', len(entry) + 8) \
+            + 'x' * 8 + entry
+        
+        rendered_root = atom.render_atom_header(self.root_type, \
+            len(child_1 + child_2)) + child_1 + child_2
+        self.rendered = rendered_root + atom.render_atom_header('mdat', 4) \
+            + 'data'
+        
+        self.stream = StringIO.StringIO(self.rendered)
+        self.index = atomindex.AtomIndex(self.stream)
+    
+    def tearDown(self):
+        del self.index
+        del self.stream
+    
+    def testIndexesEveryAtom(self):
+        self.assertEqual(
+            ['moov', 'trak', 'free', 'free', 'stsd', 'mp4a', 'mdat'],
+            [self.index.type(i) for i in range(len(self.index))])
+    
+    def testParentsAndDepths(self):
+        self.assertEqual([-1, 0, 1, 1, 0, 4, -1], list(self.index.parents))
+        self.assertEqual([0, 1, 2, 2, 1, 2, 0], list(self.index.depths))
+    
+    def testRootsAndChildren(self):
+        self.assertEqual([0, 6], self.index.roots())
+        self.assertEqual([1, 4], self.index.children(0))
+        self.assertEqual([5], self.index.children(4))
+        self.assertEqual([], self.index.children(2))
+    
+    def testFind(self):
+        self.assertEqual([2, 3], self.index.find('free'))
+        self.assertEqual([], self.index.find('stts'))
+    
+    def testOffsetsAndSizesMatchAtoms(self):
+        loaded = atom.Atom(self.stream)
+        self.assertEqual(loaded.offset(), self.index.offsets[0])
+        self.assertEqual(loaded.size(), self.index.sizes[0])
+        self.assertEqual(loaded[0][1].offset(), self.index.offsets[3])
+        self.assertEqual(loaded[0][1].size(), self.index.sizes[3])
+    
+    def testAtomViewMatchesLoadedAtom(self):
+        self.assertEqual(atom.Atom(self.stream), self.index.atom(0))
+        
+        view = self.index.atom(3)
+        view.seek(0)
+        self.assertEqual('1.2', view.read())
+    
+    def testSavedViewHasCorrectContent(self):
+        save_stream = StringIO.StringIO()
+        self.index.atom(0).save(save_stream)
+        self.index.atom(6).save(save_stream)
+        self.assertEqual(self.rendered, save_stream.getvalue())
+    
+    def testMappedIndexMatches(self):
+        atom_file = tempfile.TemporaryFile()
+        atom_file.write(self.rendered)
+        atom_file.flush()
+        mapped_index = atomindex.AtomIndex(atom.MappedStream(atom_file))
+        
+        self.assertEqual(self.index.types, mapped_index.types)
+        self.assertEqual(self.index.offsets, mapped_index.offsets)
+        self.assertEqual(self.index.sizes, mapped_index.sizes)
+        self.assertEqual(self.index.parents, mapped_index.parents)
+    
+
+
+if __name__ == "__main__":
+    unittest.main()
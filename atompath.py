@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Path queries over an MP4 atom tree.
+
+A path lists the types of the atoms leading to the ones wanted, separated
+by slashes, eg. 'moov/trak/mdia/minf/stbl/stts'. In each step:
+
+    *           any one atom (also within a type, eg. 'st*')
+    **          any number of atoms, including none
+    [p]         only atoms having a descendant at the relative path p
+    [p.f=v]     only atoms whose first descendant at p has a decoded field
+                f (see Atom.decode()) equal to v, eg. 'trak[tkhd.track_id=1]'
+
+and the predicates listed in PATH_PREDICATE_ALIASES can be used by name,
+eg. 'moov/trak[handler=vide]/**/stts'.
+
+Paths are compiled once and cached. Queries go down the tree from the
+starting atoms and only visit the children of matching atoms; given a
+TypeIndex, queries ending in a plain type start from the atoms of that
+type instead and check their ancestors, which costs O(matches).
+"""
+
+from fnmatch import fnmatchcase
+
+# Predicate name: path and field it stands for
+PATH_PREDICATE_ALIASES = {
+    'handler': '**/hdlr.handler_type',
+    'track_id': 'tkhd.track_id',
+}
+
+def children(atom):
+    if not atom.is_container():
+        return []
+    return list(atom)
+
+
+class TypeIndex(object):
+    """Atoms of a tree by type, in document order, and the parent of each
+       atom. Reflects the tree as it was when built.
+    """
+    def __init__(self, roots):
+        self.types = {}
+        self.parents = {}
+
+        # Depth-first, in document order, without recursion
+        stack = [(root, None) for root in reversed(list(roots))]
+        while stack:
+            (atom, parent) = stack.pop()
+            self.types.setdefault(atom.type, []).append(atom)
+            self.parents[id(atom)] = parent
+            stack.extend([(child, atom)
+                          for child in reversed(children(atom))])
+
+    def atoms(self, atom_type):
+        return self.types.get(atom_type, [])
+
+    def ancestors(self, atom):
+        """Atoms from the root down to <atom>, included"""
+        chain = []
+        while atom is not None:
+            chain.append(atom)
+            atom = self.parents[id(atom)]
+        chain.reverse()
+        return chain
+
+
+class PathStep(object):
+    def __init__(self, step):
+        self.predicates = []
+        if '[' in step:
+            (step, predicates) = step.split('[', 1)
+            for predicate in predicates[:-1].split(']['):
+                self.predicates.append(PathPredicate(predicate))
+
+        self.type = step
+        self.is_descendants = '**' == step
+        self.is_pattern = '*' in step or '?' in step
+
+    def matches(self, atom):
+        if self.is_pattern:
+            if not fnmatchcase(atom.type, self.type):
+                return False
+        elif atom.type != self.type:
+            return False
+
+        for predicate in self.predicates:
+            if not predicate.matches(atom):
+                return False
+        return True
+
+
+class PathPredicate(object):
+    def __init__(self, predicate):
+        self.value = None
+        if '=' in predicate:
+            (predicate, self.value) = predicate.split('=', 1)
+        predicate = PATH_PREDICATE_ALIASES.get(predicate, predicate)
+
+        # The field follows the last dot of the last step
+        self.field = None
+        (path, slash, last_step) = predicate.rpartition('/')
+        if '.' in last_step:
+            (last_step, self.field) = last_step.split('.', 1)
+        self.path = compile_path(path + slash + last_step)
+
+    def matches(self, atom):
+        found = self.path.find_in(atom, first=True)
+        if 0 == len(found):
+            return False
+        elif self.field is None:
+            return self.value is None
+        return str(getattr(found[0].decode(), self.field)) == self.value
+
+
+class AtomPath(object):
+    def __init__(self, path):
+        self.path = path
+        self.steps = [PathStep(step) for step in split_path(path)]
+
+    def __repr__(self):
+        return 'AtomPath(%r)' % self.path
+
+    def find(self, roots, index=None):
+        """Atoms matching the path, starting at <roots>, in document order.
+           With a TypeIndex of the tree, paths ending in a plain type are
+           looked up from the atoms of that type.
+        """
+        last_step = self.steps[-1]
+        if index is not None and not last_step.is_pattern:
+            return [atom for atom in index.atoms(last_step.type)
+                    if self.__matches(index.ancestors(atom), 0, 0)]
+        return self.__unique(self.__find(list(roots), 0, False))
+
+    def find_in(self, atom, first=False):
+        """Atoms matching the path below <atom>"""
+        return self.__unique(self.__find(children(atom), 0, first))
+
+    def __find(self, atoms, i, first):
+        found = []
+        if len(self.steps) == i:
+            # Only reached after a trailing '**'
+            return atoms
+
+        step = self.steps[i]
+        for atom in atoms:
+            if step.is_descendants:
+                # Either no atom for '**', or this one and maybe more
+                found += self.__find([atom], i + 1, first)
+                found += self.__find(children(atom), i, first)
+            elif step.matches(atom):
+                if len(self.steps) - 1 == i:
+                    found.append(atom)
+                else:
+                    found += self.__find(children(atom), i + 1, first)
+            if first and found:
+                break
+        return found
+
+    def __matches(self, chain, i, j):
+        # Whether steps i... match the atoms chain[j:] exactly
+        if len(self.steps) == i:
+            return len(chain) == j
+
+        step = self.steps[i]
+        if step.is_descendants:
+            return self.__matches(chain, i + 1, j) \
+                or (j < len(chain) and self.__matches(chain, i, j + 1))
+        return j < len(chain) and step.matches(chain[j]) \
+            and self.__matches(chain, i + 1, j + 1)
+
+    def __unique(self, atoms):
+        # Successive '**' steps can reach the same atom more than once
+        seen = set()
+        unique = []
+        for atom in atoms:
+            if id(atom) not in seen:
+                seen.add(id(atom))
+                unique.append(atom)
+        return unique
+
+
+def split_path(path):
+    """Split a path at the slashes outside predicates"""
+    steps = []
+    depth = 0
+    start = 0
+    for (i, c) in enumerate(path):
+        if '[' == c:
+            depth += 1
+        elif ']' == c:
+            depth -= 1
+        elif '/' == c and 0 == depth:
+            steps.append(path[start:i])
+            start = i + 1
+    steps.append(path[start:])
+    if depth != 0 or '' in steps:
+        raise ValueError, 'Invalid atom path %r' % path
+    return steps
+
+_compiled_paths = {}
+
+def compile_path(path):
+    """AtomPath of <path>, compiled once"""
+    if path not in _compiled_paths:
+        _compiled_paths[path] = AtomPath(path)
+    return _compiled_paths[path]
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Unit tests for atompath.py
+
+"""
+
+import atompath
+import mp4file
+import os
+import sampletable
+import tempfile
+import unittest
+from sampletabletest import render_atom, render_table, render_trak
+
+class QueryAtomPaths(unittest.TestCase):
+    def setUp(self):
+        tables = [render_table('stts', '>LL', [(1, 20)]),
+                  render_table('stco', '>L', [(0,)])]
+        moov = render_atom('moov',
+            render_trak(tables, track_id=1, handler_type='vide')
+            + render_trak(tables, track_id=2, handler_type='soun')
+            + render_trak(tables, track_id=3, handler_type='soun'))
+        (fd, self.path) = tempfile.mkstemp(suffix='.mp4')
+        os.write(fd, render_atom('ftyp', 'isom') + moov
+            + render_atom('mdat', ''))
+        os.close(fd)
+        self.mp4 = mp4file.Mp4File(self.path)
+        self.moov = self.mp4[1]
+    
+    def tearDown(self):
+        self.mp4.close()
+        os.remove(self.path)
+    
+    def track_ids(self, traks):
+        return [trak.get_children_of_type('tkhd')[0].decode().track_id
+                for trak in traks]
+    
+    def testPlainPath(self):
+        found = self.mp4.find('moov/trak/mdia/minf/stbl/stts')
+        self.assertEqual(self.moov.get_descendants_of_type('stts'), found)
+    
+    def testRelativePath(self):
+        self.assertEqual(self.mp4.find('moov/trak/mdia'),
+                         self.moov.find('trak/mdia'))
+    
+    def testWildcards(self):
+        self.assertEqual(3, len(self.mp4.find('moov/*/tkhd')))
+        self.assertEqual(3, len(self.mp4.find('**/st?o')))
+        self.assertEqual(self.moov.get_descendants_of_type('stco'),
+                         self.mp4.find('**/stco'))
+        self.assertEqual(self.moov.get_all_descendants(),
+                         self.mp4.find('moov/**'))
+    
+    def testRepeatedDescendantStepsDoNotDuplicate(self):
+        self.assertEqual(3, len(self.mp4.find('**/**/stts')))
+    
+    def testPredicates(self):
+        self.assertEqual([2, 3], self.track_ids(self.mp4.find('moov/trak[handler=soun]')))
+        self.assertEqual([1], self.track_ids(
+            self.moov.find('trak[mdia/hdlr.handler_type=vide]')))
+        self.assertEqual([2], self.track_ids(
+            self.mp4.find('moov/trak[handler=soun][track_id=2]')))
+        self.assertEqual(3, len(self.mp4.find('moov/trak[mdia/minf]')))
+        self.assertEqual([], self.mp4.find('moov/trak[edts]'))
+    
+    def testIndexedAndLazyQueriesAgree(self):
+        lazy_mp4 = mp4file.Mp4File(self.path, lazy=True)
+        for path in ('moov/trak/mdia/minf/stbl/stts', 'moov/trak[handler=soun]',
+                     '**/stbl/*', 'moov/**/hdlr'):
+            self.assertEqual([a.offset() for a in self.mp4.find(path)],
+                             [a.offset() for a in lazy_mp4.find(path)])
+        lazy_mp4.close()
+    
+    def testTopLevelEditsDropTheIndex(self):
+        self.mp4.find('moov/trak')
+        self.mp4.append(self.moov)
+        self.assertEqual(6, len(self.mp4.find('moov/trak')))
+        del self.mp4[-1]
+        self.assertEqual(3, len(self.mp4.find('moov/trak')))
+    
+    def testUnindexedQueriesSeeTypeChanges(self):
+        self.mp4.find('moov/**/stco')
+        sampletable.shift_chunk_offsets(self.moov, 2**32)
+        self.assertEqual(3, len(self.mp4.find('moov/**/co64', indexed=False)))
+        self.assertEqual([], self.mp4.find('moov/**/stco', indexed=False))
+        self.mp4.reindex()
+        self.assertEqual(3, len(self.mp4.find('moov/**/co64')))
+    
+    def testIndexLooksUpLastStepType(self):
+        index = atompath.TypeIndex(self.mp4)
+        self.assertEqual(3, len(index.atoms('stts')))
+        self.assertEqual(['moov', 'trak', 'mdia', 'minf', 'stbl', 'stts'],
+                         [a.type for a in index.ancestors(index.atoms('stts')[0])])
+    
+    def testPathsAreCompiledOnce(self):
+        self.assertTrue(atompath.compile_path('moov/trak')
+                        is atompath.compile_path('moov/trak'))
+    
+    def testInvalidPaths(self):
+        self.assertRaises(ValueError, atompath.compile_path, 'moov//trak')
+        self.assertRaises(ValueError, atompath.compile_path, 'moov/trak[handler=vide')
+    
+
+if __name__ == '__main__':
+    unittest.main()
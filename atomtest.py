@@ -13,6 +13,8 @@ import os
 import signal
 import StringIO
 import struct
+import tempfile
+import threading
 import unittest
 
 # TODO: Data atom equality based on content? Currently based on tempfile ref.
@@ -404,6 +406,53 @@ class LoadComplexContainerAtom(unittest.TestCase):
         
     
 
+class LoadLazyComplexContainerAtom(LoadComplexContainerAtom):
+    """Lazily loaded containers behave exactly like eagerly loaded ones"""
+    
+    def setUp(self):
+        LoadComplexContainerAtom.setUp(self)
+        self.eager_atom = atom.Atom(self.atom_stream)
+    
+    def tearDown(self):
+        LoadComplexContainerAtom.tearDown(self)
+        del self.eager_atom
+    
+    def load(self):
+        return atom.Atom(self.atom_stream, lazy=True)
+    
+    def testLoadedAtomIsCorrectlyStructured(self):
+        loaded_atom = self.load()
+        self.assertEqual(2, len(loaded_atom))
+        self.assertEqual(2, len(loaded_atom[0]))
+        self.assertEqual(0, len(loaded_atom[1]))
+    
+    def testLazyAtomEqualsEagerAtom(self):
+        self.assertEqual(self.eager_atom, self.load())
+    
+    def testLoadingLeavesStreamPosition(self):
+        loaded_atom = self.load()
+        self.atom_stream.seek(3)
+        len(loaded_atom)
+        self.assertEqual(3, self.atom_stream.tell())
+    
+    def testReadDataAtom(self):
+        loaded_atom = self.load()
+        loaded_atom[0][0].seek(0)
+        self.assertEqual(self.child_1_1_data, loaded_atom[0][0].read())
+    
+    def testGetChildrenOfType(self):
+        loaded_atom = self.load()
+        children_of_type = loaded_atom.get_children_of_type(self.child_1_type)
+        
+        self.assertEqual(1, len(children_of_type))
+        self.assertEqual(self.eager_atom[0], children_of_type[0])
+    
+    def testSavedAtomHasCorrectContent(self):
+        save_stream = StringIO.StringIO()
+        self.load().save(save_stream)
+        self.assertEqual(self.rendered_atom, save_stream.getvalue())
+    
+
 class LoadedContainerAtomChildManipulation(unittest.TestCase):
     type = 'moov'
     initial_child_type = 'free'
@@ -538,6 +587,25 @@ class LoadSpecialContainerAtom(unittest.TestCase):
         self.assertEqual(1, len(self.atom))
         self.assertEqual(self.child_type, self.atom[0].type)
         self.assertEqual(0, len(self.atom[0]))
+    
+    def testSavedAtomHasCorrectContent(self):
+        save_stream = StringIO.StringIO()
+        self.atom.save(save_stream)
+        self.assertEqual(self.rendered_atom, save_stream.getvalue())
+    
+    def testSiblingFollowsChildren(self):
+        sibling = atom.render_atom_header('free', 0)
+        rendered_atom = atom.render_atom_header('stbl', \
+            len(self.rendered_atom + sibling))
+        rendered_atom += self.rendered_atom + sibling
+        
+        init_stream = StringIO.StringIO()
+        init_stream.write(rendered_atom)
+        loaded_atom = atom.Atom(init_stream)
+        
+        self.assertEqual(2, len(loaded_atom))
+        self.assertEqual(self.atom_type, loaded_atom[0].type)
+        self.assertEqual('free', loaded_atom[1].type)
 
 class SimpleDataAtom(unittest.TestCase):
     type = 'free'
@@ -777,6 +845,212 @@ class StoreDataAtom(unittest.TestCase):
         self.assertEqual(rendered_atom, save_stream.read())
     
 
+class ReadRecordingStream(StringIO.StringIO):
+    def __init__(self, *args):
+        StringIO.StringIO.__init__(self, *args)
+        self.read_sizes = []
+    
+    def read(self, n=-1):
+        self.read_sizes.append(n)
+        return StringIO.StringIO.read(self, n)
+    
+
+class StreamLoadedDataAtom(unittest.TestCase):
+    type = 'moov'
+    child_type = 'mdat'
+    child_content = ''.join([chr(i) for i in range(256)]) * 4
+    chunk_size = 100
+    
+    def setUp(self):
+        child_atom = atom.render_atom_header(self.child_type, \
+            len(self.child_content))
+        child_atom += self.child_content
+        
+        self.rendered_atom = atom.render_atom_header(self.type, len(child_atom))
+        self.rendered_atom += child_atom
+        
+        self.atom_stream = ReadRecordingStream(self.rendered_atom)
+        self.atom = atom.Atom(self.atom_stream)
+        
+        self.initial_chunk_size = atom.SAVE_CHUNK_SIZE
+        atom.SAVE_CHUNK_SIZE = self.chunk_size
+    
+    def tearDown(self):
+        atom.SAVE_CHUNK_SIZE = self.initial_chunk_size
+        del self.atom
+        del self.atom_stream
+    
+    def testSavedAtomHasCorrectContent(self):
+        save_stream = StringIO.StringIO()
+        self.atom.save(save_stream)
+        self.assertEqual(self.rendered_atom, save_stream.getvalue())
+    
+    def testSaveReadsInChunks(self):
+        self.atom_stream.read_sizes = []
+        self.atom.save(StringIO.StringIO())
+        
+        self.assertTrue(0 < len(self.atom_stream.read_sizes))
+        self.assertTrue(max(self.atom_stream.read_sizes) <= self.chunk_size)
+        self.assertTrue(min(self.atom_stream.read_sizes) >= 0)
+    
+    def testSaveKeepsPosition(self):
+        self.atom[0].seek(5)
+        self.atom.save(StringIO.StringIO())
+        self.assertEqual(5, self.atom[0].tell())
+    
+
+class BulkLoadContainerAtom(unittest.TestCase):
+    type = 'moov'
+    child_1_type = 'trak'
+    child_1_1_type = 'stsd'
+    child_1_1_padding = '\0' * 8
+    child_1_1_1_type = 'free'
+    child_1_1_1_data = '1.1.1'
+    child_2_type = 'free'
+    child_2_data = '2'
+    
+    def setUp(self):
+        child_1_1_1 = atom.render_atom_header(self.child_1_1_1_type, \
+            len(self.child_1_1_1_data)) + self.child_1_1_1_data
+        child_1_1 = atom.render_atom_header(self.child_1_1_type, \
+            len(self.child_1_1_padding + child_1_1_1))
+        child_1_1 += self.child_1_1_padding + child_1_1_1
+        child_1 = atom.render_atom_header(self.child_1_type, len(child_1_1))
+        child_1 += child_1_1
+        child_2 = atom.render_atom_header(self.child_2_type, \
+            len(self.child_2_data)) + self.child_2_data
+        
+        self.rendered_atom = atom.render_atom_header(self.type, \
+            len(child_1 + child_2)) + child_1 + child_2
+        self.atom_stream = ReadRecordingStream(self.rendered_atom)
+        self.initial_bulk_read_size = atom.BULK_READ_SIZE
+    
+    def tearDown(self):
+        atom.BULK_READ_SIZE = self.initial_bulk_read_size
+        del self.atom_stream
+    
+    def assertCorrectlyStructured(self, loaded_atom):
+        self.assertEqual(2, len(loaded_atom))
+        self.assertEqual(self.child_1_type, loaded_atom[0].type)
+        self.assertEqual(self.child_1_1_type, loaded_atom[0][0].type)
+        self.assertEqual(self.child_1_1_1_type, loaded_atom[0][0][0].type)
+        loaded_atom[0][0][0].seek(0)
+        self.assertEqual(self.child_1_1_1_data, loaded_atom[0][0][0].read())
+        loaded_atom[1].seek(0)
+        self.assertEqual(self.child_2_data, loaded_atom[1].read())
+        
+        save_stream = StringIO.StringIO()
+        loaded_atom.save(save_stream)
+        self.assertEqual(self.rendered_atom, save_stream.getvalue())
+    
+    def testHeadersAreDecodedFromOneRead(self):
+        loaded_atom = atom.Atom(self.atom_stream)
+        
+        # The root header, then all of its content
+        self.assertEqual(2, len(self.atom_stream.read_sizes))
+        self.assertEqual(len(self.rendered_atom), self.atom_stream.tell())
+        self.assertCorrectlyStructured(loaded_atom)
+    
+    def testLargeContainersAreReadPerAtom(self):
+        atom.BULK_READ_SIZE = 0
+        loaded_atom = atom.Atom(self.atom_stream)
+        
+        self.assertEqual(5, len(self.atom_stream.read_sizes))
+        self.assertCorrectlyStructured(loaded_atom)
+    
+
+class DecodeTypedAtoms(unittest.TestCase):
+    # Version 0 mvhd: times, timescale 600, duration 1200, rate 1.0,
+    # volume 1.0, reserved, matrix (kept as is) and next track 3
+    mvhd_content = struct.pack('>LLLLLlh10x', 0, 1, 2, 600, 1200, 0x10000, 0x100) \
+        + ''.join([chr(i) for i in range(36)]) + '\0' * 24 \
+        + struct.pack('>L', 3)
+    
+    def setUp(self):
+        rendered_atom = atom.render_atom_header('mvhd', len(self.mvhd_content))
+        rendered_atom += self.mvhd_content
+        self.atom_stream = ReadRecordingStream(rendered_atom)
+        self.atom = atom.Atom(self.atom_stream)
+    
+    def tearDown(self):
+        del self.atom
+        del self.atom_stream
+    
+    def testDecode(self):
+        fields = self.atom.decode()
+        
+        self.assertEqual(0, fields.version)
+        self.assertEqual(600, fields.timescale)
+        self.assertEqual(1200, fields.duration)
+        self.assertEqual(1.0, fields.rate)
+        self.assertEqual(1.0, fields.volume)
+        self.assertEqual(3, fields.next_track_id)
+    
+    def testDecodeReadsOnce(self):
+        self.atom_stream.read_sizes = []
+        self.atom.decode()
+        self.atom.decode()
+        
+        self.assertEqual(1, len(self.atom_stream.read_sizes))
+    
+    def testEncodeKeepsOtherBytes(self):
+        self.atom.encode(self.atom.decode()._replace(duration=1800))
+        self.atom.seek(0)
+        content = self.atom.read()
+        
+        self.assertEqual(len(self.mvhd_content), len(content))
+        self.assertEqual(self.mvhd_content[:16], content[:16])
+        self.assertEqual(self.mvhd_content[20:], content[20:])
+        self.assertEqual(1800, self.atom.decode().duration)
+    
+    def testEncodePromotesLargeTimes(self):
+        self.atom.encode(self.atom.decode()._replace(duration=2**33))
+        fields = self.atom.decode()
+        
+        self.assertEqual(1, fields.version)
+        self.assertEqual(2**33, fields.duration)
+        self.assertEqual(3, fields.next_track_id)
+        self.atom.seek(0)
+        self.assertEqual(len(self.mvhd_content) + 12, len(self.atom.read()))
+    
+    def testUnknownTypesCannotBeDecoded(self):
+        self.assertRaises(ValueError, atom.Atom(type='free').decode)
+    
+    def testMediaHeaderLanguage(self):
+        content = atom.encode_mdhd(atom.MediaHeader(0, 0, 0, 0, 48000, 10, 'eng'),
+                                   '\0' * 24)
+        self.assertEqual(24, len(content))
+        self.assertEqual('eng', atom.decode_mdhd(content).language)
+    
+    def testHandlerName(self):
+        fields = atom.HandlerReference(0, 0, 'soun', 'Sound')
+        self.assertEqual(fields, atom.decode_hdlr(atom.encode_hdlr(fields)))
+    
+    def testEditList(self):
+        fields = atom.EditList(0, 0, [atom.EditListEntry(1000, -1, 1.0),
+                                      atom.EditListEntry(5, 2**40, 1.5)])
+        decoded = atom.decode_elst(atom.encode_elst(fields))
+        
+        self.assertEqual(1, decoded.version)
+        self.assertEqual(fields.entries, decoded.entries)
+    
+
+class RenderAtomHeader(unittest.TestCase):
+    type = 'mdat'
+    
+    def testBasicHeaderForLargestBasicAtom(self):
+        content_size = 2**32 - 1 - 8
+        self.assertEqual(8, atom.get_header_size(content_size))
+        self.assertEqual(struct.pack('>L4s', 2**32 - 1, self.type),
+            atom.render_atom_header(self.type, content_size))
+    
+    def testLargeHeaderWhenBasicSizeOverflows(self):
+        content_size = 2**32 - 8
+        self.assertEqual(16, atom.get_header_size(content_size))
+        self.assertEqual(struct.pack('>L4sQ', 1, self.type, content_size + 16),
+            atom.render_atom_header(self.type, content_size))
+    
+
 class LoadSimpleDataAtom(unittest.TestCase):
     type = 'free'
     content = 'line 1\nline 2'
@@ -855,6 +1129,21 @@ class LoadSimpleDataAtom(unittest.TestCase):
         data_atom.seek(7)
         self.assertEqual(self.content[7:], data_atom.read())
     
+    def testCanReadSegment(self):
+        data_atom = atom.Atom(self.atom_stream_with_content)
+        data_atom.seek(2)
+        self.assertEqual(self.content[2:6], data_atom.read(4))
+        self.assertEqual(self.content[6:], data_atom.read())
+    
+    def testZeroSizeExtendsToEnd(self):
+        atom_stream = StringIO.StringIO()
+        atom_stream.write(struct.pack('>L4s', 0, self.type) + self.content)
+        data_atom = atom.Atom(atom_stream)
+        
+        data_atom.seek(0)
+        self.assertEqual(len(self.content), data_atom.size())
+        self.assertEqual(self.content, data_atom.read())
+    
 
 class ManipulateLoadedDataAtom(unittest.TestCase):
     type = 'free'
@@ -906,6 +1195,291 @@ class ManipulateLoadedDataAtom(unittest.TestCase):
         self.assertEqual(rendered_atom, save_stream.read())
     
 
+class PatchLoadedDataAtom(unittest.TestCase):
+    type = 'stsz'
+    content = 'abcdefghij' * 10000
+    
+    def setUp(self):
+        # Some other atom first, so the data atom is not at the start
+        self.leading = atom.render_atom_header('free', 3) + 'xyz'
+        self.rendered_atom = atom.render_atom_header(self.type,
+            len(self.content)) + self.content
+        self.atom_stream = StringIO.StringIO(self.leading + self.rendered_atom)
+        self.atom = atom.Atom(self.atom_stream, offset=len(self.leading))
+    
+    def tearDown(self):
+        del self.atom
+        del self.atom_stream
+    
+    def testPatchKeepsTheRestOfTheContent(self):
+        self.atom.seek(5000)
+        self.atom.write('XYZ')
+        self.atom.seek(0)
+        self.assertEqual(self.content[:5000] + 'XYZ' + self.content[5003:],
+                         self.atom.read())
+    
+    def testPatchDoesNotReadTheSource(self):
+        with atom.AtomStats() as stats:
+            self.atom.seek(5000)
+            self.atom.write('XYZ')
+        
+        self.assertEqual(0, stats.bytes_read)
+    
+    def testSaveMergesPatches(self):
+        self.atom.seek(3)
+        self.atom.write('XYZ')
+        self.atom.seek(0, os.SEEK_END)
+        self.atom.write('end')
+        save_stream = StringIO.StringIO()
+        self.atom.save(save_stream)
+        
+        content = self.content[:3] + 'XYZ' + self.content[6:] + 'end'
+        self.assertEqual(atom.render_atom_header(self.type, len(content))
+                         + content, save_stream.getvalue())
+    
+    def testCanTruncateUneditedAtom(self):
+        self.atom.seek(10)
+        self.atom.truncate()
+        self.atom.seek(0)
+        self.assertEqual(self.content[:10], self.atom.read())
+    
+    def testCloneIsEditedApart(self):
+        self.atom.seek(0)
+        self.atom.write('first')
+        clone = self.atom.clone()
+        clone.seek(0)
+        clone.write('again')
+        
+        self.atom.seek(0)
+        self.assertEqual('first', self.atom.read(5))
+        clone.seek(0)
+        self.assertEqual('again' + self.content[5:], clone.read())
+    
+    def testCloneOfContainer(self):
+        moov = atom.Atom(StringIO.StringIO(atom.render_atom_header('moov',
+            len(self.rendered_atom)) + self.rendered_atom))
+        clone = moov.clone()
+        clone[0].seek(0)
+        clone[0].write('X')
+        
+        save_stream = StringIO.StringIO()
+        moov.save(save_stream)
+        self.assertTrue(save_stream.getvalue().endswith(self.rendered_atom))
+        save_stream = StringIO.StringIO()
+        clone.save(save_stream)
+        self.assertTrue(save_stream.getvalue().endswith('X' + self.content[1:]))
+    
+
+class OverlayStreamEdits(unittest.TestCase):
+    content = '0123456789'
+    
+    def setUp(self):
+        self.stream = atom.OverlayStream(
+            StringIO.StringIO('--' + self.content), 2, len(self.content))
+    
+    def tearDown(self):
+        del self.stream
+    
+    def testReadsSourceUntouched(self):
+        self.assertEqual(self.content, self.stream.read())
+        self.assertEqual(0, self.stream.patched_size())
+    
+    def testOverlappingWritesAreMerged(self):
+        self.stream.seek(2)
+        self.stream.write('ab')
+        self.stream.seek(7)
+        self.stream.write('cd')
+        self.stream.seek(3)
+        self.stream.write('XYZWVU')
+        self.stream.seek(0)
+        
+        self.assertEqual('01aXYZWVU9', self.stream.read())
+        self.assertEqual(7, self.stream.patched_size())
+    
+    def testTruncatedSourceStaysHidden(self):
+        self.stream.truncate(4)
+        self.stream.seek(6)
+        self.stream.write('z')
+        self.stream.seek(0)
+        
+        self.assertEqual('0123\0\0z', self.stream.read())
+    
+    def testCopyIsIndependent(self):
+        self.stream.write('a')
+        other = self.stream.copy()
+        other.write('b')
+        self.stream.seek(0)
+        other.seek(0)
+        
+        self.assertEqual('a123456789', self.stream.read())
+        self.assertEqual('ab23456789', other.read())
+    
+    def testReadLines(self):
+        self.stream.seek(4)
+        self.stream.write('\n')
+        self.stream.seek(0)
+        
+        self.assertEqual(['0123\n', '56789'], list(self.stream))
+    
+
+class LoadMappedContainerAtom(unittest.TestCase):
+    type = 'moov'
+    child_type = 'free'
+    child_content = 'line 1\nline 2'
+    
+    def setUp(self):
+        child_atom = atom.render_atom_header(self.child_type, \
+            len(self.child_content))
+        child_atom += self.child_content
+        
+        self.rendered_atom = atom.render_atom_header(self.type, len(child_atom))
+        self.rendered_atom += child_atom
+        
+        self.atom_file = tempfile.TemporaryFile()
+        self.atom_file.write(self.rendered_atom)
+        self.atom_file.flush()
+        self.atom_stream = atom.MappedStream(self.atom_file)
+    
+    def tearDown(self):
+        self.atom_stream.close()
+    
+    def testAtomIsCorrectlyStructured(self):
+        loaded_atom = atom.Atom(self.atom_stream)
+        
+        self.assertEqual(self.type, loaded_atom.type)
+        self.assertEqual(1, len(loaded_atom))
+        self.assertEqual(self.child_type, loaded_atom[0].type)
+        self.assertEqual(len(self.child_content), loaded_atom[0].size())
+    
+    def testReadIsZeroCopy(self):
+        loaded_atom = atom.Atom(self.atom_stream)
+        loaded_atom[0].seek(0)
+        content = loaded_atom[0].read()
+        
+        self.assertTrue(isinstance(content, buffer))
+        self.assertEqual(self.child_content, str(content))
+    
+    def testCanReadSegment(self):
+        loaded_atom = atom.Atom(self.atom_stream)
+        loaded_atom[0].seek(2)
+        
+        self.assertEqual(self.child_content[2:6], str(loaded_atom[0].read(4)))
+    
+    def testSavedAtomHasCorrectContent(self):
+        loaded_atom = atom.Atom(self.atom_stream)
+        save_stream = StringIO.StringIO()
+        loaded_atom.save(save_stream)
+        
+        self.assertEqual(self.rendered_atom, save_stream.getvalue())
+    
+    def testChildrenAreDecodedFromTheMap(self):
+        with atom.AtomStats() as stats:
+            atom.Atom(self.atom_stream)
+        
+        # Only the container header is parsed from the stream
+        self.assertEqual(2, stats.atoms)
+        self.assertEqual(1, stats.seeks)
+    
+
+class CountAtomStats(unittest.TestCase):
+    type = 'moov'
+    child_type = 'free'
+    child_content = 'line 1\nline 2'
+    
+    def setUp(self):
+        child_atom = atom.render_atom_header(self.child_type, \
+            len(self.child_content))
+        child_atom += self.child_content
+        
+        self.rendered_atom = atom.render_atom_header(self.type, len(child_atom))
+        self.rendered_atom += child_atom
+        self.atom_stream = StringIO.StringIO(self.rendered_atom)
+    
+    def tearDown(self):
+        del self.atom_stream
+    
+    def testThreadsCountApart(self):
+        counted = {}
+        def parse(name):
+            with atom.AtomStats() as stats:
+                for i in range(50):
+                    atom.Atom(StringIO.StringIO(self.rendered_atom))
+            counted[name] = stats.atoms
+        
+        with atom.AtomStats() as stats:
+            threads = [threading.Thread(target=parse, args=(i, ))
+                       for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        
+        self.assertEqual(0, stats.atoms)
+        self.assertEqual({0: 100, 1: 100, 2: 100, 3: 100}, counted)
+    
+    def testCountsNothingWhenInactive(self):
+        stats = atom.AtomStats()
+        atom.Atom(self.atom_stream)
+        
+        self.assertEqual(0, stats.atoms)
+        self.assertEqual(0, stats.reads)
+    
+    def testCountsParsing(self):
+        with atom.AtomStats() as stats:
+            atom.Atom(self.atom_stream)
+        
+        self.assertEqual(2, stats.atoms)
+        self.assertEqual({self.type: 1, self.child_type: 1}, stats.atom_types)
+        self.assertEqual(2, stats.reads)
+        self.assertTrue(0 < stats.seeks)
+        self.assertEqual(set([self.type, self.child_type]),
+                         set(stats.parse_time.keys()))
+    
+    def testCountsReads(self):
+        loaded_atom = atom.Atom(self.atom_stream)
+        with atom.AtomStats() as stats:
+            loaded_atom[0].seek(0)
+            loaded_atom[0].read()
+        
+        self.assertEqual(1, stats.reads)
+        self.assertEqual(len(self.child_content), stats.bytes_read)
+        self.assertEqual([self.child_type], stats.read_time.keys())
+    
+    def testCountsSaving(self):
+        loaded_atom = atom.Atom(self.atom_stream)
+        with atom.AtomStats() as stats:
+            loaded_atom.save(StringIO.StringIO())
+        
+        self.assertEqual(len(self.rendered_atom), stats.bytes_written)
+        self.assertEqual(set([self.type, self.child_type]),
+                         set(stats.save_time.keys()))
+    
+    def testCallsHook(self):
+        events = []
+        hook = lambda operation, atom_type, size, seconds: \
+            events.append((operation, atom_type, size))
+        with atom.AtomStats(hook):
+            atom.Atom(self.atom_stream).save(StringIO.StringIO())
+        
+        # Saving reads the content until an empty read
+        self.assertEqual([('parse', self.type, 8), ('parse', self.child_type, 8),
+                          ('save', self.type, 8),
+                          ('read', self.child_type, len(self.child_content)),
+                          ('read', self.child_type, 0),
+                          ('save', self.child_type, 8 + len(self.child_content))],
+                         events)
+    
+    def testNestedStatsRestoreOuter(self):
+        with atom.AtomStats() as outer:
+            with atom.AtomStats() as inner:
+                atom.Atom(self.atom_stream)
+            self.atom_stream.seek(0)
+            atom.Atom(self.atom_stream)
+        
+        self.assertEqual(2, inner.atoms)
+        self.assertEqual(2, outer.atoms)
+    
+
 
 if __name__ == "__main__":
     unittest.main()
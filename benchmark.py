@@ -0,0 +1,230 @@
+# Benchmarks on synthetic MP4 files
+#
+# Generates a corpus with mp4synth (once, kept in --corpus) and times the
+# main operations on every file: parsing with Mp4File, saving moov with
+# Atom.save, duration extraction and retiming. Each measure runs in a
+# process of its own, so that its peak memory (ru_maxrss) is its own and
+# not that of whatever ran before. Results are compared to a JSON
+# baseline and the exit status is 1 when something got slower or larger
+# than --threshold times the baseline, or when a case failed (raised or
+# ran past --timeout).
+# Run it from the repository root: the corpus and the baseline are kept
+# there, untracked, as they only make sense on the machine that made them.
+#
+# Usage:
+#   python benchmark.py --save-baseline    record the baseline of this machine
+#   python benchmark.py                    compare against it
+
+import os
+import sys
+import json
+import time
+import resource
+import tempfile
+import StringIO
+import multiprocessing
+import numpy as np
+import mp4synth
+from mp4file import Mp4File
+from sampletable import sample_tables
+from fragments import fragment_tables
+from getframesduration import Mp4DurationExtractor, export_timings, timing_tables
+from setframeduration import Mp4TimeSetter
+from seekindex import SeekIndex
+
+# name: mp4synth.synthesize arguments, scaled down by --scale
+CORPUS = {
+    "small": dict(samples=1000),
+    "tables": dict(samples=1000000,jitter=True,moov_at_end=True),
+    "sparse": dict(samples=40000,sample_size=150000),
+    "tracks": dict(tracks=32,samples=20000,jitter=True),
+    "fragmented": dict(tracks=2,samples=200000,fragments=2000),
+}
+
+def parse(path):
+    mp4 = Mp4File(path)
+    mp4.close()
+
+def parse_lazy(path):
+    mp4 = Mp4File(path,use_mmap=True,lazy=True)
+    mp4.close()
+
+def save(path):
+    mp4 = Mp4File(path)
+    for a in mp4:
+        if a.type in ("moov","moof"):
+            a.save(StringIO.StringIO())
+    mp4.close()
+
+def tables(path):
+    mp4 = Mp4File(path,use_mmap=True,lazy=True)
+    if any([a.type == "moof" for a in mp4]):
+        fragment_tables(mp4)
+    else:
+        sample_tables(mp4)
+    mp4.close()
+
+def durations(path):
+    mp4 = Mp4File(path)
+    ee = Mp4DurationExtractor(mp4,os.devnull,0,False)
+    ee.run()
+    mp4.close()
+
+def export(path):
+    mp4 = Mp4File(path,use_mmap=True,lazy=True)
+    ofp = os.path.join(tempfile.gettempdir(),"bench_export_%d.npz" % os.getpid())
+    for tmp,name in export_timings(timing_tables(mp4),ofp,"npz"):
+        os.remove(tmp)
+    mp4.close()
+
+def seek(path):
+    mp4 = Mp4File(path,use_mmap=True,lazy=True)
+    index = SeekIndex(timing_tables(mp4)[0])
+    mp4.close()
+    # random times over the track and a bit beyond
+    times = np.random.RandomState(0).uniform(-1,index.dts[-1]*1.1/index.timescale,100000)
+    index.seek_many(times)
+
+def retime(path):
+    mp4 = Mp4File(path,use_mmap=True,lazy=True)
+    t = sample_tables(mp4)[0]
+    mp4.close()
+    # 33 and 34ms in turn, one stts entry per sample
+    d = np.column_stack((np.ones(len(t),dtype=np.int64),33 + np.arange(len(t)) % 2))
+    infile = open(path,"rb")
+    output = open(os.devnull,"wb")
+    ee = Mp4TimeSetter(infile,output,d,1,int(np.sum(d[:,1])),1000,0,False)
+    ee.run()
+    output.close()
+    infile.close()
+
+# name: (function, corpus files it runs on, None for all)
+CASES = [
+    ("parse",parse,None),
+    ("parse_lazy",parse_lazy,None),
+    ("save",save,None),
+    ("tables",tables,None),
+    ("durations",durations,["small","tables","sparse","tracks"]),
+    ("export",export,None),
+    ("seek",seek,None),
+    # retiming copies the whole file, keep away from the sparse one
+    ("retime",retime,["small","tables","tracks"]),
+]
+
+def measure(fn,path,queue):
+    # the tools print as they go
+    sys.stdout = open(os.devnull,"w")
+    t0 = time.time()
+    fn(path)
+    elapsed = time.time() - t0
+    queue.put((elapsed,resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+def run_case(fn,path,repeat,timeout):
+    """Best time (s) and peak memory (KB) of fn(path) over repeat runs,
+    None if a run fails or takes more than timeout seconds"""
+    best = None
+    for i in range(repeat):
+        queue = multiprocessing.Queue()
+        p = multiprocessing.Process(target=measure,args=(fn,path,queue))
+        p.start()
+        # the result is small enough to sit in the pipe until read, the
+        # child exits as soon as it is done
+        p.join(timeout)
+        if p.is_alive():
+            p.terminate()
+            p.join()
+        if p.exitcode != 0:
+            return None
+        result = queue.get(timeout=10)
+        if best is None or result[0] < best[0]:
+            best = result
+    return best
+
+def corpus(directory,scale):
+    """Path of every corpus file, generating those missing"""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    paths = {}
+    for name,args in sorted(CORPUS.items()):
+        args = dict(args)
+        args["samples"] = max(int(args["samples"]*scale),1)
+        paths[name] = os.path.join(directory,"%s-%g.mp4" % (name,scale))
+        if not os.path.isfile(paths[name]):
+            print "generating",paths[name]
+            mp4synth.synthesize(paths[name],**args)
+    return paths
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='MP4 benchmarks')
+    parser.add_argument("--corpus",default="bench_corpus",help="directory of the synthetic files")
+    parser.add_argument("--scale",type=float,default=1,help="scales the number of samples of the corpus")
+    parser.add_argument("--repeat",type=int,default=3,help="runs of each case, the best is kept")
+    parser.add_argument("--only",default="",help="comma separated cases to run")
+    parser.add_argument("--baseline",default="bench_baseline.json")
+    parser.add_argument("--save-baseline",action="store_true")
+    parser.add_argument("--threshold",type=float,default=1.25,help="slowdown or memory growth reported as a regression")
+    parser.add_argument("--timeout",type=float,default=600,help="seconds after which a run is reported as failed")
+    parser.add_argument("--min-seconds",type=float,default=0.01,help="slowdowns below this are timer noise")
+    parser.add_argument("--output",default="bench_output.txt")
+    args = parser.parse_args()
+
+    paths = corpus(args.corpus,args.scale)
+    only = [x for x in args.only.split(",") if x != ""]
+    baseline = {}
+    if os.path.isfile(args.baseline) and not args.save_baseline:
+        baseline = json.load(open(args.baseline))
+
+    results = {}
+    regressions = []
+    failures = []
+    lines = []
+    for case,fn,files in CASES:
+        if only and case not in only:
+            continue
+        for name in sorted(paths.keys()):
+            if files is not None and name not in files:
+                continue
+            key = "%s/%s" % (case,name)
+            result = run_case(fn,paths[name],args.repeat,args.timeout)
+            if result is None:
+                failures.append(key)
+                line = "%-22s FAILED" % key
+                print line
+                lines.append(line)
+                continue
+            elapsed,peak = result
+            size = os.path.getsize(paths[name])
+            results[key] = dict(seconds=elapsed,peak_kb=peak,mb_per_s=size/1e6/max(elapsed,1e-9))
+            line = "%-22s %9.4f s %10.1f MB/s %9d KB" % (key,elapsed,results[key]["mb_per_s"],peak)
+            if key in baseline:
+                b = baseline[key]
+                ratio = elapsed/max(b["seconds"],1e-9)
+                memory = peak/float(max(b["peak_kb"],1))
+                line += "   x%.2f time x%.2f memory" % (ratio,memory)
+                slower = ratio > args.threshold and elapsed - b["seconds"] > args.min_seconds
+                if slower or memory > args.threshold:
+                    regressions.append(key)
+                    line += " REGRESSION"
+            print line
+            lines.append(line)
+
+    out = open(args.output,"w")
+    out.write("\n".join(lines) + "\n")
+    out.close()
+    if args.save_baseline:
+        tmp = args.baseline + ".tmp"
+        json.dump(results,open(tmp,"w"),indent=1,sort_keys=True)
+        os.rename(tmp,args.baseline)
+        print "baseline saved to",args.baseline
+    if len(failures) > 0:
+        print "failed:"," ".join(failures)
+    if len(regressions) > 0:
+        print "regressions:"," ".join(regressions)
+    if len(failures) > 0 or len(regressions) > 0:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+# Moves moov in front of mdat ("faststart"), so that players and web
+# clients can start without fetching the tail of the file first
+#
+# The chunk offsets (stco/co64) of all tracks are moved by as much as the
+# data they point to, with whole-array operations, promoting stco to co64
+# if needed. Everything else is streamed across in large blocks.
+#
+# Reference:
+# https://wiki.multimedia.cx/index.php/QuickTime_container#stco
+
+import os
+import StringIO
+import numpy as np
+from sampletable import remap_chunk_offsets
+from setframeduration import cloneatom, copyfileobj, toplevel
+
+def faststart(infile,output,verbose=False):
+    """Writes infile to output with moov before the first mdat. Returns
+    False, writing nothing, if moov already comes first."""
+    atoms = toplevel(infile,lazy=True)
+    types = [a.type for pre,post,a in atoms]
+    if "moov" not in types:
+        print "no moov found"
+        return False
+    m = types.index("moov")
+    data = [i for i,t in enumerate(types) if t == "mdat"]
+    if len(data) == 0 or data[0] > m:
+        print "moov already before mdat"
+        return False
+
+    # new order of the top level atoms: moov moves in front of the mdat
+    order = [i for i in range(len(atoms)) if i != m]
+    order.insert(order.index(data[0]),m)
+    starts = np.array([pre for pre,post,a in atoms],dtype=np.int64)
+    sizes = np.array([post-pre for pre,post,a in atoms],dtype=np.int64)
+
+    # the new moov size decides where everything else lands, and may
+    # itself grow if offsets get promoted to 64 bits: repeat until stable
+    moov_size = sizes[m]
+    while True:
+        sizes[m] = moov_size
+        new_starts = np.zeros(len(atoms),dtype=np.int64)
+        new_starts[order] = np.cumsum(sizes[order]) - sizes[order]
+        shifts = new_starts - starts
+        # every offset moves with the top level atom it falls in
+        remap = lambda o: o + shifts[np.maximum(np.searchsorted(starts,o,side="right")-1,0)]
+        c = cloneatom(atoms[m][2])
+        remap_chunk_offsets(c,remap)
+        rendered = StringIO.StringIO()
+        c.save(rendered)
+        moov = rendered.getvalue()
+        if len(moov) == moov_size:
+            break
+        if verbose:
+            print "moov grows from",moov_size,"to",len(moov)
+        moov_size = len(moov)
+
+    for i in order:
+        if i == m:
+            print "Writing moov at",output.tell()
+            output.write(moov)
+        else:
+            pre,post,a = atoms[i]
+            if verbose:
+                print "Copying",a.type,"from",pre,"to",output.tell()
+            infile.seek(pre,os.SEEK_SET)
+            copyfileobj(infile,output,post-pre)
+    return True
+
+def main():
+    import argparse 
+
+    parser = argparse.ArgumentParser(description='MP4 Faststart')
+    parser.add_argument("input")
+    parser.add_argument("--output",default="")
+    parser.add_argument("--verbose",action="store_true")
+
+    args = parser.parse_args()
+
+    if args.output == "":
+        args.output = args.input + ".faststart.mp4"
+
+    q = open(args.output+".tmp","wb")
+    if faststart(open(args.input,"rb"),q,args.verbose):
+        print "done"
+        q.close()
+        os.rename(args.output+".tmp",args.output)
+    else:
+        q.close()
+        os.remove(args.output+".tmp")
+if __name__ == '__main__':
+    main()
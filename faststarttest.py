@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Unit tests for faststart.py
+
+"""
+
+import atom
+import faststart
+import mp4file
+import mp4synth
+import numpy as np
+import os
+from setframedurationtest import chunk_offset_type, sample_bytes
+import shutil
+import tempfile
+import unittest
+
+class MoveMoovFirst(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'in.mp4')
+        self.output = os.path.join(self.directory, 'out.mp4')
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def write(self, *parts):
+        f = open(self.path, 'wb')
+        for part in parts:
+            f.write(part)
+        f.close()
+    
+    def faststart(self):
+        f = open(self.path, 'rb')
+        q = open(self.output, 'wb')
+        moved = faststart.faststart(f, q)
+        q.close()
+        f.close()
+        return moved
+    
+    def types(self, path):
+        mp4 = mp4file.Mp4File(path)
+        types = [a.type for a in mp4]
+        mp4.close()
+        return types
+    
+    def testMoovAtEndMovesFirst(self):
+        track = mp4synth.SyntheticTrack(1, 25, sample_size=100)
+        first = len(mp4synth.FTYP) + 8
+        self.write(mp4synth.FTYP,
+                   mp4synth.box('mdat', os.urandom(track.nbytes())),
+                   mp4synth.box('moov', mp4synth.mvhd([track])
+                                + track.sample_table(first, chunk=4)))
+        
+        self.assertTrue(self.faststart())
+        self.assertEqual(['ftyp', 'moov', 'mdat'], self.types(self.output))
+        self.assertEqual(os.path.getsize(self.path),
+                         os.path.getsize(self.output))
+        self.assertEqual(sample_bytes(self.path), sample_bytes(self.output))
+    
+    def testAlreadyFaststartIsLeftAlone(self):
+        mp4synth.synthesize(self.path, samples=10)
+        
+        self.assertFalse(self.faststart())
+        self.assertEqual(0, os.path.getsize(self.output))
+    
+    def testMoovGrowsUntilStable(self):
+        track = mp4synth.SyntheticTrack(1, 10, sample_size=100)
+        moov = lambda offset: mp4synth.box('moov', mp4synth.mvhd([track])
+            + track.sample_table(offset, chunk=2))
+        # a sparse free atom pushes the last chunk right below 4 GiB, so
+        # that moving moov in front overflows stco
+        last = (np.cumsum(track.sizes) - track.sizes)[::2][-1]
+        first = 2**32 - len(moov(0)) // 2 - last
+        f = open(self.path, 'wb')
+        f.write(mp4synth.FTYP)
+        gap = first - 8 - f.tell()
+        f.write(atom.render_atom_header('free', gap - 8))
+        f.truncate(f.tell() + gap - 8)
+        f.seek(0, os.SEEK_END)
+        f.write(mp4synth.box('mdat', os.urandom(track.nbytes())))
+        f.write(moov(first))
+        f.close()
+        self.assertEqual('stco', chunk_offset_type(self.path))
+        
+        self.assertTrue(self.faststart())
+        self.assertEqual(['ftyp', 'free', 'moov', 'mdat'],
+                         self.types(self.output))
+        self.assertEqual('co64', chunk_offset_type(self.output))
+        # every one of the 5 chunk offsets takes 4 more bytes
+        self.assertEqual(os.path.getsize(self.path) + 5 * 4,
+                         os.path.getsize(self.output))
+        self.assertEqual(sample_bytes(self.path), sample_bytes(self.output))
+    
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,319 @@
+# Sample index of fragmented MP4 files
+#
+# In fragmented files the sample tables in moov are empty: samples are
+# described by moof boxes, each holding a traf per track with a tfhd
+# (defaults), an optional tfdt (decode time of the first sample) and trun
+# boxes listing the samples. Every trun is decoded at once into NumPy
+# arrays, with the fields it leaves out taken from tfhd or moov/mvex/trex,
+# and the fragments of each track are joined into one sample index with
+# the same arrays as a SampleTable.
+#
+# Reference:
+# ISO/IEC 14496-12 Section 8.8 (Movie Fragments)
+
+import struct
+import numpy as np
+from atom import ATOM_HEADER_STRUCT, unpack_atom_header
+from sampletable import atom_content, child, track_header
+
+# tfhd flags
+TFHD_BASE_DATA_OFFSET = 0x1
+TFHD_SAMPLE_DESCRIPTION_INDEX = 0x2
+TFHD_DEFAULT_SAMPLE_DURATION = 0x8
+TFHD_DEFAULT_SAMPLE_SIZE = 0x10
+TFHD_DEFAULT_SAMPLE_FLAGS = 0x20
+TFHD_DEFAULT_BASE_IS_MOOF = 0x20000
+
+# trun flags
+TRUN_DATA_OFFSET = 0x1
+TRUN_FIRST_SAMPLE_FLAGS = 0x4
+TRUN_SAMPLE_DURATION = 0x100
+TRUN_SAMPLE_SIZE = 0x200
+TRUN_SAMPLE_FLAGS = 0x400
+TRUN_SAMPLE_COMPOSITION_TIME_OFFSET = 0x800
+
+# sample flags
+SAMPLE_IS_NON_SYNC_SAMPLE = 0x10000
+
+def boxes(data,offset=0,end=None):
+    """(type,start,end) of the boxes in data[offset:end], start and end
+    delimiting the content of each"""
+    if end is None:
+        end = len(data)
+    while offset + ATOM_HEADER_STRUCT["basic"].size <= end:
+        t,size,header = unpack_atom_header(data,offset,end)
+        yield t,offset + header,offset + header + size
+        offset += header + size
+
+def version_flags(data):
+    """(version,flags) of a full box"""
+    v = struct.unpack_from(">L",data,0)[0]
+    return v >> 24,v & 0xffffff
+
+def decode_trex(data):
+    """Returns the track_ID and sample defaults of a trex box"""
+    track_id,description,duration,size,flags = struct.unpack_from(">LLLLL",data,4)
+    return dict(track_id=track_id,sample_description_index=description,
+                duration=duration,size=size,flags=flags)
+
+def decode_tfhd(data):
+    """Returns the fields of a tfhd box, None for those not present"""
+    v,flags = version_flags(data)
+    track_id = struct.unpack_from(">L",data,4)[0]
+    out = dict(track_id=track_id,flags=flags,base_data_offset=None,
+               sample_description_index=None,duration=None,size=None,sample_flags=None)
+    k = 8
+    if flags & TFHD_BASE_DATA_OFFSET:
+        out["base_data_offset"] = struct.unpack_from(">Q",data,k)[0]
+        k += 8
+    for flag,name in ((TFHD_SAMPLE_DESCRIPTION_INDEX,"sample_description_index"),
+                      (TFHD_DEFAULT_SAMPLE_DURATION,"duration"),
+                      (TFHD_DEFAULT_SAMPLE_SIZE,"size"),
+                      (TFHD_DEFAULT_SAMPLE_FLAGS,"sample_flags")):
+        if flags & flag:
+            out[name] = struct.unpack_from(">L",data,k)[0]
+            k += 4
+    return out
+
+def decode_tfdt(data):
+    """Returns the base media decode time of a tfdt box"""
+    v,flags = version_flags(data)
+    if v == 1:
+        return struct.unpack_from(">Q",data,4)[0]
+    return struct.unpack_from(">L",data,4)[0]
+
+def decode_trun(data):
+    """Returns (flags,data_offset,first_sample_flags,samples) of a trun box.
+    data_offset and first_sample_flags are None when not present, samples
+    is a structured array with one record per sample holding only the
+    fields the box has among duration, size, flags and cts"""
+    v,flags = version_flags(data)
+    n = struct.unpack_from(">L",data,4)[0]
+    k = 8
+    data_offset = None
+    first_sample_flags = None
+    if flags & TRUN_DATA_OFFSET:
+        data_offset = struct.unpack_from(">l",data,k)[0]
+        k += 4
+    if flags & TRUN_FIRST_SAMPLE_FLAGS:
+        first_sample_flags = struct.unpack_from(">L",data,k)[0]
+        k += 4
+    fields = []
+    if flags & TRUN_SAMPLE_DURATION:
+        fields.append(("duration",">u4"))
+    if flags & TRUN_SAMPLE_SIZE:
+        fields.append(("size",">u4"))
+    if flags & TRUN_SAMPLE_FLAGS:
+        fields.append(("flags",">u4"))
+    if flags & TRUN_SAMPLE_COMPOSITION_TIME_OFFSET:
+        # signed in version 1, and in many version 0 boxes in the wild:
+        # reading both as signed is what players do (see decode_ctts)
+        fields.append(("cts",">i4"))
+    if len(fields) == 0:
+        # every sample takes the defaults
+        samples = np.zeros(n,dtype=np.dtype([]))
+    else:
+        samples = np.frombuffer(data,dtype=np.dtype(fields),count=n,offset=k)
+    return flags,data_offset,first_sample_flags,samples
+
+class FragmentTable:
+    """Per sample arrays of one track of a fragmented file, as in a
+    SampleTable, plus the 0 based moof of each sample in fragments"""
+    def __init__(self,track_id,handler_type=None,timescale=0):
+        self.track_id = track_id
+        self.handler_type = handler_type
+        self.timescale = timescale
+        self.parts = []
+        self.truns = [] # added with add_trun, not decoded yet
+        self.decode_time = 0 # where the next fragment starts without tfdt
+        self.join()
+
+    def add(self,fragment,offsets,sizes,durations,cts,flags,base_decode_time):
+        self.flush_truns()
+        if base_decode_time is None:
+            base_decode_time = self.decode_time
+        dts = base_decode_time + np.cumsum(durations) - durations
+        self.decode_time = base_decode_time + int(np.sum(durations))
+        self.parts.append((np.full(offsets.shape[0],fragment,dtype=np.int64),
+                           offsets,sizes,durations,dts,dts + cts,
+                           (flags & SAMPLE_IS_NON_SYNC_SAMPLE) == 0))
+        self.joined = False
+
+    def add_trun(self,fragment,samples,defaults,first_flags,position,base_decode_time,duration):
+        """Adds the samples of a trun as returned by decode_trun, with
+        defaults the (duration,size,flags) of the fields it lacks, position
+        the file offset of its first sample and duration its total. Truns
+        are only turned into sample arrays by flush_truns, many at once"""
+        if base_decode_time is None:
+            base_decode_time = self.decode_time
+        self.decode_time = base_decode_time + duration
+        self.truns.append((fragment,samples,defaults,first_flags,position,base_decode_time))
+        self.joined = False
+
+    def flush_truns(self):
+        """Decodes the truns added so far, each run of truns having the
+        same fields with a few operations on all of their samples"""
+        i = 0
+        while i < len(self.truns):
+            j = i + 1
+            while j < len(self.truns) and self.truns[j][1].dtype == self.truns[i][1].dtype:
+                j += 1
+            self.parts.append(self.decode_truns(self.truns[i:j]))
+            i = j
+        self.truns = []
+
+    def decode_truns(self,truns):
+        fragments,samples,defaults,first_flags,positions,decode_times = zip(*truns)
+        n = np.array([x.shape[0] for x in samples],dtype=np.int64)
+        samples = np.concatenate(samples)
+        names = samples.dtype.names or ()
+        defaults = np.array(defaults,dtype=np.int64)
+        def field(name,column):
+            if name in names:
+                return samples[name].astype(np.int64)
+            return np.repeat(defaults[:,column],n)
+        durations = field("duration",0)
+        sizes = field("size",1)
+        flags = field("flags",2)
+        if "cts" in names:
+            cts = samples["cts"].astype(np.int64)
+        else:
+            cts = np.zeros(samples.shape[0],dtype=np.int64)
+        first = np.cumsum(n) - n
+        replaced = np.array([f is not None for f in first_flags]) & (n > 0)
+        flags[first[replaced]] = np.array([f or 0 for f in first_flags],dtype=np.int64)[replaced]
+        def from_start(values,start):
+            # start of each trun plus what its samples before add up to
+            before = np.concatenate(([0],np.cumsum(values)))
+            return np.repeat(np.array(start,dtype=np.int64) - before[first],n) + before[:-1]
+        dts = from_start(durations,decode_times)
+        return (np.repeat(np.array(fragments,dtype=np.int64),n),from_start(sizes,positions),
+                sizes,durations,dts,dts + cts,(flags & SAMPLE_IS_NON_SYNC_SAMPLE) == 0)
+
+    def join(self):
+        """Concatenates the fragments added so far into the sample arrays"""
+        self.flush_truns()
+        names = ("fragments","offsets","sizes","durations","dts","pts","keyframes")
+        for i,name in enumerate(names):
+            if len(self.parts) == 0:
+                setattr(self,name,np.zeros(0,dtype=np.bool_ if name == "keyframes" else np.int64))
+            else:
+                setattr(self,name,np.concatenate([p[i] for p in self.parts]))
+        # keep the joined arrays as the only part
+        if len(self.parts) > 1:
+            self.parts = [tuple(getattr(self,name) for name in names)]
+        self.joined = True
+
+    def __len__(self):
+        return sum(p[0].shape[0] for p in self.parts) + sum(t[1].shape[0] for t in self.truns)
+
+    def seconds(self,t):
+        """Converts timescale units to seconds"""
+        return t * (1.0/self.timescale)
+
+class FragmentIndex:
+    """FragmentTable of every track of a fragmented file. Fragments can be
+    added as they are found with add_moof, see tables() for the result"""
+    def __init__(self,moov=None):
+        self.defaults = {}
+        self.tracks = {}
+        self.fragments = 0
+        if moov is not None:
+            self.add_moov(moov)
+
+    def add_moov(self,moov):
+        """Takes the tracks and the trex sample defaults from moov"""
+        for trak in moov.get_children_of_type("trak"):
+            track_id,handler_type,timescale = track_header(trak)
+            self.track(track_id,handler_type,timescale)
+        mvex = child(moov,"mvex")
+        if mvex is not None:
+            for trex in mvex.get_children_of_type("trex"):
+                d = decode_trex(atom_content(trex))
+                self.defaults[d["track_id"]] = d
+
+    def track(self,track_id,handler_type=None,timescale=0):
+        if track_id not in self.tracks:
+            self.tracks[track_id] = FragmentTable(track_id,handler_type,timescale)
+        return self.tracks[track_id]
+
+    def add_moof(self,moof,start):
+        """Decodes a moof starting (header included) at file offset start"""
+        self.add_moof_content(atom_content(moof),start)
+
+    def add_moof_content(self,data,start):
+        """Decodes the content of a moof starting (header included) at file
+        offset start. The boxes inside are read from data as they are,
+        without building atoms for them"""
+        fragment = self.fragments
+        self.fragments += 1
+        # without explicit base offsets, the data of each traf follows that
+        # of the previous one, the first starting at the moof
+        data_end = start
+        for t,traf_start,traf_end in boxes(data):
+            if t != "traf":
+                continue
+            traf = {}
+            for t,box_start,box_end in boxes(data,traf_start,traf_end):
+                traf.setdefault(t,[]).append(buffer(data,box_start,box_end - box_start))
+            tfhd = decode_tfhd(traf["tfhd"][0])
+            track_id = tfhd["track_id"]
+            trex = self.defaults.get(track_id,{})
+            if tfhd["base_data_offset"] is not None:
+                base = tfhd["base_data_offset"]
+            elif tfhd["flags"] & TFHD_DEFAULT_BASE_IS_MOOF:
+                base = start
+            else:
+                base = data_end
+            default_duration = tfhd["duration"] if tfhd["duration"] is not None else trex.get("duration",0)
+            default_size = tfhd["size"] if tfhd["size"] is not None else trex.get("size",0)
+            default_flags = tfhd["sample_flags"] if tfhd["sample_flags"] is not None else trex.get("flags",0)
+            decode_time = None
+            if "tfdt" in traf:
+                decode_time = decode_tfdt(traf["tfdt"][0])
+
+            position = base
+            defaults = (default_duration,default_size,default_flags)
+            for trun in traf.get("trun",[]):
+                flags,data_offset,first_flags,samples = decode_trun(trun)
+                n = samples.shape[0]
+                names = samples.dtype.names or ()
+                if data_offset is not None:
+                    position = base + data_offset
+                if "duration" in names:
+                    duration = int(samples["duration"].sum())
+                else:
+                    duration = n*default_duration
+                self.track(track_id).add_trun(fragment,samples,defaults,first_flags,
+                                              position,decode_time,duration)
+                if "size" in names:
+                    position += int(samples["size"].sum())
+                else:
+                    position += n*default_size
+                # the next trun, if any, continues in time
+                decode_time = None
+            data_end = position
+
+    def tables(self):
+        """FragmentTable of every track, sorted by track_ID"""
+        out = []
+        for track_id in sorted(self.tracks.keys()):
+            t = self.tracks[track_id]
+            if not t.joined:
+                t.join()
+            out.append(t)
+        return out
+
+def fragment_tables(mp4):
+    """FragmentTable of every track of an Mp4File (or any list of root
+    atoms), scanning all of its moof boxes"""
+    index = FragmentIndex()
+    start = 0
+    for a in mp4:
+        if a.type == "moov":
+            index.add_moov(a)
+        elif a.type == "moof":
+            index.add_moof(a,start)
+        # top level atoms follow each other
+        start = a.offset() + a.size()
+    return index.tables()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Unit tests for fragments.py
+
+"""
+
+import atom
+import fragments
+import mp4file
+import os
+import struct
+import tempfile
+import unittest
+from sampletabletest import render_atom, render_full_atom, render_trak, \
+    render_table
+
+def render_trex(track_id, duration, size, flags):
+    return render_full_atom('trex',
+        struct.pack('>LLLLL', track_id, 1, duration, size, flags))
+
+def render_traf(track_id, samples, tfhd_flags=0, defaults=(), decode_time=None,
+                trun_flags=0, data_offset=None, first_sample_flags=None,
+                version=0):
+    tfhd = render_full_atom('tfhd',
+        struct.pack('>L', track_id) + ''.join([struct.pack('>L', d) for d in defaults]),
+        flags=tfhd_flags)
+    tfdt = ''
+    if decode_time is not None:
+        tfdt = render_full_atom('tfdt', struct.pack('>Q', decode_time), 1)
+    content = struct.pack('>L', len(samples))
+    if data_offset is not None:
+        trun_flags |= fragments.TRUN_DATA_OFFSET
+        content += struct.pack('>l', data_offset)
+    if first_sample_flags is not None:
+        trun_flags |= fragments.TRUN_FIRST_SAMPLE_FLAGS
+        content += struct.pack('>L', first_sample_flags)
+    for sample in samples:
+        content += ''.join([struct.pack('>l', value) for value in sample])
+    trun = render_full_atom('trun', content, version, trun_flags)
+    return render_atom('traf', tfhd + tfdt + trun)
+
+NON_SYNC = fragments.SAMPLE_IS_NON_SYNC_SAMPLE
+
+class DecodeFragments(unittest.TestCase):
+    def setUp(self):
+        empty = [
+            render_table('stts', '>LL', []),
+            render_table('stsc', '>LLL', []),
+            render_full_atom('stsz', struct.pack('>LL', 0, 0)),
+            render_table('stco', '>L', []),
+        ]
+        mvex = render_atom('mvex', render_trex(1, 100, 0, NON_SYNC)
+            + render_trex(2, 10, 4, 0))
+        moov = render_atom('moov', render_trak(empty, 1000, 1, 'vide')
+            + render_trak(empty, 48000, 2, 'soun') + mvex)
+        ftyp = render_atom('ftyp', 'isom\0\0\0\0')
+
+        # first fragment: video sizes and cts in the trun, first sample is
+        # a keyframe; audio all defaults, its data following the video
+        flags = fragments.TRUN_SAMPLE_SIZE | fragments.TRUN_SAMPLE_COMPOSITION_TIME_OFFSET
+        trafs = [
+            lambda offset: render_traf(1, [(30, 100), (20, -100), (10, 0)],
+                decode_time=0, trun_flags=flags, data_offset=offset,
+                first_sample_flags=0, version=1),
+            lambda offset: render_traf(2, [()] * 3, decode_time=0),
+        ]
+        # moof size does not depend on the data offset, render it twice
+        moof = render_atom('moof', render_full_atom('mfhd', struct.pack('>L', 1))
+            + ''.join([t(0) for t in trafs]))
+        moof = render_atom('moof', render_full_atom('mfhd', struct.pack('>L', 1))
+            + ''.join([t(len(moof) + 8) for t in trafs]))
+        mdat = render_atom('mdat', 'v' * 60 + 'a' * 12)
+
+        # second fragment: explicit durations and base offset, no tfdt
+        flags = fragments.TRUN_SAMPLE_DURATION | fragments.TRUN_SAMPLE_FLAGS
+        start = len(ftyp + moov + moof + mdat)
+        traf = lambda base: render_traf(1, [(50, 0), (50, NON_SYNC)],
+            fragments.TFHD_BASE_DATA_OFFSET | fragments.TFHD_DEFAULT_SAMPLE_SIZE,
+            (base >> 32, base & 0xffffffff, 8), trun_flags=flags)
+        mfhd = render_full_atom('mfhd', struct.pack('>L', 2))
+        moof2 = render_atom('moof', mfhd + traf(0))
+        moof2 = render_atom('moof', mfhd + traf(start + len(moof2) + 8))
+        data = ftyp + moov + moof + mdat + moof2
+        data += render_atom('mdat', 'w' * 16)
+
+        self.data = data
+        self.moof_starts = [len(ftyp + moov), start]
+        self.video_data = len(ftyp + moov + moof) + 8
+        (fd, self.path) = tempfile.mkstemp(suffix='.mp4')
+        os.write(fd, data)
+        os.close(fd)
+        self.mp4 = mp4file.Mp4File(self.path)
+        self.tables = fragments.fragment_tables(self.mp4)
+    
+    def tearDown(self):
+        self.mp4.close()
+        os.remove(self.path)
+        del self.tables
+    
+    def testTracks(self):
+        self.assertEqual([(t.track_id, t.handler_type, t.timescale) for t in self.tables],
+                         [(1, 'vide', 1000), (2, 'soun', 48000)])
+    
+    def testSizes(self):
+        video, audio = self.tables
+        self.assertEqual(list(video.sizes), [30, 20, 10, 8, 8])
+        self.assertEqual(list(audio.sizes), [4, 4, 4])
+    
+    def testOffsets(self):
+        video, audio = self.tables
+        base = self.video_data
+        self.assertEqual(list(video.offsets[:3]), [base, base + 30, base + 50])
+        self.assertEqual(list(audio.offsets), [base + 60, base + 64, base + 68])
+        self.mp4.stream.seek(video.offsets[3])
+        self.assertEqual(self.mp4.stream.read(16), 'w' * 16)
+    
+    def testTimestamps(self):
+        video, audio = self.tables
+        self.assertEqual(list(video.dts), [0, 100, 200, 300, 350])
+        self.assertEqual(list(video.pts), [100, 0, 200, 300, 350])
+        self.assertEqual(list(video.durations), [100, 100, 100, 50, 50])
+        self.assertEqual(list(audio.dts), [0, 10, 20])
+    
+    def testNegativeCompositionOffsetsInVersion0(self):
+        flags = fragments.TRUN_SAMPLE_SIZE | fragments.TRUN_SAMPLE_COMPOSITION_TIME_OFFSET
+        trun = render_full_atom('trun', struct.pack('>LLlLl', 2, 30, 100, 20, -100),
+                                0, flags)
+        (flags, data_offset, first_sample_flags, samples) = \
+            fragments.decode_trun(trun[8:])
+        self.assertEqual(list(samples['cts']), [100, -100])
+    
+    def testKeyframes(self):
+        video, audio = self.tables
+        self.assertEqual(list(video.keyframes), [True, False, False, True, False])
+        self.assertEqual(list(audio.keyframes), [True, True, True])
+    
+    def testFragments(self):
+        video, audio = self.tables
+        self.assertEqual(list(video.fragments), [0, 0, 0, 1, 1])
+        self.assertEqual(len(video), 5)
+    
+    def testMappedFile(self):
+        mp4 = mp4file.Mp4File(self.path, use_mmap=True, lazy=True)
+        video = fragments.fragment_tables(mp4)[0]
+        self.assertEqual(list(video.offsets), list(self.tables[0].offsets))
+        mp4.close()
+    
+    def testLazyOpenParsesAtomsAsReached(self):
+        with atom.AtomStats() as stats:
+            mp4 = mp4file.Mp4File(self.path, lazy=True)
+            self.assertEqual(0, stats.atoms)
+            for a in mp4:
+                if 'moov' == a.type:
+                    break
+            self.assertEqual(2, stats.atoms)
+            self.assertEqual(len(self.mp4), len(mp4))
+        self.assertEqual([a.type for a in self.mp4], [a.type for a in mp4])
+        mp4.close()
+    
+    def testIncremental(self):
+        index = fragments.FragmentIndex(self.mp4[1])
+        index.add_moof(self.mp4[2], self.moof_starts[0])
+        self.assertEqual(len(index.tables()[0]), 3)
+        index.add_moof(self.mp4[4], self.moof_starts[1])
+        video = index.tables()[0]
+        self.assertEqual(list(video.dts), [0, 100, 200, 300, 350])
+    
+    def testFollowGrowingFile(self):
+        (fd, path) = tempfile.mkstemp(suffix='.mp4')
+        index = fragments.FragmentIndex()
+        follower = mp4file.Mp4Follower(path, fragments=index)
+        try:
+            # moov and first moof, then a truncated mdat header
+            os.write(fd, self.data[:self.moof_starts[1] - 76])
+            self.assertEqual([a.type for a in follower.poll()],
+                             ['ftyp', 'moov', 'moof'])
+            self.assertEqual(len(index.tables()[0]), 3)
+            self.assertEqual(follower.poll(), [])
+            
+            # rest of the mdat, second moof cut in its middle
+            os.write(fd, self.data[self.moof_starts[1] - 76:self.moof_starts[1] + 20])
+            self.assertEqual([a.type for a in follower.poll()], ['mdat'])
+            
+            os.write(fd, self.data[self.moof_starts[1] + 20:])
+            self.assertEqual([a.type for a in follower.poll()], ['moof', 'mdat'])
+            self.assertEqual([a.type for a in follower],
+                             [a.type for a in self.mp4])
+            video = index.tables()[0]
+            self.assertEqual(list(video.offsets), list(self.tables[0].offsets))
+            self.assertEqual(list(video.dts), list(self.tables[0].dts))
+        finally:
+            os.close(fd)
+            follower.close()
+            os.remove(path)
+    
+    def testFollowWaitsForZeroSizeAtom(self):
+        (fd, path) = tempfile.mkstemp(suffix='.mp4')
+        follower = mp4file.Mp4Follower(path)
+        try:
+            # mdat being recorded, its size is only written at the end
+            os.write(fd, self.data[:self.moof_starts[0]] + '\0\0\0\0mdat' + 'x' * 16)
+            self.assertEqual([a.type for a in follower.poll()], ['ftyp', 'moov'])
+            self.assertEqual(follower.poll(), [])
+        finally:
+            os.close(fd)
+            follower.close()
+            os.remove(path)
+    
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,11 +6,21 @@
 # by Emanuele Ruffaldi 2017
 #
 # TODO: stts is in the codec nominal rate
+#
+# --all-tracks (implied by the binary formats) decodes the sample tables
+# of every track in one pass and writes them labelled as handler type and
+# track ID, eg. vide1 or soun2:
+# - npz: one file, <label>_dts/_pts/_durations in track units plus
+#   <label>_keyframes and <label>_timescale, and labels listing the tracks
+# - npy: one file per track, the timestamp and duration columns (s) of the
+#   text output as float64
+# - txt: one file per track, as the single stream output
 import sys
 import os
-import struct
 from mp4file import Mp4File
 from atom import Atom
+from sampletable import atom_content, decode_stts, sample_tables
+from fragments import fragment_tables
 import numpy as np
 try:
     import cv2
@@ -18,7 +28,7 @@ except:
     cv2 = None
 
 class Mp4DurationExtractor:
-    def __init__(self,mp4,ofp,stream,verbose):
+    def __init__(self,mp4,ofp,stream,verbose,withtimestamps=False):
         self.mp4 = mp4
         self.tstream = stream
         self.istream = 0
@@ -26,6 +36,8 @@ class Mp4DurationExtractor:
         self.timeunit_hz = 0 # long unsigned time unit per second
         self.duration = 0 # in seconds
         self.ofp = ofp # output filename
+        self.withtimestamps = withtimestamps # emit timestamp and duration columns
+        self.timestamps = None # decode timestamps of the last stts in track units
         self.verbose = True
         self.found = False
     def run(self):
@@ -41,98 +53,58 @@ class Mp4DurationExtractor:
         if self.verbose:
             print "atom",s,a.type,a.offset()
         if a.type == "elst":
-            fp = a._Atom__source_stream
-            fp.seek(a.offset(),0)
-            v1,n = struct.unpack(">LL",fp.read(8))
-            for i in range(0,n):
-                if v1 == 1:
-                    d,mt =  struct.unpack(">QQ",fp.read(16))
-                else:
-                    d,mt =  struct.unpack(">LL",fp.read(8))
-                media_rate_integer,media_rate_fraction =  struct.unpack(">HH",fp.read(4))
+            for e in a.decode().entries:
                 if self.verbose:
-                    print "\telst",d,mt,media_rate_integer,media_rate_fraction
+                    print "\telst",e.segment_duration,e.media_time,e.media_rate
         elif a.type == "mvhd":
-            fp = a._Atom__source_stream
-            fp.seek(a.offset(),0)
-            v1 = struct.unpack(">L",fp.read(4))[0]
+            h = a.decode()
             if self.verbose:
-                print a.type,"version",v1
-            if v1 == 1:
-                created_t,modified_t = struct.unpack(">QQ",fp.read(16))
-                tss = 8
-            else:
-                created_t,modified_t = struct.unpack(">LL",fp.read(8))
-                tss = 4
-            self.timeunit_hz = struct.unpack(">L",fp.read(4))[0]
+                print a.type,"version",h.version
+            self.timeunit_hz = h.timescale
+            self.duration = h.duration
+            self.rate = h.rate
             if self.verbose:
                 print a.type,"timebase (Hz)",self.timeunit_hz
-            if v1 == 1:
-                self.duration = struct.unpack(">Q",fp.read(8))[0]
-                tss = 8
-            else:
-                self.duration = struct.unpack(">L",fp.read(4))[0]
-                tss = 4
-            self.rate = struct.unpack(">H",fp.read(2))[0]
-            if self.verbose:
                 print a.type,"duration (units)",self.duration   
                 print a.type,"duration (s)",self.duration/float(self.timeunit_hz)
                 print a.type,"playback rate",self.rate   
         elif a.type == "mdhd":
-            fp = a._Atom__source_stream
-            fp.seek(a.offset(),0)
-            v1 = struct.unpack(">L",fp.read(4))[0]
+            h = a.decode()
             if self.verbose:
-                print a.type,"version",v1
-            if v1 == 1:
-                created_t,modified_t = struct.unpack(">QQ",fp.read(16))
-                tss = 8
-            else:
-                created_t,modified_t = struct.unpack(">LL",fp.read(8))
-                tss = 4
-            self.track_timeunit_hz = struct.unpack(">L",fp.read(4))[0]
+                print a.type,"version",h.version
+            self.track_timeunit_hz = h.timescale
+            self.track_duration = h.duration
             if self.verbose:
                 print a.type,"track timebase (Hz)",self.track_timeunit_hz
-            if v1 == 1:
-                self.track_duration = struct.unpack(">Q",fp.read(8))[0]
-                tss = 8
-            else:
-                self.track_duration = struct.unpack(">L",fp.read(4))[0]
-                tss = 4
-            self.track_rate = struct.unpack(">H",fp.read(2))[0]
-            if self.verbose:
                 print a.type,"track duration (units)",self.track_duration   
                 print a.type,"track duration (s)",self.track_duration/float(self.track_timeunit_hz)
-                print a.type,"track playback rate",self.track_rate           
         elif a.type == "stts":
             #ISO/IEC 14496-12 Section 8.15.2.1 Definition
             #http://l.web.umkc.edu/lizhu/teaching/2016sp.video-communication/ref/mp4.pdf
             if self.verbose:
                 print "found atom stts"
-            fp = a._Atom__source_stream
-            fp.seek(a.offset(),0)
-            # 4bytes=0
-            # uint32 entries
-            # entry[entries] as: duration (in base units), count
-           
-            v1,n= struct.unpack(">LL",fp.read(8))
-            dt = np.dtype(">i4")
-            pi = np.reshape(np.fromfile(fp,dtype=dt,count=n*2),(n,2))
-            pd = pi.astype(np.float64)
-            pd[:,1] *= (1.0/(self.track_timeunit_hz))  # Note asumption of 30Hz
-            tot = np.sum(pi[:,0])
-            dur = np.sum(pi[:,0] * pd[:,1])
-            out = np.zeros((tot,1),dtype=np.float64)
-            k = 0
-            for i in range(0,pd.shape[0]):
-                w = int(pd[i,0])
-                out[k:k+w] = pd[i,1]
-                k += w
+            # entries are unsigned: decode_stts widens them to int64 so that
+            # neither large deltas nor the running sum of long recordings
+            # can wrap
+            counts,deltas = decode_stts(atom_content(a))
+            # expand the run-length table to one duration per frame
+            units = np.repeat(deltas,counts)
+            # absolute decode timestamps (in track units) of each frame
+            ends = np.cumsum(units)
+            self.timestamps = ends - units
+            out = np.reshape(units * (1.0/(self.track_timeunit_hz)),(units.shape[0],1))
+            dur = np.sum(counts * deltas) / float(self.track_timeunit_hz)
             if self.verbose:
                 print "estimated duration from expanded (s)",np.sum(out)
                 print "estimated duration from sum (s)",dur
+                if units.shape[0] > 0:
+                    print "estimated duration from timestamps (s)",ends[-1]/float(self.track_timeunit_hz)
             if self.istream == self.tstream:
-                np.savetxt(open(self.ofp,"wb"),out)
+                if self.withtimestamps:
+                    out = np.concatenate((np.reshape(self.timestamps * (1.0/(self.track_timeunit_hz)),out.shape),out),axis=1)
+                f = open(self.ofp,"wb")
+                np.savetxt(f,out)
+                f.close()
                 print "emitted stream",self.istream
             else:
                 print "skipped stream",self.istream
@@ -147,6 +119,139 @@ class Mp4DurationExtractor:
                         return True
             return False
 
+def track_label(t):
+    """Label of a SampleTable or FragmentTable, handler type and track ID"""
+    return "%s%d" % (t.handler_type or "trak",t.track_id)
+
+def timing_tables(mp4):
+    """Tables of every track, from the moof boxes in fragmented files"""
+    if any([a.type == "moof" for a in mp4]):
+        return fragment_tables(mp4)
+    return sample_tables(mp4)
+
+def track_columns(t,withtimestamps):
+    """Duration column (s), after the decode timestamp one if asked, as
+    in the text output"""
+    out = np.reshape(t.seconds(t.durations),(len(t),1))
+    if withtimestamps:
+        out = np.concatenate((np.reshape(t.seconds(t.dts),out.shape),out),axis=1)
+    return out
+
+def export_timings(tables,ofp,format="npz",withtimestamps=False):
+    """Writes the timings of all the tables, to ofp for npz and to
+    ofp.<label>.<format> otherwise. Every file is written as .tmp first;
+    returns the list of (tmp,final) names left to rename"""
+    if format == "npz":
+        arrays = dict(labels=np.array([track_label(t) for t in tables]))
+        for t in tables:
+            label = track_label(t)
+            arrays[label+"_dts"] = t.dts
+            arrays[label+"_pts"] = t.pts
+            arrays[label+"_durations"] = t.durations
+            arrays[label+"_keyframes"] = t.keyframes
+            arrays[label+"_timescale"] = np.int64(t.timescale)
+        # a file object, savez would append .npz to the name
+        out = open(ofp+".tmp","wb")
+        np.savez(out,**arrays)
+        out.close()
+        return [(ofp+".tmp",ofp)]
+    written = []
+    try:
+        for t in tables:
+            name = "%s.%s.%s" % (ofp,track_label(t),format)
+            written.append((name+".tmp",name))
+            out = open(name+".tmp","wb")
+            if format == "npy":
+                np.save(out,track_columns(t,withtimestamps))
+            else:
+                np.savetxt(out,track_columns(t,withtimestamps))
+            out.close()
+    except:
+        for tmp,name in written:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        raise
+    return written
+
+def process_file(job):
+    """Extracts the durations of one file, writing ofp transactionally
+    through ofp.tmp. Returns (name,success,message); kept at top level so
+    that it can be sent to a process pool"""
+    fp,ofp,x,mode,stream,verbose,timestamps,format,all_tracks = job
+    print "doing",fp
+    try:
+        result = extract_file(job)
+    except Exception as e:
+        result = (x,False,"%s: %s" % (type(e).__name__,e))
+    # a failed job leaves no partial output behind
+    if not result[1] and os.path.exists(ofp+".tmp"):
+        os.remove(ofp+".tmp")
+    return result
+
+def extract_file(job):
+    """process_file without the error handling"""
+    fp,ofp,x,mode,stream,verbose,timestamps,format,all_tracks = job
+    if mode == "opencv":
+        if cv2 is None:
+            return (x,False,"OpenCV not available")
+        try:
+            cap = cv2.VideoCapture(fp)
+        except:
+            return (x,False,"bad "+fp)
+        out = open(ofp+".tmp","w")
+        iframe = 1
+        while True:
+            ret, frame = cap.read()
+            if ret == 0:
+                break
+            now = cap.get(cv2.cv.CV_CAP_PROP_POS_MSEC)
+            out.write("%d %d\n" % (iframe,now))
+            iframe = iframe + 1
+            if (iframe % 10000) == 0:
+                print "\t",iframe
+        out.close()
+        cap.release()
+        # transactional
+        os.rename(ofp+".tmp",ofp)
+        print "done",x
+        return (x,True,"%d frames" % (iframe-1))
+    elif mode == "ffmpeg":      
+        print "ffmpeg mode",x          
+        r = os.system("ffprobe -i \"%s\" -show_frames -show_entries frame=pkt_pts_time -of csv=p=0 > \"%s\"" % (fp,ofp+".tmp"))
+        if r != 0:
+            return (x,False,"ffprobe failed with %d" % r)
+        os.rename(ofp+".tmp",ofp)
+        print "done",x
+        return (x,True,"")
+    elif mode == "mp4" and (all_tracks or format != "txt"):
+        mp4file = Mp4File(fp,use_mmap=True,lazy=True)
+        try:
+            tables = timing_tables(mp4file)
+            if len(tables) == 0:
+                return (x,False,"no tracks found")
+            written = export_timings(tables,ofp,format,timestamps)
+        finally:
+            mp4file.close()
+        # transactional
+        for tmp,name in written:
+            os.rename(tmp,name)
+        print "done",x
+        return (x,True,"%d tracks" % len(tables))
+    elif mode == "mp4":
+        mp4file = Mp4File( fp )
+        try:
+            ee = Mp4DurationExtractor(mp4file,ofp+".tmp",stream,verbose,timestamps)
+            found = ee.run()
+        finally:
+            mp4file.close()
+        if found:
+            print "run"
+            os.rename(ofp+".tmp",ofp)
+            return (x,True,"")
+        return (x,False,"no stts found")
+    else:
+        return (x,False,"Unknown mode "+mode)
+
 def main():
     import argparse 
 
@@ -155,7 +260,11 @@ def main():
     parser.add_argument("outputpath")
     parser.add_argument("--verbose",action="store_true")
     parser.add_argument("--stream",type=int,default=0)
+    parser.add_argument("--timestamps",action="store_true",help="emits decode timestamp and duration (s) per frame")
     parser.add_argument("--mode",default="mp4",choices=("mp4","opencv","ffmpeg"))
+    parser.add_argument("--all-tracks",action="store_true",help="exports every track in one pass (mp4 mode)")
+    parser.add_argument("--format",default="txt",choices=("txt","npy","npz"),help="npy and npz imply --all-tracks")
+    parser.add_argument("--jobs",type=int,default=1,help="number of files processed in parallel")
 
     args = parser.parse_args()
     path = args.input
@@ -168,50 +277,31 @@ def main():
     else:
         paths = os.listdir(path) 
     print "processing",len(paths),"in",path
+    jobs = []
     for x in paths:
         fp = os.path.join(path,x)
         ofp = os.path.join(outpath,x+".time")
+        if mode == "mp4" and args.format == "npz":
+            ofp += ".npz"
         if x.endswith(".mp4"):
             #if os.path.isfile(ofp):
             #    continue
-            print "doing",fp
-            if mode == "opencv":
-                if cv2 is None:
-                    print "OpenCV not available"
-                    continue
-                try:
-                    cap = cv2.VideoCapture(fp)
-                except:
-                    print "bad",fp
-                    continue
-                out = open(ofp+".tmp","w")
-                iframe = 1
-                while True:
-                    ret, frame = cap.read()
-                    if ret == 0:
-                        break
-                    now = cap.get(cv2.cv.CV_CAP_PROP_POS_MSEC)
-                    out.write("%d %d\n" % (iframe,now))
-                    iframe = iframe + 1
-                    if (iframe % 10000) == 0:
-                        print "\t",iframe
-                # transactional
-                os.rename(ofp+".tmp",ofp)
-                print "done",x
-                out.close()
-                cap.release()
-            elif mode == "ffmpeg":      
-                print "ffmpeg mode",x          
-                os.system("ffprobe -i \"%s\" -show_frames -show_entries frame=pkt_pts_time -of csv=p=0 > \"%s\"" % (fp,ofp+".tmp"))
-                os.rename(ofp+".tmp",ofp)
-                print "done",x
-            elif mode == "mp4":
-                mp4file = Mp4File( fp )
-                ee = Mp4DurationExtractor(mp4file,ofp+".tmp",args.stream,args.verbose)
-                if ee.run():
-                    print "run"
-                    os.rename(ofp+".tmp",ofp)
-            else:
-                print "Unknown mode",mode
+            jobs.append((fp,ofp,x,mode,args.stream,args.verbose,args.timestamps,args.format,args.all_tracks))
+
+    if args.jobs > 1 and len(jobs) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(args.jobs,len(jobs)))
+        # one file at a time per worker, collected as they complete
+        results = list(pool.imap_unordered(process_file,jobs,chunksize=1))
+        pool.close()
+        pool.join()
+    else:
+        results = [process_file(job) for job in jobs]
+
+    failed = [r for r in results if not r[1]]
+    print "summary:",len(results)-len(failed),"done",len(failed),"failed"
+    for x,ok,message in failed:
+        print "failed",x,message
+    return len(failed) == 0
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(0 if main() else 1)
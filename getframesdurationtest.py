@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Unit tests for getframesduration.py
+
+"""
+
+import getframesduration
+import mp4synth
+import numpy
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+class ExportAllTracks(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'in.mp4')
+        self.tracks = mp4synth.synthesize(self.path, tracks=2, samples=50,
+                                          jitter=True)
+        self.ofp = os.path.join(self.directory, 'in.mp4.time')
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def process(self, format, path=None, timestamps=False):
+        return getframesduration.process_file((path or self.path, self.ofp,
+                                               'in.mp4', 'mp4', 0, False,
+                                               timestamps, format, True))
+    
+    def testNpzHoldsEveryTrack(self):
+        self.assertEqual(self.process('npz'), ('in.mp4', True, '2 tracks'))
+        out = numpy.load(self.ofp)
+        self.assertEqual(list(out['labels']), ['vide1', 'soun2'])
+        for (label, track) in zip(out['labels'], self.tracks):
+            self.assertEqual(list(out[label + '_durations']),
+                             list(track.durations))
+            self.assertEqual(list(out[label + '_keyframes']),
+                             list(track.keyframes))
+            self.assertEqual(int(out[label + '_timescale']), track.timescale)
+        self.assertEqual(out['vide1_dts'][2], 6001)
+        self.assertEqual(out['vide1_pts'][2], 9001)
+        self.assertFalse(os.path.exists(self.ofp + '.tmp'))
+    
+    def testNpyAndTextPerTrack(self):
+        self.process('npy', timestamps=True)
+        self.process('txt', timestamps=True)
+        for (label, track) in (('vide1', self.tracks[0]),
+                               ('soun2', self.tracks[1])):
+            expected = numpy.column_stack((
+                (numpy.cumsum(track.durations) - track.durations),
+                track.durations)) / float(track.timescale)
+            npy = numpy.load('%s.%s.npy' % (self.ofp, label))
+            txt = numpy.loadtxt('%s.%s.txt' % (self.ofp, label))
+            self.assertTrue(numpy.allclose(npy, expected))
+            self.assertTrue(numpy.allclose(txt, expected))
+    
+    def testFailedJobLeavesNoTemporaryFile(self):
+        path = os.path.join(self.directory, 'bad.mp4')
+        f = open(path, 'wb')
+        f.write(mp4synth.box('free', ''))
+        f.close()
+        for format in ('txt', 'npz'):
+            open(self.ofp + '.tmp', 'wb').close()
+            (name, success, message) = getframesduration.process_file((path,
+                self.ofp, 'bad.mp4', 'mp4', 0, False, False, format,
+                format != 'txt'))
+            self.assertFalse(success)
+            self.assertFalse(os.path.exists(self.ofp + '.tmp'))
+    
+    def testFragmentedFile(self):
+        path = os.path.join(self.directory, 'fragmented.mp4')
+        tracks = mp4synth.synthesize(path, tracks=2, samples=50, fragments=4)
+        self.process('npz', path)
+        out = numpy.load(self.ofp)
+        self.assertEqual(list(out['soun2_durations']),
+                         list(tracks[1].durations))
+        self.assertEqual(out['soun2_dts'][-1], 49 * 1024)
+    
+class ExtractDurations(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'in.mp4')
+        self.ofp = os.path.join(self.directory, 'in.mp4.time')
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def testDurationsPastThirtyOneBits(self):
+        # deltas above 2**31 and a total above 2**32 track units
+        track = mp4synth.SyntheticTrack(1, 5, delta=3000000000)
+        track.durations[1::2] = 2**32 - 1
+        f = open(self.path, 'wb')
+        mp4synth.write_progressive(f, [track])
+        f.close()
+        
+        self.assertTrue(getframesduration.process_file((self.path, self.ofp,
+            'in.mp4', 'mp4', 0, False, True, 'txt', False))[1])
+        out = numpy.loadtxt(self.ofp)
+        durations = numpy.array([3000000000, 2**32 - 1] * 2 + [3000000000])
+        self.assertTrue(numpy.allclose(out[:, 1],
+                                       durations / float(track.timescale)))
+        self.assertTrue(numpy.allclose(out[:, 0],
+            (numpy.cumsum(durations) - durations) / float(track.timescale)))
+    
+class ProcessDirectory(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.input = os.path.join(self.directory, 'in')
+        self.output = os.path.join(self.directory, 'out')
+        os.mkdir(self.input)
+        os.mkdir(self.output)
+        self.tracks = {}
+        for name in ('a.mp4', 'b.mp4', 'c.mp4'):
+            self.tracks[name] = mp4synth.synthesize(
+                os.path.join(self.input, name), samples=20 + len(self.tracks))
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def run_jobs(self):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'getframesduration.py')
+        devnull = open(os.devnull, 'w')
+        status = subprocess.call([sys.executable, script, self.input,
+                                  self.output, '--jobs', '2'], stdout=devnull)
+        devnull.close()
+        return status
+    
+    def testJobsProcessEveryFile(self):
+        self.assertEqual(0, self.run_jobs())
+        for (name, tracks) in self.tracks.items():
+            out = numpy.loadtxt(os.path.join(self.output, name + '.time'))
+            self.assertEqual(len(tracks[0]), len(out))
+    
+    def testFailedJobSetsExitStatus(self):
+        open(os.path.join(self.input, 'bad.mp4'), 'wb').write(
+            mp4synth.box('free', ''))
+        
+        self.assertEqual(1, self.run_jobs())
+        self.assertEqual(sorted(['a.mp4.time', 'b.mp4.time', 'c.mp4.time']),
+                         sorted(os.listdir(self.output)))
+    
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+# Cache of parsed MP4 structures
+#
+# Files that are opened again and again need not be parsed each time: the
+# atom layout (an AtomIndex) and the decoded sample tables of a file are
+# kept under (path, size, mtime), so any change to the file invalidates
+# them. Entries live in an in-process LRU bounded by a byte budget and,
+# optionally, in sidecar files on disk that survive the process.
+#
+# Sidecars are npz files of plain arrays plus a JSON header, read back with
+# allow_pickle=False: a sidecar dropped in a shared directory can at worst
+# be a miss, never run code.
+
+import os
+import hashlib
+import json
+from array import array
+from collections import OrderedDict
+import numpy as np
+from atomindex import AtomIndex
+from mp4file import Mp4File
+from sampletable import SampleTable, sample_tables
+
+SIDECAR_VERSION = 1
+INDEX_ARRAYS = (("types","I"),("offsets","L"),("sizes","L"),("header_sizes","B"),("parents","i"),("depths","B"))
+
+class _Bare:
+    pass
+
+def bare(cls):
+    """Instance of the (old style) class cls without running __init__"""
+    o = _Bare()
+    o.__class__ = cls
+    return o
+
+def encode_sidecar(entry):
+    """(header,arrays) of a CachedLayout, see decode_sidecar"""
+    index = entry.index
+    header = dict(version=SIDECAR_VERSION,key=repr(entry.key),end=index._AtomIndex__end,tables=None)
+    arrays = {}
+    for name,code in INDEX_ARRAYS:
+        arrays["index_"+name] = np.array(getattr(index,name),dtype=np.dtype(code))
+    if entry.tables is not None:
+        header["tables"] = []
+        for i,t in enumerate(entry.tables):
+            names = sorted([k for k,v in t.__dict__.items() if isinstance(v,np.ndarray)])
+            # handler types are four raw bytes, latin-1 keeps them in JSON
+            handler_type = t.handler_type
+            if handler_type is not None:
+                handler_type = handler_type.decode("latin-1")
+            header["tables"].append(dict(track_id=t.track_id,handler_type=handler_type,timescale=t.timescale,arrays=names))
+            for k in names:
+                arrays["table%d_%s" % (i,k)] = getattr(t,k)
+    return header,arrays
+
+def decode_sidecar(header,arrays):
+    """CachedLayout from the header and arrays of encode_sidecar"""
+    index = AtomIndex.__new__(AtomIndex)
+    index.stream = None
+    index._AtomIndex__end = header["end"]
+    for name,code in INDEX_ARRAYS:
+        a = array(code)
+        a.fromstring(arrays["index_"+name].astype(code).tostring())
+        setattr(index,name,a)
+    entry = CachedLayout(None,index)
+    if header["tables"] is not None:
+        entry.tables = []
+        for i,h in enumerate(header["tables"]):
+            t = bare(SampleTable)
+            t.trak = None
+            t.track_id = h["track_id"]
+            t.timescale = h["timescale"]
+            t.handler_type = h["handler_type"]
+            if t.handler_type is not None:
+                t.handler_type = t.handler_type.encode("latin-1")
+            for k in h["arrays"]:
+                setattr(t,str(k),arrays["table%d_%s" % (i,k)])
+            entry.tables.append(t)
+    return entry
+
+class CachedLayout:
+    """Parsed structure of one file: its AtomIndex and, once decoded, the
+    SampleTable of each track"""
+    def __init__(self,key,index):
+        self.key = key
+        self.index = index
+        self.tables = None
+
+    def nbytes(self):
+        """Approximate memory held by the entry"""
+        index = self.index
+        n = 0
+        for a in (index.types,index.offsets,index.sizes,index.header_sizes,index.parents,index.depths):
+            n += len(a) * a.itemsize
+        for t in self.tables or []:
+            for v in t.__dict__.values():
+                if isinstance(v,np.ndarray):
+                    n += v.nbytes
+        return n
+
+class Mp4Cache:
+    def __init__(self,max_bytes=64*1024*1024,sidecar_dir=None):
+        """max_bytes bounds the in-process tier. With sidecar_dir entries are
+        also saved there, one file per entry."""
+        self.max_bytes = max_bytes
+        self.sidecar_dir = sidecar_dir
+        self.entries = OrderedDict() # least recently used first
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def key(self,path):
+        st = os.stat(path)
+        return (os.path.abspath(path),st.st_size,st.st_mtime)
+
+    def layout(self,path):
+        """CachedLayout of path, parsing the file only on a miss of both tiers"""
+        key = self.key(path)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.load_sidecar(key)
+        if entry is None:
+            self.misses += 1
+            fp = open(path,"rb")
+            index = AtomIndex(fp)
+            fp.close()
+            index.stream = None
+            entry = CachedLayout(key,index)
+            self.save_sidecar(entry)
+        else:
+            self.hits += 1
+        self.store(entry)
+        return entry
+
+    def open(self,path,use_mmap=False):
+        """Mp4File of path built from the cached layout, without parsing"""
+        return Mp4File(path,use_mmap=use_mmap,index=self.layout(path).index)
+
+    def sample_tables(self,path):
+        """SampleTable of every track of path, decoded only once"""
+        entry = self.layout(path)
+        if entry.tables is None:
+            mp4 = Mp4File(path,index=entry.index)
+            entry.tables = sample_tables(mp4)
+            mp4.close()
+            for t in entry.tables:
+                t.trak = None # do not pin the atom tree and its stream
+            self.store(entry)
+            self.save_sidecar(entry)
+        return entry.tables
+
+    def store(self,entry):
+        """(Re)inserts entry as the most recently used, evicting as needed"""
+        old = self.entries.pop(entry.key,None)
+        if old is not None:
+            self.nbytes -= old.size
+        entry.size = entry.nbytes()
+        self.entries[entry.key] = entry
+        self.nbytes += entry.size
+        # always keep the entry just used, even if alone it is over budget
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            key,evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted.size
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def sidecar_path(self,key):
+        return os.path.join(self.sidecar_dir,hashlib.sha1(repr(key)).hexdigest()+".mp4cache")
+
+    def load_sidecar(self,key):
+        if self.sidecar_dir is None:
+            return None
+        try:
+            f = open(self.sidecar_path(key),"rb")
+        except IOError:
+            return None
+        try:
+            data = np.load(f,allow_pickle=False)
+            header = json.loads(data["header"].tostring())
+            if header["version"] != SIDECAR_VERSION or header["key"] != repr(key):
+                return None
+            entry = decode_sidecar(header,data)
+        except Exception:
+            # unreadable sidecars are just misses, they get rewritten
+            return None
+        finally:
+            f.close()
+        entry.key = key
+        return entry
+
+    def save_sidecar(self,entry):
+        if self.sidecar_dir is None:
+            return
+        p = self.sidecar_path(entry.key)
+        header,arrays = encode_sidecar(entry)
+        arrays["header"] = np.frombuffer(json.dumps(header),dtype=np.uint8)
+        # a file object, savez would append .npz to the name
+        f = open(p+".tmp","wb")
+        np.savez(f,**arrays)
+        f.close()
+        # transactional
+        os.rename(p+".tmp",p)
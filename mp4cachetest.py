@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Unit tests for mp4cache.py
+
+"""
+
+import atom
+import atomindex
+import cPickle
+import mp4cache
+from mp4file import Mp4File
+import numpy
+import os
+import shutil
+from sampletabletest import render_atom, render_full_atom, render_table, \
+    render_trak
+import struct
+import tempfile
+import unittest
+
+class CacheParsedFiles(unittest.TestCase):
+    sizes = [3, 4, 5]
+    
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'a.mp4')
+        self.other_path = os.path.join(self.directory, 'b.mp4')
+        
+        tables = [
+            render_table('stts', '>LL', [(len(self.sizes), 10)]),
+            render_full_atom('stsz', struct.pack('>LL', 0, len(self.sizes))
+                + ''.join([struct.pack('>L', s) for s in self.sizes])),
+            render_table('stsc', '>LLL', [(1, len(self.sizes), 1)]),
+            render_table('stco', '>L', [(8,)]),
+        ]
+        rendered = render_atom('mdat', 'x' * sum(self.sizes)) \
+            + render_atom('moov', render_trak(tables))
+        for path in (self.path, self.other_path):
+            open(path, 'wb').write(rendered)
+        
+        self.parses = 0
+        self.initial_parse_atom_header = atom.parse_atom_header
+        self.initial_unpack_atom_header = atomindex.unpack_atom_header
+        atom.parse_atom_header = self.counting(atom.parse_atom_header)
+        atomindex.unpack_atom_header = self.counting(atomindex.unpack_atom_header)
+        
+        self.cache = mp4cache.Mp4Cache()
+    
+    def tearDown(self):
+        atom.parse_atom_header = self.initial_parse_atom_header
+        atomindex.unpack_atom_header = self.initial_unpack_atom_header
+        shutil.rmtree(self.directory)
+    
+    def counting(self, function):
+        def counted(*args):
+            self.parses += 1
+            return function(*args)
+        return counted
+    
+    def testOpenMatchesParsedFile(self):
+        self.assertEqual(Mp4File(self.path), self.cache.open(self.path))
+    
+    def testWarmOpenSkipsParsing(self):
+        self.cache.open(self.path)
+        self.parses = 0
+        mp4 = self.cache.open(self.path)
+        mp4[1][0][1][2][0].get_children_of_type('stts')
+        
+        self.assertEqual(0, self.parses)
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(1, self.cache.misses)
+    
+    def testSampleTablesAreDecodedOnce(self):
+        tables = self.cache.sample_tables(self.path)
+        
+        self.assertEqual(1, len(tables))
+        self.assertEqual([8, 11, 15], list(tables[0].offsets))
+        self.assertTrue(tables is self.cache.sample_tables(self.path))
+    
+    def testModifiedFileIsParsedAgain(self):
+        self.cache.open(self.path)
+        stat = os.stat(self.path)
+        os.utime(self.path, (stat.st_atime, stat.st_mtime + 10))
+        self.cache.open(self.path)
+        
+        self.assertEqual(2, self.cache.misses)
+    
+    def testLeastRecentlyUsedIsEvicted(self):
+        self.cache.open(self.path)
+        self.cache.max_bytes = self.cache.nbytes
+        self.cache.open(self.other_path)
+        
+        self.assertEqual(1, len(self.cache.entries))
+        self.cache.open(self.other_path)
+        self.assertEqual(1, self.cache.hits)
+    
+    def testSidecarSurvivesProcess(self):
+        cache = mp4cache.Mp4Cache(sidecar_dir=self.directory)
+        tables = cache.sample_tables(self.path)
+        self.parses = 0
+        
+        cache = mp4cache.Mp4Cache(sidecar_dir=self.directory)
+        self.assertEqual(list(tables[0].offsets),
+                         list(cache.sample_tables(self.path)[0].offsets))
+        self.assertEqual(Mp4File(self.path), cache.open(self.path))
+        self.assertEqual(0, cache.misses)
+    
+    def testSidecarHoldsNoPickles(self):
+        cache = mp4cache.Mp4Cache(sidecar_dir=self.directory)
+        cache.sample_tables(self.path)
+        
+        sidecar = numpy.load(cache.sidecar_path(cache.key(self.path)),
+                             allow_pickle=False)
+        for name in sidecar.files:
+            self.assertNotEqual(object, sidecar[name].dtype)
+    
+    def testPickledSidecarIsMiss(self):
+        cache = mp4cache.Mp4Cache(sidecar_dir=self.directory)
+        open(cache.sidecar_path(cache.key(self.path)), 'wb').write(
+            cPickle.dumps(cache.layout(self.other_path)))
+        
+        cache = mp4cache.Mp4Cache(sidecar_dir=self.directory)
+        cache.open(self.path)
+        self.assertEqual(1, cache.misses)
+    
+
+
+if __name__ == "__main__":
+    unittest.main()
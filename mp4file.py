@@ -5,16 +5,161 @@ __author__ = "Steve Marshall (steve@nascentguruism.com)"
 __copyright__ = "Copyright (c) 2008 Steve Marshall"
 __license__ = "Python"
 
-from atom import Atom
+from atom import ATOM_HEADER_STRUCT, Atom, MappedStream, unpack_atom_header
+from atompath import TypeIndex, compile_path
 import os
 
 class Mp4File(list):
-    def __init__(self, file):
-        fh = open(file, 'rb')
-        size = os.stat(file).st_size
-        while fh.tell() < size:
-            root_atom = Atom( stream=fh, offset=fh.tell() )
+    def __init__(self, file, use_mmap=False, lazy=False, index=None):
+        # A mapped file is parsed in place: only the pages holding atom
+        # headers get touched, and data reads are zero-copy slices
+        if use_mmap:
+            fh = MappedStream(file)
+        else:
+            fh = open(file, 'rb')
+        self.stream = fh
+        self.lazy = lazy or index is not None
+        self.type_index = None
+        
+        # With an AtomIndex of the file (eg. from a cache) nothing needs
+        # parsing at all: the tree is built from the index on demand
+        if index is not None:
+            self.__position = self.__size = 0
+            for i in index.roots():
+                self.append( index.atom( i, fh ) )
+            return
+        
+        # Opened lazily, top-level atoms are only parsed as they are reached
+        # (see __iter__), so opening costs nothing whatever the file holds;
+        # otherwise the whole tree is parsed now
+        self.__position = 0
+        self.__size = os.stat(file).st_size
+        if not lazy:
+            self.__scan()
+    
+    def __scan(self, count=None):
+        # Parse top-level atoms until there are <count> of them, or all
+        fh = self.stream
+        while self.__position < self.__size \
+        and (count is None or list.__len__(self) < count):
+            root_atom = Atom( stream=fh, offset=self.__position,
+                              lazy=self.lazy )
             root_atom.seek( 0, os.SEEK_END )
-            self.append( root_atom )
+            self.__position = fh.tell()
+            list.append( self, root_atom )
+    
+    def __iter__(self):
+        i = 0
+        while True:
+            if list.__len__(self) <= i:
+                self.__scan(i + 1)
+                if list.__len__(self) <= i:
+                    return
+            yield list.__getitem__(self, i)
+            i += 1
+    
+    def find(self, path, indexed=True):
+        """Atoms matching <path>, eg. 'moov/trak[handler=vide]/**/stts'
+           (see atompath). Unless the file was opened lazily or <indexed>
+           is False, the first query indexes the atoms by type for the
+           following ones. Edits of the top-level atoms drop the index, but
+           edits further down the tree (eg. remap_chunk_offsets turning
+           stco into co64) are not seen: call reindex() after them, or
+           query with indexed=False.
+        """
+        if self.lazy or not indexed:
+            return compile_path(path).find(self)
+        if self.type_index is None:
+            self.reindex()
+        return compile_path(path).find(self, self.type_index)
+    
+    def reindex(self):
+        self.type_index = TypeIndex(self)
+    
+    def close(self):
+        self.stream.close()
     
 
+def _scanning(name, edits=False):
+    # Everything but iteration needs all the top-level atoms first, and
+    # edits make the type index stale
+    method = getattr(list, name)
+    def scanning(self, *args, **kwargs):
+        self._Mp4File__scan()
+        if edits:
+            self.type_index = None
+        return method(self, *args, **kwargs)
+    scanning.__name__ = name
+    return scanning
+
+for name in ('__len__', '__getitem__', '__getslice__', '__contains__',
+             '__reversed__', '__repr__', '__eq__', '__ne__', 'count', 'index'):
+    setattr(Mp4File, name, _scanning(name))
+for name in ('append', 'extend', 'insert', 'pop', 'remove', 'reverse', 'sort',
+             '__setitem__', '__setslice__', '__delitem__', '__delslice__'):
+    setattr(Mp4File, name, _scanning(name, edits=True))
+del name
+
+
+class Mp4Follower(list):
+    """Top-level atoms of a file that is still being written. Each poll()
+       parses only the atoms appended since the previous one; an atom that
+       is not fully written yet is left for a later poll, not reported as
+       corrupt. Moov and moof atoms are passed to <fragments> (eg. a
+       fragments.FragmentIndex) as they are found.
+    """
+    def __init__(self, file, lazy=False, fragments=None):
+        if isinstance(file, basestring):
+            file = open(file, 'rb')
+        self.stream = file
+        self.lazy = lazy
+        self.fragments = fragments
+        # Where the next top-level atom starts
+        self.position = 0
+    
+    def poll(self):
+        """Parse the complete top-level atoms appended since the last call,
+           and return them
+        """
+        size = os.fstat(self.stream.fileno()).st_size
+        basic_header_size = ATOM_HEADER_STRUCT['basic'].size
+        large_header_size = ATOM_HEADER_STRUCT['large'].size
+        new_atoms = []
+        while basic_header_size <= size - self.position:
+            self.stream.seek(self.position)
+            header = self.stream.read(large_header_size)
+            atom_size = ATOM_HEADER_STRUCT['basic'].unpack_from(header)[0]
+            
+            # The large size may not be written yet, and a zero size atom
+            # runs up to an end of file that is not known until the writer
+            # goes back and fills the size in
+            if (1 == atom_size and len(header) < large_header_size) \
+                    or 0 == atom_size:
+                break
+            
+            (atom_type, content_size, header_size) = \
+                unpack_atom_header(header)
+            if content_size < 0:
+                raise ValueError, 'Invalid size for atom %r at %d' \
+                    % (atom_type, self.position)
+            end = self.position + header_size + content_size
+            if size < end:
+                break
+            
+            root_atom = Atom( stream=self.stream, offset=self.position,
+                              lazy=self.lazy,
+                              header=(atom_type, content_size, header_size) )
+            if self.fragments is not None:
+                if 'moov' == atom_type:
+                    self.fragments.add_moov( root_atom )
+                elif 'moof' == atom_type:
+                    self.fragments.add_moof( root_atom, self.position )
+            
+            self.append( root_atom )
+            new_atoms.append( root_atom )
+            self.position = end
+        
+        return new_atoms
+    
+    def close(self):
+        self.stream.close()
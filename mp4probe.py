@@ -0,0 +1,77 @@
+# Concurrent probing of many MP4 files
+#
+# Opening an Mp4File blocks on file I/O, so probing hundreds of files one
+# after the other mostly waits on the disk. A Mp4Prober runs the opens and
+# the decoding on a pool of threads (file reads release the GIL) and hands
+# back results as they complete, with at most max_open files open at once.
+# Files are read with regular I/O by default: reading through a mapping
+# faults pages in while the thread holds the GIL, so mapped probes hardly
+# overlap. Mapping stays available with use_mmap=True.
+#
+# Python 2 has no asyncio: the pool returns multiprocessing AsyncResult
+# objects, which can be waited on with get() or followed with callbacks.
+
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from mp4file import Mp4File
+from sampletable import sample_tables
+
+def track_durations(mp4,stream=0):
+    """Frame durations (s) of track stream, as written by getframesduration"""
+    t = sample_tables(mp4)[stream]
+    return t.seconds(t.durations)
+
+class Mp4Prober:
+    def __init__(self,max_open=16,use_mmap=False,lazy=True):
+        """Every worker thread holds at most one open file, so max_open is
+        also the number of probes running at the same time"""
+        self.max_open = max_open
+        self.use_mmap = use_mmap
+        self.lazy = lazy
+        self.pool = ThreadPool(max_open)
+
+    def call(self,path,fn):
+        """Opens path, returns fn(mp4) and closes the file again"""
+        mp4 = Mp4File(path,use_mmap=self.use_mmap,lazy=self.lazy)
+        try:
+            return fn(mp4)
+        finally:
+            mp4.close()
+
+    def probe(self,path,fn,callback=None):
+        """AsyncResult of fn(Mp4File(path)), run on the pool. The file is
+        closed once fn returns, so fn must not keep atoms around"""
+        return self.pool.apply_async(self.call,(path,fn),callback=callback)
+
+    def tables(self,path,callback=None):
+        """AsyncResult of the SampleTable list of path"""
+        return self.probe(path,sample_tables,callback)
+
+    def durations(self,path,stream=0,callback=None):
+        """AsyncResult of the frame durations (s) of track stream of path"""
+        return self.probe(path,partial(track_durations,stream=stream),callback)
+
+    def map(self,fn,paths):
+        """Iterates over (path,result,error) of fn(Mp4File(path)) for every
+        path, in completion order. error is None or the exception raised,
+        so a bad file does not stop the others"""
+        def job(path):
+            try:
+                return (path,self.call(path,fn),None)
+            except Exception as e:
+                return (path,None,e)
+        return self.pool.imap_unordered(job,paths)
+
+    def close(self):
+        """Waits for the pending probes and stops the threads"""
+        self.pool.close()
+        self.pool.join()
+
+def probe_durations(paths,stream=0,max_open=16):
+    """{path: frame durations (s) or exception} of many files at once"""
+    prober = Mp4Prober(max_open)
+    out = {}
+    for path,result,error in prober.map(partial(track_durations,stream=stream),paths):
+        out[path] = error if error is not None else result
+    prober.close()
+    return out
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Unit tests for mp4probe.py
+
+"""
+
+import mp4probe
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from sampletabletest import render_atom, render_full_atom, render_table, \
+    render_trak
+
+class ProbeManyFiles(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(1, 9):
+            trak = render_trak([
+                render_table('stts', '>LL', [(i, 300)]),
+                render_full_atom('stsz', struct.pack('>LL', 4, i)),
+                render_table('stsc', '>LLL', [(1, i, 1)]),
+                render_table('stco', '>L', [(0,)]),
+            ])
+            path = os.path.join(self.directory, '%d.mp4' % i)
+            f = open(path, 'wb')
+            f.write(render_atom('moov', trak))
+            f.close()
+            self.paths.append(path)
+        
+        self.bad_path = os.path.join(self.directory, 'bad.mp4')
+        f = open(self.bad_path, 'wb')
+        f.write(render_atom('free', ''))
+        f.close()
+        
+        self.prober = mp4probe.Mp4Prober(max_open=3)
+    
+    def tearDown(self):
+        self.prober.close()
+        shutil.rmtree(self.directory)
+    
+    def testDurations(self):
+        results = [self.prober.durations(path) for path in self.paths]
+        for (i, result) in enumerate(results):
+            self.assertEqual(list(result.get()), [0.5] * (i + 1))
+    
+    def testMappedFilesOptIn(self):
+        prober = mp4probe.Mp4Prober(max_open=2, use_mmap=True)
+        self.assertEqual(list(prober.durations(self.paths[1]).get()),
+                         [0.5, 0.5])
+        prober.close()
+    
+    def testCallback(self):
+        found = []
+        self.prober.tables(self.paths[2], found.append).wait()
+        self.assertEqual(len(found[0][0]), 3)
+    
+    def testMapReportsEveryFile(self):
+        results = list(self.prober.map(len, self.paths + [self.bad_path]))
+        self.assertEqual(sorted([path for (path, result, error) in results]),
+                         sorted(self.paths + [self.bad_path]))
+        self.assertEqual(set([result for (path, result, error) in results]),
+                         set([1]))
+    
+    def testProbeDurationsCollectsErrors(self):
+        out = mp4probe.probe_durations(self.paths + [self.bad_path])
+        self.assertEqual(list(out[self.paths[1]]), [0.5, 0.5])
+        self.assertTrue(isinstance(out[self.bad_path], IndexError))
+    
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,224 @@
+# Synthetic MP4 files for tests and benchmarks
+#
+# Writes valid MP4 files of any size without real media: sample data is
+# never written, mdat is extended with truncate() so that multi-GB files
+# stay sparse on disk and are created in no time. The sample tables are
+# built with NumPy, so millions of stts/stsz/stco entries cost little.
+#
+# Variants: any number of tracks, moov before or after mdat, stts with one
+# entry per sample (jitter) or run-length friendly, 64bit chunk offsets
+# for files over 4GB, and fragmented files (moov/mvex + moof/mdat pairs).
+#
+# Usage: python mp4synth.py out.mp4 --samples 1000000 --jitter
+
+import struct
+import numpy as np
+from atom import render_atom_header, decode_mdhd, decode_mvhd, decode_tkhd, \
+    encode_mdhd, encode_mvhd, encode_tkhd
+from sampletable import run_lengths
+
+def box(t,content):
+    return render_atom_header(t,len(content)) + content
+
+def full(t,content,version=0,flags=0):
+    return box(t,struct.pack(">L",(version << 24) | flags) + content)
+
+def timed(t,decode,encode,content,duration,flags=0):
+    """Version 0 full box t with its duration set by the atom encoder,
+    that writes version 1 when the duration needs 64 bits"""
+    content = struct.pack(">L",flags) + content
+    return box(t,encode(decode(content)._replace(duration=duration),content))
+
+def entries(t,count,data,version=0):
+    """Full box made of an entry count and the entries"""
+    return full(t,struct.pack(">L",count) + data,version)
+
+def be(a,dtype=">u4"):
+    return np.asarray(a).astype(dtype).tostring()
+
+class SyntheticTrack:
+    """Samples of one synthetic track"""
+    def __init__(self,track_id,samples,sample_size=1000,timescale=90000,delta=3000,
+                 jitter=False,gop=30,handler_type="vide"):
+        self.track_id = track_id
+        self.handler_type = handler_type
+        self.timescale = timescale
+        i = np.arange(samples,dtype=np.int64)
+        # sizes vary, so that stsz has one entry per sample
+        self.sizes = sample_size + (i % 7)
+        # with jitter no two neighbouring durations match, as in variable
+        # frame rate recordings, and stts gets one entry per sample
+        self.durations = np.full(samples,delta,dtype=np.int64)
+        if jitter:
+            self.durations += i % 2
+        self.keyframes = (i % gop) == 0
+        self.ctts = np.where(self.keyframes,0,delta)
+
+    def __len__(self):
+        return self.sizes.shape[0]
+
+    def nbytes(self):
+        return int(np.sum(self.sizes))
+
+    def header(self):
+        """tkhd and the mdia boxes but stbl"""
+        duration = int(np.sum(self.durations))
+        tkhd = timed("tkhd",decode_tkhd,encode_tkhd,struct.pack(">LLLLL",0,0,self.track_id,0,0)
+                     + "\0" * 52 + struct.pack(">LL",640 << 16,480 << 16),
+                     duration*1000//self.timescale,flags=3)
+        mdhd = timed("mdhd",decode_mdhd,encode_mdhd,struct.pack(">LLLLHH",0,0,self.timescale,0,0x55c4,0),
+                     duration)
+        hdlr = full("hdlr",struct.pack(">L4sLLL",0,self.handler_type,0,0,0) + "synthetic\0")
+        return tkhd,mdhd,hdlr
+
+    def stsd(self):
+        if self.handler_type == "vide":
+            entry = box("avc1","\0" * 6 + struct.pack(">H",1) + "\0" * 16
+                        + struct.pack(">HH",640,480) + "\0" * 50)
+        else:
+            entry = box("mp4a","\0" * 6 + struct.pack(">H",1) + "\0" * 20)
+        return entries("stsd",1,entry)
+
+    def trak(self,stbl):
+        tkhd,mdhd,hdlr = self.header()
+        dinf = box("dinf",entries("dref",1,full("url ","",flags=1)))
+        minf = box("minf",full("vmhd","\0" * 8,flags=1) + dinf + stbl)
+        return box("trak",tkhd + box("mdia",mdhd + hdlr + minf))
+
+    def sample_table(self,first_offset,chunk=10,wide=False):
+        """trak whose samples are stored contiguously from first_offset,
+        chunk samples per chunk"""
+        n = len(self)
+        counts,deltas = run_lengths(self.durations)
+        stts = entries("stts",counts.shape[0],be(np.column_stack((counts,deltas))))
+        counts,offsets = run_lengths(self.ctts)
+        ctts = entries("ctts",counts.shape[0],be(np.column_stack((counts,offsets))))
+        stsz = full("stsz",struct.pack(">LL",0,n) + be(self.sizes))
+        nchunks = (n + chunk - 1) // chunk
+        stsc = [(1,chunk,1)]
+        if n % chunk != 0:
+            stsc.append((nchunks,n % chunk,1))
+        stsc = entries("stsc",len(stsc),be(stsc))
+        before = np.cumsum(self.sizes) - self.sizes
+        chunk_offsets = first_offset + before[::chunk]
+        if wide:
+            stco = entries("co64",nchunks,be(chunk_offsets,">u8"))
+        else:
+            stco = entries("stco",nchunks,be(chunk_offsets))
+        sync = np.nonzero(self.keyframes)[0] + 1
+        stss = entries("stss",sync.shape[0],be(sync))
+        return self.trak(box("stbl",self.stsd() + stts + ctts + stsz + stsc + stco + stss))
+
+    def empty_table(self):
+        """trak of a fragmented file, all samples are in the fragments"""
+        stbl = self.stsd() + entries("stts",0,"") + entries("stsc",0,"") \
+            + full("stsz",struct.pack(">LL",0,0)) + entries("stco",0,"")
+        return self.trak(box("stbl",stbl))
+
+def mvhd(tracks):
+    duration = max([int(np.sum(t.durations))*1000//t.timescale for t in tracks])
+    return timed("mvhd",decode_mvhd,encode_mvhd,struct.pack(">LLLLLH",0,0,1000,0,0x10000,0x100)
+                 + "\0" * 70 + struct.pack(">L",len(tracks) + 1),duration)
+
+FTYP = box("ftyp","isom\0\0\2\0isomiso2mp41")
+
+def write_mdat_header(f,size):
+    """mdat header for size bytes of content, the content is left sparse"""
+    f.write(render_atom_header("mdat",size))
+    start = f.tell()
+    f.truncate(start + size)
+    f.seek(start + size)
+    return start
+
+def write_progressive(f,tracks,moov_at_end=False,chunk=10):
+    mdat_size = sum([t.nbytes() for t in tracks])
+    mdat_header = len(render_atom_header("mdat",mdat_size))
+    # leave room for 32bit offsets overflowing once moov is in front
+    wide = mdat_size + 2**24 > 0xffffffff
+    def moov(mdat_start):
+        traks = []
+        offset = mdat_start
+        for t in tracks:
+            traks.append(t.sample_table(offset,chunk,wide))
+            offset += t.nbytes()
+        return box("moov",mvhd(tracks) + "".join(traks))
+    f.write(FTYP)
+    if moov_at_end:
+        write_mdat_header(f,mdat_size)
+        f.write(moov(len(FTYP) + mdat_header))
+    else:
+        # the size of moov does not depend on the offsets it holds
+        size = len(moov(0))
+        f.write(moov(len(FTYP) + size + mdat_header))
+        write_mdat_header(f,mdat_size)
+
+def write_fragmented(f,tracks,fragments):
+    mvex = box("mvex","".join([full("trex",struct.pack(">LLLLL",t.track_id,1,0,0,0)) for t in tracks]))
+    f.write(FTYP)
+    f.write(box("moov",mvhd(tracks) + "".join([t.empty_table() for t in tracks]) + mvex))
+    decode_time = [0] * len(tracks)
+    for k in range(fragments):
+        # data offsets are relative to the moof, filled in once its size is known
+        def moof(offset):
+            out = []
+            data = offset
+            for j,t in enumerate(tracks):
+                lo,hi = len(t)*k//fragments,len(t)*(k+1)//fragments
+                flags = np.where(t.keyframes[lo:hi],0,0x10000)
+                samples = np.column_stack((t.durations[lo:hi],t.sizes[lo:hi],flags))
+                tfhd = full("tfhd",struct.pack(">L",t.track_id),flags=0x20000)
+                tfdt = full("tfdt",struct.pack(">Q",decode_time[j]),1)
+                trun = full("trun",struct.pack(">Ll",hi-lo,data) + be(samples),flags=0x701)
+                out.append(box("traf",tfhd + tfdt + trun))
+                data += int(np.sum(t.sizes[lo:hi]))
+            return box("moof",full("mfhd",struct.pack(">L",k+1)) + "".join(out))
+        size = len(moof(0))
+        nbytes = 0
+        for t in tracks:
+            nbytes += int(np.sum(t.sizes[len(t)*k//fragments:len(t)*(k+1)//fragments]))
+        f.write(moof(size + len(render_atom_header("mdat",nbytes))))
+        write_mdat_header(f,nbytes)
+        for j,t in enumerate(tracks):
+            decode_time[j] += int(np.sum(t.durations[len(t)*k//fragments:len(t)*(k+1)//fragments]))
+
+def synthesize(path,tracks=1,samples=1000,sample_size=1000,jitter=False,
+               moov_at_end=False,fragments=0,chunk=10):
+    """Writes a synthetic MP4 file: the first track is video, the others
+    audio. fragments > 0 spreads the samples over that many moof/mdat
+    pairs. Returns the list of SyntheticTrack written"""
+    out = []
+    for i in range(tracks):
+        if i == 0:
+            out.append(SyntheticTrack(i+1,samples,sample_size,jitter=jitter))
+        else:
+            # AAC like: 1024 samples per frame at 48kHz, all keyframes
+            out.append(SyntheticTrack(i+1,samples,max(sample_size//8,1),48000,1024,
+                                      jitter,1,"soun"))
+    f = open(path,"wb")
+    if fragments > 0:
+        write_fragmented(f,out,fragments)
+    else:
+        write_progressive(f,out,moov_at_end,chunk)
+    f.close()
+    return out
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Synthetic MP4 generator')
+    parser.add_argument("output")
+    parser.add_argument("--tracks",type=int,default=1)
+    parser.add_argument("--samples",type=int,default=1000,help="samples per track")
+    parser.add_argument("--sample-size",type=int,default=1000,help="bytes per video sample, mdat is sparse")
+    parser.add_argument("--jitter",action="store_true",help="one stts entry per sample")
+    parser.add_argument("--moov-at-end",action="store_true")
+    parser.add_argument("--fragments",type=int,default=0,help="writes a fragmented file with this many fragments")
+    parser.add_argument("--chunk",type=int,default=10,help="samples per chunk")
+    args = parser.parse_args()
+
+    tracks = synthesize(args.output,args.tracks,args.samples,args.sample_size,args.jitter,
+                        args.moov_at_end,args.fragments,args.chunk)
+    print "written",args.output,"with",len(tracks),"tracks of",args.samples,"samples"
+
+if __name__ == '__main__':
+    main()
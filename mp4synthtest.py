@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Unit tests for mp4synth.py
+
+"""
+
+import fragments
+import mp4file
+import mp4synth
+import os
+import sampletable
+import tempfile
+import unittest
+
+class SynthesizeFiles(unittest.TestCase):
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp(suffix='.mp4')
+        os.close(fd)
+    
+    def tearDown(self):
+        os.remove(self.path)
+    
+    def decode(self, **args):
+        tracks = mp4synth.synthesize(self.path, **args)
+        mp4 = mp4file.Mp4File(self.path, use_mmap=True, lazy=True)
+        types = [a.type for a in mp4]
+        if args.get('fragments', 0) > 0:
+            tables = fragments.fragment_tables(mp4)
+        else:
+            tables = sampletable.sample_tables(mp4)
+        mp4.close()
+        self.assertEqual(len(tables), len(tracks))
+        for (table, track) in zip(tables, tracks):
+            self.assertEqual(table.handler_type, track.handler_type)
+            self.assertTrue((table.sizes == track.sizes).all())
+            self.assertTrue((table.durations == track.durations).all())
+            self.assertTrue((table.keyframes == track.keyframes).all())
+            self.assertTrue(table.offsets[-1] + table.sizes[-1]
+                <= os.path.getsize(self.path))
+        return (types, tables)
+    
+    def testMoovAtStart(self):
+        (types, tables) = self.decode(samples=100)
+        self.assertEqual(types, ['ftyp', 'moov', 'mdat'])
+    
+    def testMoovAtEnd(self):
+        (types, tables) = self.decode(samples=100, tracks=3, moov_at_end=True)
+        self.assertEqual(types, ['ftyp', 'mdat', 'moov'])
+        # tracks follow each other in mdat
+        self.assertEqual(tables[1].offsets[0],
+                         tables[0].offsets[-1] + tables[0].sizes[-1])
+    
+    def testJitterGivesOneTimeEntryPerSample(self):
+        tracks = mp4synth.synthesize(self.path, samples=100, jitter=True)
+        (counts, deltas) = mp4synth.run_lengths(tracks[0].durations)
+        self.assertEqual(counts.shape[0], 100)
+        self.decode(samples=100, jitter=True)
+    
+    def testFragmented(self):
+        (types, tables) = self.decode(samples=100, tracks=2, fragments=3)
+        self.assertEqual(types.count('moof'), 3)
+        self.assertEqual(list(tables[0].dts[:3]), [0, 3000, 6000])
+    
+    def testLargeSparseFile(self):
+        (types, tables) = self.decode(samples=3000, sample_size=2*1024*1024)
+        self.assertTrue(os.path.getsize(self.path) > 2**32)
+        self.assertTrue(tables[0].offsets[-1] > 2**32)
+    
+    def testDurationsPastThirtyTwoBits(self):
+        samples = 2**32 // 3000 + 1000
+        (types, tables) = self.decode(samples=samples, sample_size=1)
+        mp4 = mp4file.Mp4File(self.path)
+        mdhd = mp4.find('moov/trak/mdia/mdhd')[0].decode()
+        mp4.close()
+        self.assertEqual(mdhd.version, 1)
+        self.assertEqual(mdhd.duration, samples * 3000)
+        self.assertTrue(tables[0].dts[-1] > 2**32)
+    
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+# Random access to the samples of an MP4 track
+#
+# Fetches samples straight from mdat using the offsets and sizes of a
+# SampleTable. Requests for many samples are sorted by file offset and
+# samples that are close to each other are merged into one large
+# sequential read, so a batch costs a handful of seeks rather than one
+# per sample.
+
+import numpy as np
+from atom import MappedStream
+
+class SampleReader:
+    def __init__(self,stream,table,max_gap=64*1024,max_read=16*1024*1024):
+        """stream is the file holding the samples (eg. Mp4File.stream),
+        table its SampleTable. Samples at most max_gap bytes apart are read
+        together, as long as a single read stays below max_read bytes."""
+        self.stream = stream
+        self.table = table
+        self.max_gap = max_gap
+        self.max_read = max_read
+        self.reads = 0 # number of reads issued, for tuning max_gap
+
+    def __len__(self):
+        return len(self.table)
+
+    def read(self,i):
+        """Bytes of sample i"""
+        return self.read_samples([i])[0]
+
+    def read_range(self,start,stop):
+        """Bytes of samples start to stop (excluded)"""
+        return self.read_samples(np.arange(start,min(stop,len(self.table))))
+
+    def read_samples(self,indices):
+        """Bytes of each of the given samples, in the order requested"""
+        indices = np.asarray(indices,dtype=np.int64)
+        offsets = self.table.offsets[indices]
+        sizes = self.table.sizes[indices]
+        out = [None] * indices.shape[0]
+        if isinstance(self.stream,MappedStream):
+            # already in memory: slice the mapping, no copy and no merging
+            for k in range(indices.shape[0]):
+                out[k] = buffer(self.stream.map,offsets[k],sizes[k])
+            return out
+        order = np.argsort(offsets,kind="mergesort")
+        for group in self.groups(offsets[order],sizes[order]):
+            first = offsets[order[group[0]]]
+            last = max([offsets[order[k]] + sizes[order[k]] for k in group])
+            self.stream.seek(first)
+            data = self.stream.read(last - first)
+            self.reads += 1
+            for k in group:
+                j = order[k]
+                begin = offsets[j] - first
+                out[j] = data[begin:begin+sizes[j]]
+        return out
+
+    def groups(self,offsets,sizes):
+        """Splits samples sorted by offset into runs that are read at once"""
+        ends = np.maximum.accumulate(offsets + sizes)
+        # a new read starts wherever the gap from what precedes is too large
+        breaks = np.nonzero(offsets[1:] - ends[:-1] > self.max_gap)[0] + 1
+        groups = []
+        for run in np.split(np.arange(offsets.shape[0]),breaks):
+            if run.shape[0] == 0:
+                continue
+            # keep single reads bounded
+            group = [run[0]]
+            first = offsets[run[0]]
+            for k in run[1:]:
+                if ends[k] - first > self.max_read:
+                    groups.append(group)
+                    group = []
+                    first = offsets[k]
+                group.append(k)
+            groups.append(group)
+        return groups
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Unit tests for samplereader.py
+
+"""
+
+import atom
+import samplereader
+import sampletable
+from sampletabletest import load_trak, render_full_atom, render_table, \
+    render_trak
+import StringIO
+import struct
+import tempfile
+import unittest
+
+class ReadCountingStream(StringIO.StringIO):
+    def __init__(self, *args):
+        StringIO.StringIO.__init__(self, *args)
+        self.reads = 0
+    
+    def read(self, n=-1):
+        self.reads += 1
+        return StringIO.StringIO.read(self, n)
+    
+
+class ReadSamples(unittest.TestCase):
+    # chunk 1 holds samples 0-2, chunk 2 far away holds samples 3-5
+    sizes = [3, 5, 4, 2, 6, 1]
+    chunk_offsets = [100, 10000]
+    
+    def setUp(self):
+        data = ['\0'] * (self.chunk_offsets[-1] + 100)
+        self.samples = []
+        sample = 0
+        for chunk_offset in self.chunk_offsets:
+            offset = chunk_offset
+            for size in self.sizes[sample:sample + 3]:
+                content = chr(ord('a') + sample) * size
+                data[offset:offset + size] = list(content)
+                self.samples.append(content)
+                offset += size
+                sample += 1
+        self.data = ''.join(data)
+        
+        tables = [
+            render_table('stts', '>LL', [(len(self.sizes), 1)]),
+            render_full_atom('stsz', struct.pack('>LL', 0, len(self.sizes))
+                + ''.join([struct.pack('>L', s) for s in self.sizes])),
+            render_table('stsc', '>LLL', [(1, 3, 1)]),
+            render_table('stco', '>L', [(o,) for o in self.chunk_offsets]),
+        ]
+        self.table = sampletable.SampleTable(load_trak(render_trak(tables)))
+        self.stream = ReadCountingStream(self.data)
+        self.reader = samplereader.SampleReader(self.stream, self.table,
+                                                max_gap=1000)
+    
+    def tearDown(self):
+        del self.reader
+        del self.stream
+    
+    def testReadSample(self):
+        self.assertEqual(self.samples[4], self.reader.read(4))
+    
+    def testReadRange(self):
+        self.assertEqual(self.samples[1:5], self.reader.read_range(1, 5))
+    
+    def testReadSamplesInRequestedOrder(self):
+        self.assertEqual([self.samples[i] for i in [5, 0, 3, 0]],
+                         self.reader.read_samples([5, 0, 3, 0]))
+    
+    def testNearbySamplesAreCoalesced(self):
+        self.reader.read_range(0, len(self.sizes))
+        self.assertEqual(2, self.stream.reads)
+        self.assertEqual(2, self.reader.reads)
+    
+    def testReadsAreBounded(self):
+        self.reader.max_read = 8
+        self.assertEqual(self.samples, self.reader.read_range(0, len(self.sizes)))
+        self.assertEqual(4, self.reader.reads)
+    
+    def testMappedReadsAreZeroCopy(self):
+        data_file = tempfile.TemporaryFile()
+        data_file.write(self.data)
+        data_file.flush()
+        reader = samplereader.SampleReader(atom.MappedStream(data_file), self.table)
+        samples = reader.read_range(0, len(self.sizes))
+        
+        self.assertTrue(isinstance(samples[0], buffer))
+        self.assertEqual(self.samples, [str(s) for s in samples])
+    
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,258 @@
+# Sample tables of MP4 tracks as NumPy arrays
+#
+# Decodes stts, ctts, stsz/stz2, stsc, stco/co64 and stss of a trak and
+# resolves, for every sample, its file offset, size, decode and
+# presentation timestamps and keyframe flag. All the run-length tables
+# are expanded with vectorized operations, never per sample in Python.
+#
+# Reference:
+# ISO/IEC 14496-12 Section 8.6 (Time to Sample) and 8.7 (Sample Table)
+
+import struct
+import numpy as np
+
+def atom_content(a):
+    """Whole content of a data atom (a zero-copy buffer on mapped files)"""
+    a.seek(0)
+    return a.read()
+
+def full_box_version(data):
+    """Version of a full box, from its leading version and flags"""
+    return struct.unpack_from(">B",data,0)[0]
+
+def table(data,dtype,count,offset=8):
+    """count entries of dtype following the full box header and entry count"""
+    return np.frombuffer(data,dtype=np.dtype(dtype),count=count,offset=offset)
+
+def decode_stts(data):
+    """Returns (sample_count, sample_delta) of each stts entry"""
+    n = struct.unpack_from(">L",data,4)[0]
+    t = np.reshape(table(data,">u4",n*2),(n,2)).astype(np.int64)
+    return t[:,0],t[:,1]
+
+def decode_ctts(data):
+    """Returns (sample_count, sample_offset) of each ctts entry"""
+    n = struct.unpack_from(">L",data,4)[0]
+    # version 1 offsets are signed, and so are many version 0 ones in
+    # the wild: reading both as signed is what players do
+    t = np.reshape(table(data,">i4",n*2),(n,2)).astype(np.int64)
+    return t[:,0],t[:,1]
+
+def decode_stsz(data):
+    """Returns the size of every sample"""
+    sample_size,n = struct.unpack_from(">LL",data,4)
+    if sample_size != 0:
+        return np.full(n,sample_size,dtype=np.int64)
+    return table(data,">u4",n,12).astype(np.int64)
+
+def decode_stz2(data):
+    """Returns the size of every sample from a compact sample size box"""
+    field_size,n = struct.unpack_from(">xxxBL",data,4)
+    if field_size == 4:
+        # two samples per byte, the first in the high nibble
+        packed = table(data,">u1",(n+1)//2,12)
+        sizes = np.empty(packed.shape[0]*2,dtype=np.int64)
+        sizes[0::2] = packed >> 4
+        sizes[1::2] = packed & 0x0f
+        return sizes[:n]
+    elif field_size == 8:
+        return table(data,">u1",n,12).astype(np.int64)
+    elif field_size == 16:
+        return table(data,">u2",n,12).astype(np.int64)
+    raise ValueError("unsupported stz2 field size %d" % field_size)
+
+def decode_stsc(data):
+    """Returns (first_chunk, samples_per_chunk, sample_description_index)
+    of each stsc entry, chunks numbered from 1"""
+    n = struct.unpack_from(">L",data,4)[0]
+    t = np.reshape(table(data,">u4",n*3),(n,3)).astype(np.int64)
+    return t[:,0],t[:,1],t[:,2]
+
+def decode_stco(data):
+    """Returns the file offset of every chunk"""
+    n = struct.unpack_from(">L",data,4)[0]
+    return table(data,">u4",n).astype(np.int64)
+
+def decode_co64(data):
+    """Returns the file offset of every chunk from a 64bit chunk offset box"""
+    n = struct.unpack_from(">L",data,4)[0]
+    return table(data,">u8",n).astype(np.int64)
+
+def decode_stss(data):
+    """Returns the sample numbers of the sync samples, numbered from 1"""
+    n = struct.unpack_from(">L",data,4)[0]
+    return table(data,">u4",n).astype(np.int64)
+
+def encode_chunk_offsets(offsets,version_flags="\0\0\0\0",wide=False):
+    """Returns (type,content) of a chunk offset box holding offsets: co64
+    when asked to be wide or when some offset needs 64 bits, else stco"""
+    if offsets.shape[0] > 0 and offsets.min() < 0:
+        raise ValueError("negative chunk offset %d" % offsets.min())
+    if wide or (offsets.shape[0] > 0 and offsets.max() > 0xffffffff):
+        atom_type,dt = "co64",">u8"
+    else:
+        atom_type,dt = "stco",">u4"
+    return atom_type,version_flags + struct.pack(">L",offsets.shape[0]) + offsets.astype(dt).tostring()
+
+def remap_chunk_offsets(moov,remap):
+    """Replaces the chunk offsets o of all the tracks of moov by remap(o),
+    where remap works on whole arrays. stco boxes are promoted to co64 when
+    needed and never demoted. Returns True if any box changed size."""
+    resized = False
+    for a in moov.get_descendants_of_type("stco") + moov.get_descendants_of_type("co64"):
+        data = atom_content(a)
+        if a.type == "co64":
+            offsets = decode_co64(data)
+        else:
+            offsets = decode_stco(data)
+        atom_type,content = encode_chunk_offsets(remap(offsets),str(data[0:4]),a.type == "co64")
+        resized = resized or atom_type != a.type
+        a.type = atom_type
+        a.seek(0)
+        a.write(content)
+        a.truncate()
+    return resized
+
+def shift_chunk_offsets(moov,delta):
+    """Adds delta to the chunk offsets of all the tracks of moov, see
+    remap_chunk_offsets"""
+    return remap_chunk_offsets(moov,lambda offsets: offsets + delta)
+
+def expand_runs(counts,values):
+    """Expands a run-length table to one value per item"""
+    return np.repeat(values,counts)
+
+def run_lengths(values):
+    """(counts,values) of the runs of equal values"""
+    if values.shape[0] == 0:
+        return values,values
+    starts = np.concatenate(([0],np.nonzero(np.diff(values))[0] + 1))
+    counts = np.diff(np.append(starts,values.shape[0]))
+    return counts,values[starts]
+
+def samples_per_chunk(first_chunk,per_chunk,nchunks):
+    """Expands stsc to the number of samples in each of nchunks chunks"""
+    # every entry runs up to the first chunk of the next one
+    runs = np.diff(np.append(first_chunk,nchunks+1))
+    return np.repeat(per_chunk,np.maximum(runs,0))[:nchunks]
+
+def child(a,t):
+    """First child of a with type t, or None"""
+    found = a.get_children_of_type(t)
+    if len(found) == 0:
+        return None
+    return found[0]
+
+def track_header(trak):
+    """Returns (track_id,handler_type,timescale) of a trak"""
+    track_id,handler_type,timescale = 0,None,0
+    tkhd = child(trak,"tkhd")
+    if tkhd is not None:
+        track_id = tkhd.decode().track_id
+    mdia = child(trak,"mdia")
+    mdhd = child(mdia,"mdhd")
+    if mdhd is not None:
+        timescale = mdhd.decode().timescale
+    hdlr = child(mdia,"hdlr")
+    if hdlr is not None:
+        handler_type = hdlr.decode().handler_type
+    return track_id,handler_type,timescale
+
+class SampleTable:
+    """Per sample arrays of one trak, sample numbers are 0 based unlike
+    in the MP4 tables
+
+    offsets   file offset of each sample
+    sizes     size in bytes of each sample
+    chunks    0 based chunk of each sample
+    dts       decode timestamp of each sample, in timescale units
+    pts       presentation timestamp of each sample, in timescale units
+    durations duration of each sample, in timescale units
+    keyframes True for sync samples
+    """
+    def __init__(self,trak):
+        self.trak = trak
+        self.track_id,self.handler_type,self.timescale = track_header(trak)
+        mdia = child(trak,"mdia")
+        stbl = child(child(mdia,"minf"),"stbl")
+        self.decode(stbl)
+
+    def decode(self,stbl):
+        tables = {}
+        for a in stbl:
+            tables[a.type] = a
+
+        # sizes
+        if "stsz" in tables:
+            sizes = decode_stsz(atom_content(tables["stsz"]))
+        elif "stz2" in tables:
+            sizes = decode_stz2(atom_content(tables["stz2"]))
+        else:
+            sizes = np.zeros(0,dtype=np.int64)
+
+        # timing: samples beyond the time table are dropped, as players do
+        counts,deltas = decode_stts(atom_content(tables["stts"]))
+        durations = expand_runs(counts,deltas)
+        n = min(sizes.shape[0],durations.shape[0])
+
+        # chunks
+        if "co64" in tables:
+            chunk_offsets = decode_co64(atom_content(tables["co64"]))
+        else:
+            chunk_offsets = decode_stco(atom_content(tables["stco"]))
+        first_chunk,per_chunk,_ = decode_stsc(atom_content(tables["stsc"]))
+        per_chunk = samples_per_chunk(first_chunk,per_chunk,chunk_offsets.shape[0])
+        chunks = np.repeat(np.arange(per_chunk.shape[0],dtype=np.int64),per_chunk)
+        n = min(n,chunks.shape[0])
+
+        self.sizes = sizes[:n]
+        self.durations = durations[:n]
+        self.chunks = chunks[:n]
+
+        # byte offset of each sample inside its chunk
+        before = np.cumsum(self.sizes) - self.sizes
+        chunk_first = (np.cumsum(per_chunk) - per_chunk)[self.chunks]
+        self.offsets = chunk_offsets[self.chunks] + before - before[chunk_first]
+
+        self.dts = np.cumsum(self.durations) - self.durations
+        if "ctts" in tables:
+            counts,offsets = decode_ctts(atom_content(tables["ctts"]))
+            composition = expand_runs(counts,offsets)[:n]
+            self.pts = self.dts.copy()
+            self.pts[:composition.shape[0]] += composition
+        else:
+            self.pts = self.dts
+
+        if "stss" in tables:
+            self.keyframes = np.zeros(n,dtype=np.bool_)
+            sync = decode_stss(atom_content(tables["stss"])) - 1
+            self.keyframes[sync[(sync >= 0) & (sync < n)]] = True
+        else:
+            # no stss means every sample is a sync sample
+            self.keyframes = np.ones(n,dtype=np.bool_)
+
+        self.chunk_offsets = chunk_offsets
+        self.samples_per_chunk = per_chunk
+
+    def __len__(self):
+        return self.sizes.shape[0]
+
+    def __getstate__(self):
+        # the arrays are all that is needed once decoded, the trak holds
+        # an open stream and cannot be pickled
+        state = self.__dict__.copy()
+        state["trak"] = None
+        return state
+
+    def seconds(self,t):
+        """Converts timescale units to seconds"""
+        return t * (1.0/self.timescale)
+
+def sample_tables(mp4):
+    """SampleTable of every trak of an Mp4File (or any list of root atoms)"""
+    out = []
+    for a in mp4:
+        if a.type == "moov":
+            for trak in a.get_children_of_type("trak"):
+                out.append(SampleTable(trak))
+    return out
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Unit tests for sampletable.py
+
+"""
+
+import atom
+import numpy as np
+import sampletable
+import StringIO
+import struct
+import unittest
+
+def render_atom(type, content):
+    return atom.render_atom_header(type, len(content)) + content
+
+def render_full_atom(type, content, version=0, flags=0):
+    return render_atom(type, struct.pack('>L', (version << 24) | flags) + content)
+
+def render_table(type, format, entries, version=0):
+    content = struct.pack('>L', len(entries))
+    content += ''.join([struct.pack(format, *entry) for entry in entries])
+    return render_full_atom(type, content, version)
+
+def render_trak(tables, timescale=600, track_id=7, handler_type='vide'):
+    tkhd = render_full_atom('tkhd', struct.pack('>LLLLL', 0, 0, track_id, 0, 0)
+        + '\0' * 60)
+    mdhd = render_full_atom('mdhd', struct.pack('>LLLLHH', 0, 0, timescale, 0, 0, 0))
+    hdlr = render_full_atom('hdlr', struct.pack('>L4sLLL', 0, handler_type, 0, 0, 0)
+        + 'handler\0')
+    stbl = render_atom('stbl', ''.join(tables))
+    minf = render_atom('minf', stbl)
+    mdia = render_atom('mdia', mdhd + hdlr + minf)
+    return render_atom('trak', tkhd + mdia)
+
+def load_trak(rendered):
+    return atom.Atom(StringIO.StringIO(rendered))
+
+class DecodeSampleTable(unittest.TestCase):
+    sizes = [10, 11, 12, 13, 14, 15, 16]
+    
+    def setUp(self):
+        self.tables = [
+            render_table('stts', '>LL', [(3, 20), (4, 40)]),
+            render_table('ctts', '>Li', [(1, 40), (2, -20), (4, 0)], 1),
+            render_full_atom('stsz', struct.pack('>LL', 0, len(self.sizes))
+                + ''.join([struct.pack('>L', s) for s in self.sizes])),
+            # 2 samples in chunks 1-2, 3 samples in chunk 3
+            render_table('stsc', '>LLL', [(1, 2, 1), (3, 3, 1)]),
+            render_table('stco', '>L', [(1000,), (2000,), (3000,)]),
+            render_table('stss', '>L', [(1,), (5,)]),
+        ]
+        self.table = sampletable.SampleTable(load_trak(render_trak(self.tables)))
+    
+    def tearDown(self):
+        del self.table
+    
+    def testTrackInformation(self):
+        self.assertEqual(7, self.table.track_id)
+        self.assertEqual('vide', self.table.handler_type)
+        self.assertEqual(600, self.table.timescale)
+        self.assertEqual(len(self.sizes), len(self.table))
+    
+    def testSizesAndChunks(self):
+        self.assertEqual(self.sizes, list(self.table.sizes))
+        self.assertEqual([0, 0, 1, 1, 2, 2, 2], list(self.table.chunks))
+    
+    def testOffsets(self):
+        self.assertEqual([1000, 1010, 2000, 2012, 3000, 3014, 3029],
+            list(self.table.offsets))
+    
+    def testTimestamps(self):
+        self.assertEqual([0, 20, 40, 60, 100, 140, 180], list(self.table.dts))
+        self.assertEqual([40, 0, 20, 60, 100, 140, 180], list(self.table.pts))
+        self.assertEqual([20, 20, 20, 40, 40, 40, 40], list(self.table.durations))
+    
+    def testKeyframes(self):
+        self.assertEqual([True, False, False, False, True, False, False],
+            list(self.table.keyframes))
+    
+    def testMissingSyncTableMeansAllKeyframes(self):
+        trak = load_trak(render_trak(self.tables[:-1]))
+        self.assertTrue(np.all(sampletable.SampleTable(trak).keyframes))
+    
+    def testLargeChunkOffsets(self):
+        co64 = render_table('co64', '>Q', [(2**33,), (2**34,), (2**35,)])
+        trak = load_trak(render_trak(self.tables[:4] + [co64]))
+        offsets = sampletable.SampleTable(trak).offsets
+        
+        self.assertEqual(2**33 + 10, offsets[1])
+        self.assertEqual(2**35 + 29, offsets[-1])
+    
+
+class RemapChunkOffsets(unittest.TestCase):
+    offsets = [100, 2000, 2**32 - 1000]
+    
+    def setUp(self):
+        stbl = render_atom('stbl', render_table('stco', '>L',
+            [(o,) for o in self.offsets]))
+        self.moov = atom.Atom(StringIO.StringIO(render_atom('moov', stbl)))
+    
+    def tearDown(self):
+        del self.moov
+    
+    def chunk_offsets(self):
+        data = sampletable.atom_content(self.moov[0][0])
+        if self.moov[0][0].type == 'co64':
+            return list(sampletable.decode_co64(data))
+        return list(sampletable.decode_stco(data))
+    
+    def testShift(self):
+        self.assertFalse(sampletable.shift_chunk_offsets(self.moov, 500))
+        self.assertEqual('stco', self.moov[0][0].type)
+        self.assertEqual([o + 500 for o in self.offsets], self.chunk_offsets())
+    
+    def testPromotesToLargeOffsets(self):
+        self.assertTrue(sampletable.shift_chunk_offsets(self.moov, 1000))
+        self.assertEqual('co64', self.moov[0][0].type)
+        self.assertEqual([o + 1000 for o in self.offsets], self.chunk_offsets())
+    
+    def testNeverDemotes(self):
+        sampletable.shift_chunk_offsets(self.moov, 1000)
+        self.assertFalse(sampletable.shift_chunk_offsets(self.moov, -1000))
+        self.assertEqual('co64', self.moov[0][0].type)
+        self.assertEqual(self.offsets, self.chunk_offsets())
+    
+    def testSavedMoovIsValid(self):
+        sampletable.shift_chunk_offsets(self.moov, 1000)
+        save_stream = StringIO.StringIO()
+        self.moov.save(save_stream)
+        saved = atom.Atom(StringIO.StringIO(save_stream.getvalue()))
+        
+        self.assertEqual('co64', saved[0][0].type)
+        self.assertEqual(8 + len(self.offsets) * 8, saved[0][0].size())
+    
+
+class DecodeCompactSampleSizes(unittest.TestCase):
+    sizes = [1, 15, 7, 0, 9]
+    
+    def render_stz2(self, field_size, data):
+        return render_full_atom('stz2',
+            struct.pack('>xxxBL', field_size, len(self.sizes)) + data)
+    
+    def testFourBitFields(self):
+        data = ''.join([chr((self.sizes[i] << 4) | (self.sizes[i + 1:i + 2] or [0])[0])
+                        for i in range(0, len(self.sizes), 2)])
+        atom_data = self.render_stz2(4, data)[8:]
+        self.assertEqual(self.sizes, list(sampletable.decode_stz2(atom_data)))
+    
+    def testEightBitFields(self):
+        atom_data = self.render_stz2(8, ''.join([chr(s) for s in self.sizes]))[8:]
+        self.assertEqual(self.sizes, list(sampletable.decode_stz2(atom_data)))
+    
+    def testSixteenBitFields(self):
+        data = ''.join([struct.pack('>H', s * 1000) for s in self.sizes])
+        atom_data = self.render_stz2(16, data)[8:]
+        self.assertEqual([s * 1000 for s in self.sizes],
+            list(sampletable.decode_stz2(atom_data)))
+    
+
+if __name__ == "__main__":
+    unittest.main()
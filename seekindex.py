@@ -0,0 +1,60 @@
+# Time to sample lookup of an MP4 track
+#
+# Built once from the arrays of a SampleTable (stts gives the decode
+# timestamps, stss the sync samples), a SeekIndex answers "which sample is
+# shown at time t and from which keyframe must decoding start" with one
+# searchsorted over the decode timestamps: the keyframe at or before every
+# sample is precomputed, so a batch of queries costs a handful of array
+# operations whatever its size.
+#
+# FragmentTable has no chunks, the moof of each sample stands in for them.
+
+import numpy as np
+
+class SeekIndex:
+    def __init__(self,table):
+        self.table = table
+        self.timescale = table.timescale
+        self.dts = table.dts
+        n = len(table)
+        # last sync sample at or before each sample, the first one for the
+        # samples before it (a track not starting on a keyframe)
+        last_sync = np.maximum.accumulate(np.where(table.keyframes,np.arange(n),-1))
+        sync = np.nonzero(table.keyframes)[0]
+        first_sync = sync[0] if sync.shape[0] > 0 else 0
+        self.keyframes = np.where(last_sync < 0,first_sync,last_sync)
+        chunks = getattr(table,"chunks",None)
+        if chunks is None:
+            chunks = table.fragments
+        self.chunks = chunks[self.keyframes]
+        self.offsets = table.offsets[self.keyframes]
+
+    def __len__(self):
+        return self.dts.shape[0]
+
+    def samples(self,times,units=False):
+        """Sample decoded at each time: the last one starting at or before
+        it, the first one for earlier times. times are in seconds, rounded
+        to the nearest track unit, or in track units with units=True"""
+        times = np.asarray(times)
+        if not units:
+            times = np.floor(times * float(self.timescale) + 0.5)
+        i = np.searchsorted(self.dts,times,side="right") - 1
+        return np.clip(i,0,max(len(self) - 1,0))
+
+    def seek_many(self,times,units=False):
+        """(samples,keyframes,chunks,offsets) arrays for each time: the
+        sample at that time, the sync sample decoding has to start from,
+        and the 0 based chunk and file offset of that sync sample"""
+        if len(self) == 0:
+            raise IndexError("seek in an empty track")
+        i = self.samples(times,units)
+        return i,self.keyframes[i],self.chunks[i],self.offsets[i]
+
+    def seek(self,t,units=False):
+        """(sample,keyframe,chunk,offset) for one time, see seek_many"""
+        return tuple(int(x) for x in self.seek_many(t,units))
+
+def seek_indices(tables):
+    """SeekIndex of every SampleTable or FragmentTable"""
+    return [SeekIndex(t) for t in tables]
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Unit tests for seekindex.py
+
+"""
+
+import fragments
+import numpy as np
+import sampletable
+from sampletabletest import load_trak, render_full_atom, render_table, \
+    render_trak
+import seekindex
+import struct
+import unittest
+
+class SeekByTime(unittest.TestCase):
+    # decode timestamps 0, 20, 40, 60, 100, 140, 180 at 600 units per
+    # second, keyframes 0 and 4, chunks 0-0-1-1-2-2-2
+    def setUp(self):
+        self.tables = [
+            render_table('stts', '>LL', [(3, 20), (4, 40)]),
+            render_full_atom('stsz', struct.pack('>LL', 0, 7)
+                + ''.join([struct.pack('>L', s) for s in range(10, 17)])),
+            render_table('stsc', '>LLL', [(1, 2, 1), (3, 3, 1)]),
+            render_table('stco', '>L', [(1000,), (2000,), (3000,)]),
+            render_table('stss', '>L', [(1,), (5,)]),
+        ]
+        self.index = seekindex.SeekIndex(sampletable.SampleTable(
+            load_trak(render_trak(self.tables))))
+    
+    def tearDown(self):
+        del self.index
+    
+    def testSeekInSeconds(self):
+        self.assertEqual((3, 0, 0, 1000), self.index.seek(0.1))
+        self.assertEqual((5, 4, 2, 3000), self.index.seek(0.25))
+    
+    def testSeekInUnits(self):
+        self.assertEqual((4, 4, 2, 3000), self.index.seek(100, units=True))
+        self.assertEqual((3, 0, 0, 1000), self.index.seek(99, units=True))
+    
+    def testTimesOutsideTheTrack(self):
+        self.assertEqual((0, 0, 0, 1000), self.index.seek(-1))
+        self.assertEqual((6, 4, 2, 3000), self.index.seek(3600))
+    
+    def testSeekMany(self):
+        times = np.arange(-10, 300, 7)
+        (samples, keyframes, chunks, offsets) = self.index.seek_many(
+            times, units=True)
+        for (k, t) in enumerate(times):
+            self.assertEqual(self.index.seek(t, units=True),
+                             (samples[k], keyframes[k], chunks[k], offsets[k]))
+    
+    def testTrackNotStartingOnAKeyframe(self):
+        self.tables[-1] = render_table('stss', '>L', [(3,)])
+        index = seekindex.SeekIndex(sampletable.SampleTable(
+            load_trak(render_trak(self.tables))))
+        self.assertEqual([2, 2, 2, 2], list(index.seek_many([0, 20, 40, 60],
+                                                            units=True)[1]))
+    
+    def testFragmentsStandInForChunks(self):
+        table = fragments.FragmentTable(1, 'vide', 1000)
+        for fragment in range(3):
+            table.add(fragment, np.arange(2) * 10 + fragment * 100,
+                      np.full(2, 10), np.full(2, 40), np.zeros(2),
+                      np.array([0, fragments.SAMPLE_IS_NON_SYNC_SAMPLE]),
+                      None)
+        table.join()
+        index = seekindex.SeekIndex(table)
+        self.assertEqual((3, 2, 1, 100), index.seek(0.13))
+    
+    def testEmptyTrack(self):
+        index = seekindex.SeekIndex(fragments.FragmentTable(1))
+        self.assertRaises(IndexError, index.seek, 0)
+    
+
+if __name__ == "__main__":
+    unittest.main()
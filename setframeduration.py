@@ -14,19 +14,143 @@
 import sys
 import os
 import struct
+import StringIO
+import ctypes
+import ctypes.util
 from mp4file import Mp4File
-from atom import Atom
+from atom import Atom, get_header_size, render_atom_header
+from sampletable import remap_chunk_offsets, run_lengths
 import numpy as np
 
-def copyfileobj(fsrc, fdst, size,length=16*1024):
-    """copy data from file-like object fsrc to file-like object fdst"""
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library("c"),use_errno=True)
+except OSError:
+    libc = None
+
+def libc_function(name,*argtypes):
+    """name from the C library returning ssize_t, None when it is missing
+    (the os module of Python 2 has no copy_file_range nor sendfile)"""
+    f = getattr(libc,name,None)
+    if f is None:
+        return None
+    f.argtypes = argtypes
+    f.restype = ctypes.c_ssize_t
+    return f
+
+loff_p = ctypes.POINTER(ctypes.c_int64)
+copy_file_range = libc_function("copy_file_range",ctypes.c_int,loff_p,ctypes.c_int,loff_p,ctypes.c_size_t,ctypes.c_uint)
+sendfile = libc_function("sendfile64",ctypes.c_int,ctypes.c_int,loff_p,ctypes.c_size_t)
+
+def kernelcopy(fsrc, fdst, size):
+    """copy up to size bytes between two real files inside the kernel with
+    copy_file_range (which may share extents, reflink-style) or sendfile.
+    Returns the number of bytes copied, that is 0 if neither is usable"""
+    if copy_file_range is None and sendfile is None:
+        return 0
+    try:
+        fin = fsrc.fileno()
+        fout = fdst.fileno()
+    except (AttributeError, IOError, ValueError):
+        return 0
+    # the kernel works on descriptors: flush what is buffered first, then
+    # pass explicit positions and move the file objects along afterwards
+    fdst.flush()
+    src = fsrc.tell()
+    dst = fdst.tell()
+    done = 0
+    copy = copy_file_range
+    while done < size:
+        src_offset = ctypes.c_int64(src + done)
+        dst_offset = ctypes.c_int64(dst + done)
+        if copy is not None:
+            n = copy(fin, src_offset, fout, dst_offset, size - done, 0)
+            if n < 0:
+                # eg. unsupported across these filesystems: try sendfile
+                copy = None
+                continue
+        elif sendfile is not None:
+            os.lseek(fout, dst + done, os.SEEK_SET)
+            n = sendfile(fout, fin, src_offset, size - done)
+        else:
+            break
+        # on errors the caller copies the rest
+        if n <= 0:
+            break
+        done += n
+    fsrc.seek(src + done, os.SEEK_SET)
+    fdst.seek(dst + done, os.SEEK_SET)
+    return done
+
+def copyfileobj(fsrc, fdst, size,length=1024*1024):
+    """copy size bytes from file-like object fsrc to file-like object fdst,
+    in the kernel when possible, else at most length bytes at a time"""
+    size -= kernelcopy(fsrc, fdst, size)
     while size > 0:
-        buf = fsrc.read(length if length > size else size)
+        buf = fsrc.read(min(length,size))
         if not buf:
             break
         size -= len(buf)
         fdst.write(buf)
 
+# time units per second by default: the usual video timescale, in which
+# the frames of all the common rates (24, 25, 30, 60 and their 1000/1001
+# NTSC variants) last a whole number of units, so a constant rate encodes
+# to a single stts entry
+DEFAULT_TIMEUNIT = 90000
+
+def rle_durations(durations,tolerance=0):
+    """Compresses a (count,duration) table, durations in time units, into
+    the fewest stts (sample_count,sample_delta) entries.
+
+    Durations become whole time units by rounding the running timestamps,
+    so no frame drifts by more than half a unit. With a tolerance, frames
+    are merged into runs taking the delta v of their first frame, as long
+    as the timestamps stay within tolerance units of the rounded ones; the
+    last frame of a run takes whatever the run drifted by, so that every
+    run ends exactly where it should. Jitter around a whole number of time
+    units compresses well, a rate between two whole numbers hardly does."""
+    d = np.repeat(durations[:,1],durations[:,0].astype(np.int64))
+    d = np.diff(np.concatenate(([0],np.round(np.cumsum(d)).astype(np.int64))))
+    n = d.shape[0]
+    if n == 0:
+        return np.zeros((0,2),dtype=np.int64)
+    counts,values = run_lengths(d)
+    if tolerance > 0:
+        # one step per run of equal durations: within it the drift
+        # changes by the same amount every frame
+        runs = [] # (frames,v,drift) with drift = sum of duration - v
+        frames,v,drift = 0,None,0
+        for m,x in zip(counts.tolist(),values.tolist()):
+            step = x - v if v is not None else 0
+            # frames taken while the drift so far is within tolerance
+            if v is None or abs(drift) > tolerance:
+                taken = 0
+            elif step > 0:
+                taken = min(m,(tolerance - drift)//step + 1)
+            elif step < 0:
+                taken = min(m,(drift + tolerance)//-step + 1)
+            else:
+                taken = m
+            frames += taken
+            drift += taken*step
+            if taken < m:
+                if frames > 0:
+                    runs.append((frames,v,drift))
+                frames,v,drift = m - taken,x,0
+        runs.append((frames,v,drift))
+        runs = np.array(runs,dtype=np.int64)
+        entries = np.empty((runs.shape[0]*2,2),dtype=np.int64)
+        entries[0::2,0] = runs[:,0] - 1
+        entries[0::2,1] = runs[:,1]
+        entries[1::2,0] = 1
+        entries[1::2,1] = runs[:,1] + runs[:,2]
+        entries = entries[entries[:,0] > 0]
+        # neighbouring entries may now have the same delta: merge them too
+        counts,values = run_lengths(entries[:,1])
+        first = np.cumsum(counts) - counts
+        counts = np.add.reduceat(entries[:,0],first)
+    return np.column_stack((counts,values))
+
 """
   ftyp,
   free,
@@ -57,29 +181,28 @@ def copyfileobj(fsrc, fdst, size,length=16*1024):
 
 
 Copy exactly up to moov (exact bytes to be fast)
-Put all the metadata atoms in memory altering the content of:
+Clone the metadata atoms, keeping in memory only what changes in:
     mvhd e mdhd due to the duration change
     stts with the new durations
 """
 
 def cloneatom(a):
-    oa = Atom(type=a.type)
-    if not a.is_normal_container():
-        # content followed by table
-        oa.makestrstorage() # avoid using file
-        a.seek(0,os.SEEK_SET)
-        z = a.read()
-        if len(z) != a.size():
-            print "ERROR of size with atom",a.type
-            raise Exception()
-        oa.write(z)
-        if a.is_special_container():
-            print "special ",a.type,"has content",len(z),"and children",len(a)
-    if a.is_container():
-        for x in a:
-            oa.append(cloneatom(x))        
-    a.seek(0,os.SEEK_SET) #rewind
-    return oa
+    """Copy of a for patching: content is read from the input on save and
+    only the patched bytes are held in memory"""
+    return a.clone()
+
+def toplevel(infile,lazy=False):
+    """Lists (start,end,atom) of the top level atoms of infile"""
+    infile.seek(0,os.SEEK_END)
+    size = infile.tell()
+    infile.seek(0,os.SEEK_SET)
+    atoms = []
+    while infile.tell() < size:
+        pre = infile.tell()
+        root_atom = Atom( stream=infile, offset=pre, lazy=lazy )
+        root_atom.seek( 0, os.SEEK_END )
+        atoms.append((pre,infile.tell(),root_atom))
+    return atoms
 
 class Mp4TimeSetter:
     def __init__(self,infile,output,durations,rate,duration,timeunit_hz,stream,verbose):
@@ -97,56 +220,96 @@ class Mp4TimeSetter:
     def run(self):
         self.found = False
         """ Process the MP4 """
-        moovseen = False
-        self.infile.seek(0,os.SEEK_END)
-        size = self.infile.tell()
+        atoms = toplevel(self.infile)
+        k = [i for i,(pre,post,a) in enumerate(atoms) if a.type == "moov"]
+        if len(k) == 0:
+            print "no moov found"
+            return False
+        pre,post,root_atom = atoms[k[0]]
+        print "cloning all moov"
+        c = cloneatom(root_atom)
+        print "Cloned moov with",len(c),"children"
+
+        print "Patching moov"
+        self.descendfix(c)
+        moov = self.render(c)
+        # data after moov moves by as much as moov changes size, and so do
+        # the chunk offsets pointing there; moving them may promote stco to
+        # co64 and grow moov further, so repeat until the size is stable
+        delta = 0
+        while post < atoms[-1][1] and len(moov) - (post-pre) != delta:
+            delta = len(moov) - (post-pre)
+            print "Shifting chunk offsets after moov by",delta
+            c = cloneatom(root_atom)
+            self.descendfix(c)
+            remap_chunk_offsets(c,lambda o: o + np.where(o >= post,delta,0))
+            moov = self.render(c)
+
         self.infile.seek(0,os.SEEK_SET)
-        while self.infile.tell() < size:
-            pre = self.infile.tell()
-            root_atom = Atom( stream=self.infile, offset=pre )
-            root_atom.seek( 0, os.SEEK_END )
-            if root_atom.type == "moov":
-                moovseen = True
-                post = self.infile.tell()
-                print "cloning all moov"
-                c = cloneatom(root_atom)
-                print "Cloned moov with",len(c),"children"
-
-                self.infile.seek(0,os.SEEK_SET)
-                print "Found moov at",pre,"copying for this size from input:",self.infile.tell(),"to output:",self.output.tell()
-                copyfileobj(self.infile,self.output,pre)
-
-                print "Patching moov"
-                self.descendfix(c)
-                print "Writing moov to output"
-                # write out moov adjusting sizes
-                c.save(self.output)
-                print "Continuining after moov with input:",post,"output:",self.output.tell()
-                self.infile.seek(post,os.SEEK_SET) 
-            elif moovseen:
-                print "unsupported after moov",root_atom.type
-                self.found = False
+        print "Found moov at",pre,"copying for this size from input:",self.infile.tell(),"to output:",self.output.tell()
+        copyfileobj(self.infile,self.output,pre)
+        print "Writing moov to output"
+        self.output.write(moov)
+        print "Continuining after moov with input:",post,"output:",self.output.tell()
+        self.infile.seek(post,os.SEEK_SET)
+        copyfileobj(self.infile,self.output,atoms[-1][1]-post)
         return self.found 
+    def render(self,c):
+        """Saves an atom in memory, moov is small enough to know its size"""
+        out = StringIO.StringIO()
+        c.save(out)
+        return out.getvalue()
+    def run_inplace(self):
+        """ Patches moov inside the input itself, that has to be open for update.
+
+        Only possible when the new moov fits in the old one plus the free
+        atoms right around it: mdat does not move, so no chunk offset
+        changes, and whatever space is left over becomes a free atom.
+        Returns False, leaving the input untouched, when it does not fit
+        or there is no stts to patch."""
+        self.found = False
+        atoms = toplevel(self.infile)
+        k = [i for i,(pre,post,a) in enumerate(atoms) if a.type == "moov"]
+        if len(k) == 0:
+            print "no moov found"
+            return False
+        first = last = k[0]
+        while first > 0 and atoms[first-1][2].type in ("free","skip"):
+            first -= 1
+        while last+1 < len(atoms) and atoms[last+1][2].type in ("free","skip"):
+            last += 1
+        start = atoms[first][0]
+        available = atoms[last][1] - start
+
+        print "cloning all moov"
+        c = cloneatom(atoms[k[0]][2])
+        print "Patching moov"
+        self.descendfix(c)
+        if not self.found:
+            print "no stts found"
+            return False
+        moov = self.render(c)
+        slack = available - len(moov)
+        # the leftover has to hold at least the header of a free atom
+        if slack < 0 or 0 < slack < get_header_size(0):
+            print "new moov of",len(moov),"does not fit in",available
+            return False
+        print "Writing moov in place at",start,"with",slack,"bytes of free"
+        self.infile.seek(start,os.SEEK_SET)
+        self.infile.write(moov)
+        if slack > 0:
+            # the content of the free atom is whatever was there before
+            self.infile.write(render_atom_header("free",slack-get_header_size(slack)))
+        self.infile.flush()
+        return self.found
     def descendfix(self,c,sep=""):
         print "entering",sep,c.type
         if c.type == "mvhd" or c.type == "mdhd":
-            c.seek(0, os.SEEK_SET)
-            L = c.read(4)
-            print "Patching",c.type,len(L),"with ",dict(duration=self.duration,timeunit_hz=self.timeunit_hz)
-            v1 = struct.unpack(">L",L)[0]
-            if v1 == 1:
-                created_t,modified_t = struct.unpack(">QQ",c.read(16))
-                tss = 8
-            else:
-                created_t,modified_t = struct.unpack(">LL",c.read(8))
-                tss = 4
-            c.write(struct.pack(">L",self.timeunit_hz))
-            if v1 == 1:
-                c.write(struct.pack(">Q",self.duration))
-            else:
-                c.write(struct.pack(">L",self.duration))
-            c.write(struct.pack(">H",1)) # WHY we need to write it down
-            #typically 1 c.write(struct.pack(">H",self.rate))
+            print "Patching",c.type,"with ",dict(duration=self.duration,timeunit_hz=self.timeunit_hz)
+            h = c.decode()._replace(timescale=self.timeunit_hz,duration=int(self.duration))
+            if c.type == "mvhd":
+                h = h._replace(rate=1.0) #typically 1 rather than self.rate
+            c.encode(h)
         elif c.type == "stts":        
             c.seek(0, os.SEEK_SET)
             v1 = struct.unpack(">L",c.read(4))[0]
@@ -155,7 +318,7 @@ class Mp4TimeSetter:
             print "Patching stss with",n,"elements","version",v1
             c.write(struct.pack(">L",n))
             # now append all the stss
-            c.write(np.reshape(self.durations.astype(np.dtype(">i4")),n*2).tostring())
+            c.write(np.reshape(self.durations.astype(np.dtype(">u4")),n*2).tostring())
             self.found = True
         if c.is_container():
             #print "descending",sep,c.type
@@ -171,7 +334,9 @@ def main():
     parser.add_argument("--verbose",action="store_true")
     parser.add_argument("--stream",type=int,default=0)
     parser.add_argument("--scale",type=float,default=1)
-    parser.add_argument("--timeunit",type=int,default=1000)
+    parser.add_argument("--timeunit",type=int,default=DEFAULT_TIMEUNIT,help="time units per second of the output")
+    parser.add_argument("--tolerance",type=int,default=0,help="timestamps may move by up to this many time units to merge durations")
+    parser.add_argument("--inplace",action="store_true",help="patches the input itself when the new moov fits")
 
     args = parser.parse_args()
 
@@ -188,18 +353,32 @@ def main():
     durations[:,1] *= args.timeunit
     if args.scale != 1:
         durations[:,1] *= args.scale
+    frames = int(np.sum(durations[:,0]))
+    durations = rle_durations(durations,args.tolerance)
     print durations
-    total = np.sum(durations[:,1])
-    print "total is",total/args.timeunit,"seconds with ",durations.shape[0],"frames"
-    # TODO convert durations to RLE
+    total = np.sum(durations[:,0]*durations[:,1])
+    print "total is",total/float(args.timeunit),"seconds with ",frames,"frames in",durations.shape[0],"stts entries"
 
     # rate duration timeunit_hz
+    if args.inplace:
+        ee = Mp4TimeSetter(open(args.input,"r+b"),None,  durations, 1, total, args.timeunit ,args.stream,args.verbose)
+        if ee.run_inplace():
+            print "done in place"
+            return
+        print "cannot patch in place, rewriting to",args.output
     q = open(args.output+".tmp","wb")
     #self,infile,output,durations,rate,duration,timeunit_hzoutput,stream,verbose
     ee = Mp4TimeSetter(open(args.input,"rb"),q,  durations, 1, total, args.timeunit ,args.stream,args.verbose)
-    if ee.run():
-        print "done"
+    done = False
+    try:
+        done = ee.run()
+    finally:
         q.close()
+        # no partial output is left behind
+        if not done:
+            os.remove(args.output+".tmp")
+    if done:
+        print "done"
         os.rename(args.output+".tmp",args.output)
     else:
         print "error"
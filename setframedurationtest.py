@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Unit tests for setframeduration.py
+
+"""
+
+import atom
+import mp4file
+import mp4synth
+import numpy as np
+import os
+import sampletable
+import setframeduration
+import shutil
+import tempfile
+import unittest
+
+def timestamps(entries):
+    return np.cumsum(np.repeat(entries[:, 1], entries[:, 0]))
+
+class EncodeDurations(unittest.TestCase):
+    def encode(self, durations, tolerance):
+        table = np.column_stack((np.ones(len(durations)), durations))
+        entries = setframeduration.rle_durations(table, tolerance)
+        error = np.abs(timestamps(entries) - np.cumsum(durations)).max()
+        return (entries, error)
+    
+    def testEqualDurationsAreMerged(self):
+        (entries, error) = self.encode([40, 40, 40, 33, 33], 0)
+        self.assertEqual([[3, 40], [2, 33]], entries.tolist())
+        self.assertEqual(0, error)
+    
+    def testFractionalDurationsKeepTheirTotal(self):
+        table = np.array([[3, 33.4]])
+        entries = setframeduration.rle_durations(table)
+        self.assertEqual([33, 34, 33], list(np.diff(
+            np.concatenate(([0], timestamps(entries))))))
+    
+    def testRampStaysWithinTolerance(self):
+        for tolerance in (1, 2, 5):
+            for repeat in (1, 50):
+                (entries, error) = self.encode(
+                    np.repeat(np.arange(33, 41), repeat), tolerance)
+                self.assertTrue(error <= tolerance)
+    
+    def testConstantRatesAreOneEntry(self):
+        for rate in (24, 25, 30, 60, 30000 / 1001.0):
+            seconds = np.column_stack((np.ones(3600 * 30), np.ones(3600 * 30)
+                / rate))
+            entries = setframeduration.rle_durations(seconds
+                * [1, setframeduration.DEFAULT_TIMEUNIT])
+            self.assertEqual(1, len(entries))
+    
+    def testJitterAroundWholeDurationIsMerged(self):
+        durations = 40 + np.tile([1, -1, 0, 1, -1], 100)
+        (entries, error) = self.encode(durations, 1)
+        self.assertTrue(error <= 1)
+        self.assertTrue(len(entries) <= 3)
+    
+
+class PatchInPlace(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'in.mp4')
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def patch(self):
+        f = open(self.path, 'r+b')
+        setter = setframeduration.Mp4TimeSetter(f, None,
+            np.array([[10, 40]]), 1, 400, 1000, 0, False)
+        patched = setter.run_inplace()
+        f.close()
+        return patched
+    
+    def testPatchesStts(self):
+        mp4synth.synthesize(self.path, samples=10)
+        self.assertTrue(self.patch())
+        mp4 = mp4file.Mp4File(self.path)
+        table = sampletable.sample_tables(mp4)[0]
+        mp4.close()
+        self.assertEqual([40] * 10, list(table.durations))
+        self.assertEqual(1000, table.timescale)
+    
+    def testLeavesInputWithoutSttsUntouched(self):
+        track = mp4synth.SyntheticTrack(1, 10)
+        content = mp4synth.FTYP + mp4synth.box('moov',
+            mp4synth.mvhd([track])) + mp4synth.box('mdat', '\0' * 100)
+        f = open(self.path, 'wb')
+        f.write(content)
+        f.close()
+        
+        self.assertFalse(self.patch())
+        self.assertEqual(content, open(self.path, 'rb').read())
+    
+def sample_bytes(path):
+    f = open(path, 'rb')
+    mp4 = mp4file.Mp4File(path)
+    table = sampletable.sample_tables(mp4)[0]
+    mp4.close()
+    samples = []
+    for (offset, size) in zip(table.offsets, table.sizes):
+        f.seek(offset)
+        samples.append(f.read(size))
+    f.close()
+    return samples
+
+def chunk_offset_type(path):
+    mp4 = mp4file.Mp4File(path)
+    types = [a.type for a in mp4.find('moov/**/stbl/*')]
+    mp4.close()
+    return [t for t in types if t in ('stco', 'co64')][0]
+
+class RewriteMoov(unittest.TestCase):
+    # one stts entry per sample once retimed: moov grows
+    durations = np.column_stack((np.ones(10), 40 + np.arange(10)))
+    
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'in.mp4')
+        self.output = os.path.join(self.directory, 'out.mp4')
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def fill_mdat(self):
+        f = open(self.path, 'r+b')
+        for (pre, post, a) in setframeduration.toplevel(f):
+            if a.type == 'mdat':
+                f.seek(a.offset())
+                f.write(os.urandom(a.size()))
+        f.close()
+    
+    def retime(self):
+        entries = setframeduration.rle_durations(self.durations)
+        total = np.sum(entries[:, 0] * entries[:, 1])
+        f = open(self.path, 'rb')
+        q = open(self.output, 'wb')
+        setter = setframeduration.Mp4TimeSetter(f, q, entries, 1, total,
+            1000, 0, False)
+        done = setter.run()
+        q.close()
+        f.close()
+        return done
+    
+    def testChunkOffsetsFollowMdat(self):
+        mp4synth.synthesize(self.path, samples=10, chunk=3)
+        self.fill_mdat()
+        
+        self.assertTrue(self.retime())
+        self.assertTrue(os.path.getsize(self.output)
+                        > os.path.getsize(self.path))
+        self.assertEqual(sample_bytes(self.path), sample_bytes(self.output))
+    
+    def testChunkOffsetsArePromoted(self):
+        track = mp4synth.SyntheticTrack(1, 10, sample_size=100)
+        moov = lambda offset: mp4synth.box('moov', mp4synth.mvhd([track])
+            + track.sample_table(offset, chunk=2))
+        # a sparse free atom pushes the last chunk right below 4 GiB
+        last = (np.cumsum(track.sizes) - track.sizes)[::2][-1]
+        first = 2**32 - 20 - last
+        f = open(self.path, 'wb')
+        f.write(mp4synth.FTYP + moov(first))
+        gap = first - 8 - f.tell()
+        f.write(atom.render_atom_header('free', gap - 8))
+        f.truncate(f.tell() + gap - 8)
+        f.seek(0, os.SEEK_END)
+        f.write(mp4synth.box('mdat', os.urandom(track.nbytes())))
+        f.close()
+        self.assertEqual('stco', chunk_offset_type(self.path))
+        
+        self.assertTrue(self.retime())
+        self.assertEqual('co64', chunk_offset_type(self.output))
+        self.assertEqual(sample_bytes(self.path), sample_bytes(self.output))
+    
+
+class CountingFile(file):
+    reads = 0
+    
+    def read(self, *args):
+        self.reads += 1
+        return file.read(self, *args)
+    
+
+class CopyPassthrough(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'in')
+        self.content = os.urandom(3 * 1024 * 1024 + 17)
+        open(self.path, 'wb').write(self.content)
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def copy(self, start, size):
+        fsrc = CountingFile(self.path, 'rb')
+        fdst = open(os.path.join(self.directory, 'out'), 'w+b')
+        fdst.write('head')
+        fsrc.seek(start)
+        setframeduration.copyfileobj(fsrc, fdst, size)
+        position = (fsrc.tell(), fdst.tell())
+        fdst.seek(0)
+        copied = fdst.read()
+        fsrc.close()
+        fdst.close()
+        return (fsrc.reads, position, copied)
+    
+    def testCopiesInTheKernel(self):
+        if setframeduration.copy_file_range is None \
+                and setframeduration.sendfile is None:
+            self.skipTest('no copy_file_range nor sendfile in the C library')
+        (reads, position, copied) = self.copy(5, len(self.content) - 10)
+        self.assertEqual(0, reads)
+        self.assertEqual((len(self.content) - 5, len(self.content) - 6),
+                         position)
+        self.assertEqual('head' + self.content[5:-5], copied)
+    
+    def testFallsBackToReads(self):
+        kernelcopy = setframeduration.kernelcopy
+        setframeduration.kernelcopy = lambda fsrc, fdst, size: 0
+        try:
+            (reads, position, copied) = self.copy(5, len(self.content) - 10)
+        finally:
+            setframeduration.kernelcopy = kernelcopy
+        self.assertNotEqual(0, reads)
+        self.assertEqual('head' + self.content[5:-5], copied)
+    
+
+if __name__ == '__main__':
+    unittest.main()